@@ -1,48 +1,12 @@
-import json
 import logging
-from typing import Callable, Optional, Any, Tuple
+from typing import Callable, Optional, Any
 from langchain_core.messages import SystemMessage, HumanMessage
-from app.commons.services.miscelaneous import load_prompts_generales
-
-
-def _strip_code_fences(text: str) -> str:
-    if not isinstance(text, str):
-        return text
-    text = text.strip()
-    if text.startswith("```"):
-        first_newline = text.find("\n")
-        if first_newline != -1:
-            text = text[first_newline + 1:].strip()
-    if text.endswith("```"):
-        text = text[:-3].strip()
-    return text
-
-
-def _extract_json(text: str) -> Tuple[Optional[Any], Optional[Exception]]:
-    if text is None:
-        return None, ValueError("Empty response")
-
-    try:
-        return json.loads(text), None
-    except Exception:
-        pass
-
-    stripped = _strip_code_fences(text)
-    try:
-        return json.loads(stripped), None
-    except Exception:
-        pass
-
-    try:
-        start = stripped.find("{")
-        end = stripped.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            candidate = stripped[start:end + 1]
-            return json.loads(candidate), None
-    except Exception as e:
-        return None, e
-
-    return None, ValueError("Could not parse JSON after repairs")
+from app.commons.services.prompt_registry import obtener_prompt
+from app.commons.services.context_cache import mensajes_con_prefijo
+from app.commons.services.json_respuesta import extraer_json
+from app.commons.services.esquemas_etapas import invocar_estructurado
+from app.commons.services.metrics import registrar_fallo_parseo, registrar_reintento_json
+from app.commons.services.cancelacion import CasoCancelado
 
 
 def evaluar_circunstancias_marcus(
@@ -61,7 +25,7 @@ def evaluar_circunstancias_marcus(
     Devuelve SIEMPRE un dict (JSON parseado). En caso de error devuelve {"error": "..."}.
     """
     try:
-        base_prompt = load_prompts_generales("evaluar_circunstancias_marcus")
+        base_prompt = obtener_prompt("evaluar_circunstancias_marcus")
         if not base_prompt:
             return {"error": "❌ Prompt 'evaluar_circunstancias_marcus' no encontrado en YAML."}
 
@@ -78,23 +42,23 @@ def evaluar_circunstancias_marcus(
         if force_json_only:
             system_msg = f"{system_msg}\n\n# OUTPUT FORMAT (REQUIRED)\n{json_rules}"
 
-        user_content = [
-            {"type": "text", "text": "Aplica la matriz Marcus al caso siguiente y devuelve SOLO JSON válido:"},
-            {"type": "text", "text": f"Contexto Marcus:\n{contexto_marcus}"},
-            {"type": "text", "text": f"JSON Visual:\n{json_visual}"},
-            {"type": "text", "text": f"JSON Transcripción:\n{json_transcripcion}"},
-        ]
-
-        mensajes = [
-            SystemMessage(content=system_msg),
-            HumanMessage(content=user_content),
-        ]
+        # Prefijo estable (system + instrucción) y al final lo propio del caso. El contexto
+        # Marcus va en la parte variable: con IndiceMarcus se filtra distinto en cada caso
+        mensajes = mensajes_con_prefijo(
+            system_msg,
+            ["Aplica la matriz Marcus al caso siguiente y devuelve SOLO JSON válido:"],
+            [
+                {"type": "text", "text": f"Contexto Marcus:\n{contexto_marcus}"},
+                {"type": "text", "text": f"JSON Visual:\n{json_visual}"},
+                {"type": "text", "text": f"JSON Transcripción:\n{json_transcripcion}"},
+            ],
+        )
 
         logging.info("📨 Enviando análisis de circunstancias Marcus al LLM (intento 1)...")
-        respuesta = llm.invoke(mensajes)
+        respuesta = invocar_estructurado(llm, mensajes, etapa="circunstancias")
         raw = respuesta.content if hasattr(respuesta, "content") else str(respuesta)
 
-        parsed, err = _extract_json(raw)
+        parsed, err = extraer_json(raw)
 
         if parsed is not None and schema_validator:
             try:
@@ -106,21 +70,24 @@ def evaluar_circunstancias_marcus(
         attempts = 0
         while parsed is None and attempts < max_retries:
             attempts += 1
-            logging.warning(f"🔁 Reintentando porque la respuesta no es JSON válido: {err}")
+            logging.warning(f"🔁 Reintentando con el LLM: respuesta sin JSON válido (ni tras reparación local) o fuera de esquema: {err}")
+            registrar_reintento_json()
 
             fix_messages = [
                 SystemMessage(content=system_msg),
                 HumanMessage(content=[
                     {"type": "text",
-                     "text": "La respuesta anterior NO fue JSON válido. Corrige y devuelve SOLO un JSON válido."},
+                     "text": "La respuesta anterior NO fue JSON válido o no cumple la estructura pedida. "
+                             "Corrige y devuelve SOLO un JSON válido."},
+                    {"type": "text", "text": f"Problema detectado: {err}"},
                     {"type": "text",
                      "text": "RECUERDA: no incluyas texto adicional ni formato Markdown; solo el objeto JSON."},
                     {"type": "text", "text": f"Respuesta previa (para corregir):\n{raw}"},
                 ])
             ]
-            respuesta = llm.invoke(fix_messages)
+            respuesta = invocar_estructurado(llm, fix_messages, etapa="circunstancias")
             raw = respuesta.content if hasattr(respuesta, "content") else str(respuesta)
-            parsed, err = _extract_json(raw)
+            parsed, err = extraer_json(raw)
 
             if parsed is not None and schema_validator:
                 try:
@@ -131,11 +98,14 @@ def evaluar_circunstancias_marcus(
 
         if parsed is None:
             logging.error(f"❌ No se pudo obtener JSON válido del LLM: {err}")
+            registrar_fallo_parseo()
             return {"error": f"No se pudo parsear JSON: {str(err)}", "raw": raw}
 
         # ✅ Devuelve el dict JSON directamente
         return parsed
 
+    except CasoCancelado:
+        raise
     except Exception as e:
         logging.error(f"❌ Error al evaluar circunstancias Marcus: {e}", exc_info=True)
         return {"error": str(e)}
@@ -0,0 +1,203 @@
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from app.commons.services.stage_scheduler import Etapa, ResultadoPlan
+from app.commons.services.prompt_registry import obtener_prompt
+from app.commons.services.checkpoints import CheckpointCaso, es_resultado_error, hash_archivo, hash_texto, huella
+from app.commons.services.cancelacion import config_plazos
+from app.commons.services.marcus_index import IndiceMarcus, contexto_para_caso
+from app.commons.services.metrics import instrumentar_etapa
+from app.commons.services.esquemas_etapas import validador_etapa
+from app.commons.services.model_routing import ejecutar_con_escalamiento, firma_politica
+
+from app.Funciones.procesar_audio import transcribir_audio_gemini
+from app.Funciones.procesar_imagen import procesar_imagen, procesar_imagen_ficha
+from app.Funciones.Procesar_circunstancias import evaluar_circunstancias_marcus
+from app.Funciones.presicion import evaluar_coherencia_visual_vs_ficha
+
+
+# ============================================================
+# GRAFO DEL CASO
+# ============================================================
+#   visual ──┬──────────────► circunstancias
+#   audio  ──┘          ┌───► precision
+#   visual ─────────────┤
+#   ficha  ─────────────┘
+
+# Archivo de salida de cada etapa dentro de la carpeta del caso
+ARCHIVOS_SALIDA: Dict[str, str] = {
+    "visual": "hechos_visual.json",
+    "ficha": "ficha_siniestro.json",
+    "audio": "transcripcion.txt",
+    "circunstancias": "resultado_circunstancias.json",
+    "precision": "precision_visual_vs_ficha.json",
+}
+
+# Clave de cada etapa en la respuesta consolidada del caso
+CLAVES_RESULTADO: Dict[str, str] = {
+    "visual": "hechos_visual",
+    "ficha": "ficha_siniestro",
+    "audio": "transcripcion_text",
+    "circunstancias": "resultado_circunstancias",
+    "precision": "precision_visual_vs_ficha",
+}
+
+
+# Sin hechos visuales no hay respuesta útil: circunstancias y precisión dependen de ellos
+ETAPAS_REQUERIDAS: Tuple[str, ...] = ("visual",)
+
+
+class CasoFallido(Exception):
+    """El caso no produjo una respuesta utilizable; `detalle` lleva los errores por etapa."""
+
+    def __init__(self, motivo: str, detalle: Optional[Dict[str, Any]] = None):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.detalle = detalle or {}
+
+
+def errores_caso(plan: ResultadoPlan, errores_salida: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Errores del caso para la respuesta: `errores_etapas` (etapas que lanzaron
+    excepción o devolvieron {"error": ...}) y `etapas_bloqueadas` (no
+    ejecutadas -> dependencias fallidas).
+    """
+    return {
+        "errores_etapas": {
+            **errores_salida,
+            **{etapa: error for etapa, error in plan.errores.items() if etapa not in plan.bloqueadas},
+        },
+        "etapas_bloqueadas": dict(plan.bloqueadas),
+    }
+
+
+# Prompt de cada etapa (entra en la huella del checkpoint: cambiar el prompt invalida la etapa)
+PROMPTS_ETAPA: Dict[str, Tuple[str, ...]] = {
+    "visual": ("extraction_visual",),
+    "ficha": ("extraction_visual_Ficha",),
+    "audio": ("transcription_audio", "transcripcion_segmento_audio"),
+    "circunstancias": ("evaluar_circunstancias_marcus",),
+    "precision": ("evcaluacion_presicion_",),
+}
+
+
+def construir_etapas_caso(
+        ruta_visual_pdf: str,
+        ruta_ficha_png: str,
+        ruta_audio: str,
+        gemini,
+        contexto_marcus: Union[str, IndiceMarcus],
+        modelos: Optional[Callable[[str], Any]] = None,
+) -> List[Etapa]:
+    """
+    Define las 5 fases del caso como grafo de dependencias:
+    visual, ficha y audio son independientes; circunstancias depende de
+    visual + audio y precision de visual + ficha.
+
+    Con `modelos` (nombre -> LLM) cada etapa usa el modelo de
+    config/model_routing.json y escala al siguiente si la salida no convence;
+    sin él todas las etapas usan `gemini`.
+    """
+
+    def _enrutar(etapa: str, funcion: Callable[[Any], Any]) -> Any:
+        if modelos is None:
+            return funcion(gemini)
+        return ejecutar_con_escalamiento(etapa, funcion, modelos)
+
+    def _visual(_: Dict[str, Any]):
+        return _enrutar("visual", lambda llm: procesar_imagen(ruta_visual_pdf, llm=llm))
+
+    def _ficha(_: Dict[str, Any]):
+        return _enrutar("ficha", lambda llm: procesar_imagen_ficha(ruta_ficha_png, llm))
+
+    def _audio(_: Dict[str, Any]):
+        transcripcion = _enrutar("audio", lambda llm: transcribir_audio_gemini(ruta_audio, llm=llm))
+        if es_resultado_error(transcripcion):
+            # transcribir_audio_gemini devuelve "" al fallar: sin transcripción, circunstancias no se evalúa
+            raise RuntimeError("La transcripción del audio falló o quedó vacía (ver log de la etapa).")
+        return transcripcion
+
+    def _circunstancias(dep: Dict[str, Any]):
+        hechos_visual = dep["visual"]
+        # Con IndiceMarcus solo viajan las circunstancias relevantes para los hechos
+        contexto = contexto_para_caso(contexto_marcus, hechos_visual, dep["audio"])
+        return _enrutar("circunstancias", lambda llm: evaluar_circunstancias_marcus(
+            contexto_marcus=contexto,
+            json_visual=hechos_visual.get("resultado", hechos_visual),
+            json_transcripcion=dep["audio"],
+            llm=llm,
+            schema_validator=validador_etapa("circunstancias"),
+        ))
+
+    def _precision(dep: Dict[str, Any]):
+        return _enrutar("precision", lambda llm: evaluar_coherencia_visual_vs_ficha(
+            llm=llm,
+            json_analisis_visual=json.dumps(dep["visual"], ensure_ascii=False),
+            json_ficha_siniestro=json.dumps(dep["ficha"], ensure_ascii=False),
+            schema_validator=validador_etapa("precision"),
+        ))
+
+    plazos = config_plazos().get("por_etapa_s") or {}
+
+    def _etapa(nombre: str, funcion: Callable[[Dict[str, Any]], Any], dependencias: Tuple[str, ...] = ()) -> Etapa:
+        # Cada etapa reporta su duración (y si terminó en error) a /metrics
+        return Etapa(nombre, instrumentar_etapa(nombre)(funcion), dependencias, plazo_s=plazos.get(nombre) or None)
+
+    return [
+        _etapa("visual", _visual),
+        _etapa("ficha", _ficha),
+        _etapa("audio", _audio),
+        _etapa("circunstancias", _circunstancias, ("visual", "audio")),
+        _etapa("precision", _precision, ("visual", "ficha")),
+    ]
+
+
+def huellas_etapas(
+        ruta_visual_pdf: str,
+        ruta_ficha_png: str,
+        ruta_audio: str,
+        contexto_marcus: Union[str, IndiceMarcus],
+) -> Dict[str, str]:
+    """
+    Huella de cada etapa para checkpoints: hash de su archivo de entrada y de
+    sus prompts (y su política de modelo); las etapas derivadas encadenan la huella de sus dependencias
+    (y circunstancias además la matriz Marcus).
+    """
+    def _prompts(etapa: str) -> str:
+        return huella(*(hash_texto(obtener_prompt(p)) for p in PROMPTS_ETAPA[etapa]),
+                      hash_texto(firma_politica(etapa)))
+
+    h = {
+        "visual": huella("visual", hash_archivo(ruta_visual_pdf), _prompts("visual")),
+        "ficha": huella("ficha", hash_archivo(ruta_ficha_png), _prompts("ficha")),
+        "audio": huella("audio", hash_archivo(ruta_audio), _prompts("audio")),
+    }
+    h["circunstancias"] = huella(
+        "circunstancias", h["visual"], h["audio"],
+        contexto_marcus.firma() if isinstance(contexto_marcus, IndiceMarcus) else hash_texto(str(contexto_marcus)),
+        _prompts("circunstancias"),
+    )
+    h["precision"] = huella("precision", h["visual"], h["ficha"], _prompts("precision"))
+    return h
+
+
+def precargar_checkpoint(
+        etapas: List[Etapa],
+        huellas: Dict[str, str],
+        checkpoint: CheckpointCaso,
+) -> Dict[str, Any]:
+    """
+    Salidas reutilizables del checkpoint: una etapa se reutiliza solo si su
+    checkpoint es válido, su salida guardada no está vacía ni es un error
+    (checkpoints escritos por versiones previas) y todas sus dependencias
+    también se reutilizan (si se recalcula visual, sus dependientes se
+    recalculan con la salida nueva).
+    """
+    precargados: Dict[str, Any] = {}
+    for etapa in etapas:  # orden topológico
+        if any(d not in precargados for d in etapa.dependencias):
+            continue
+        previo = checkpoint.cargar(etapa.nombre, huellas[etapa.nombre])
+        if previo is not None and not es_resultado_error(previo):
+            precargados[etapa.nombre] = previo
+    return precargados
@@ -1,62 +1,13 @@
-import json
 import logging
-from typing import Callable, Optional, Any, Tuple
+from typing import Callable, Optional, Any
 
 from langchain_core.messages import SystemMessage, HumanMessage
-from app.commons.services.miscelaneous import load_prompts_generales
-
-
-def _strip_code_fences(text: str) -> str:
-    """
-    Elimina fences de código tipo ``` de una respuesta del LLM.
-    """
-    if not isinstance(text, str):
-        return text
-    text = text.strip()
-    if text.startswith("```"):
-        first_newline = text.find("\n")
-        if first_newline != -1:
-            text = text[first_newline + 1:].strip()
-    if text.endswith("```"):
-        text = text[:-3].strip()
-    return text
-
-
-def _extract_json(text: str) -> Tuple[Optional[Any], Optional[Exception]]:
-    """
-    Intenta extraer JSON válido desde un string.
-    - Primero intenta json.loads directo.
-    - Luego sin fences.
-    - Luego buscando el primer '{' y el último '}'.
-    Devuelve (objeto_json, error) donde error es None si todo salió bien.
-    """
-    if text is None:
-        return None, ValueError("Empty response")
-
-    # Intento directo
-    try:
-        return json.loads(text), None
-    except Exception:
-        pass
-
-    # Intento sin fences
-    stripped = _strip_code_fences(text)
-    try:
-        return json.loads(stripped), None
-    except Exception:
-        pass
-
-    # Intento recortando desde el primer '{' hasta el último '}'
-    try:
-        start = stripped.find("{")
-        end = stripped.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            candidate = stripped[start:end + 1]
-            return json.loads(candidate), None
-    except Exception as e:
-        return None, e
-
-    return None, ValueError("Could not parse JSON after repairs")
+from app.commons.services.prompt_registry import obtener_prompt
+from app.commons.services.context_cache import mensajes_con_prefijo
+from app.commons.services.json_respuesta import extraer_json
+from app.commons.services.esquemas_etapas import invocar_estructurado
+from app.commons.services.metrics import registrar_fallo_parseo, registrar_reintento_json
+from app.commons.services.cancelacion import CasoCancelado
 
 
 def evaluar_coherencia_visual_vs_ficha(
@@ -82,7 +33,7 @@ def evaluar_coherencia_visual_vs_ficha(
     """
     try:
         # 1. Cargar prompt base desde YAML
-        base_prompt = load_prompts_generales("evcaluacion_presicion_")
+        base_prompt = obtener_prompt("evcaluacion_presicion_")
         if not base_prompt:
             return {"error": "❌ Prompt 'evaluar_coherencia_visual_vs_ficha' no encontrado en YAML."}
 
@@ -101,32 +52,27 @@ def evaluar_coherencia_visual_vs_ficha(
             system_msg = f"{system_msg}\n\n# OUTPUT FORMAT (REQUIRED)\n{json_rules}"
 
         # 3. Construir mensaje de usuario (SOLO DOS JSON, como pediste)
-        user_content = [
-            {
-                "type": "text",
-                "text": (
-                    "Evalúa la coherencia entre el ANÁLISIS VISUAL del siniestro y la FICHA DOCUMENTAL, "
-                    "asociando placas, interpretando la causa del siniestro y comparando la responsabilidad. "
-                    "Devuelve SOLO un JSON válido siguiendo las instrucciones del sistema."
-                ),
-            },
-            {"type": "text", "text": "ANÁLISIS VISUAL (JSON):"},
-            {"type": "text", "text": json_analisis_visual},
-            {"type": "text", "text": "FICHA DEL SINIESTRO (JSON):"},
-            {"type": "text", "text": json_ficha_siniestro},
-        ]
-
-        mensajes = [
-            SystemMessage(content=system_msg),
-            HumanMessage(content=user_content),
-        ]
+        mensajes = mensajes_con_prefijo(
+            system_msg,
+            [
+                "Evalúa la coherencia entre el ANÁLISIS VISUAL del siniestro y la FICHA DOCUMENTAL, "
+                "asociando placas, interpretando la causa del siniestro y comparando la responsabilidad. "
+                "Devuelve SOLO un JSON válido siguiendo las instrucciones del sistema.",
+                "ANÁLISIS VISUAL (JSON):",
+            ],
+            [
+                {"type": "text", "text": json_analisis_visual},
+                {"type": "text", "text": "FICHA DEL SINIESTRO (JSON):"},
+                {"type": "text", "text": json_ficha_siniestro},
+            ],
+        )
 
         # 4. Primera invocación al LLM
         logging.info("📨 Enviando evaluación de coherencia visual vs ficha al LLM (intento 1)...")
-        respuesta = llm.invoke(mensajes)
+        respuesta = invocar_estructurado(llm, mensajes, etapa="precision")
         raw = respuesta.content if hasattr(respuesta, "content") else str(respuesta)
 
-        parsed, err = _extract_json(raw)
+        parsed, err = extraer_json(raw)
 
         # 5. Validación opcional contra schema (Pydantic u otro)
         if parsed is not None and schema_validator:
@@ -140,7 +86,8 @@ def evaluar_coherencia_visual_vs_ficha(
         attempts = 0
         while parsed is None and attempts < max_retries:
             attempts += 1
-            logging.warning(f"🔁 Reintentando porque la respuesta no es JSON válido: {err}")
+            logging.warning(f"🔁 Reintentando con el LLM: respuesta sin JSON válido (ni tras reparación local) o fuera de esquema: {err}")
+            registrar_reintento_json()
 
             fix_messages = [
                 SystemMessage(content=system_msg),
@@ -148,17 +95,19 @@ def evaluar_coherencia_visual_vs_ficha(
                     {
                         "type": "text",
                         "text": (
-                            "La respuesta anterior NO fue JSON válido. Corrige y devuelve SOLO un JSON válido. "
+                            "La respuesta anterior NO fue JSON válido o no cumple la estructura pedida. "
+                            "Corrige y devuelve SOLO un JSON válido. "
                             "RECUERDA: no incluyas texto adicional ni formato Markdown; solo el objeto JSON."
                         ),
                     },
+                    {"type": "text", "text": f"Problema detectado: {err}"},
                     {"type": "text", "text": f"Respuesta previa (para corregir):\n{raw}"},
                 ])
             ]
 
-            respuesta = llm.invoke(fix_messages)
+            respuesta = invocar_estructurado(llm, fix_messages, etapa="precision")
             raw = respuesta.content if hasattr(respuesta, "content") else str(respuesta)
-            parsed, err = _extract_json(raw)
+            parsed, err = extraer_json(raw)
 
             if parsed is not None and schema_validator:
                 try:
@@ -170,11 +119,14 @@ def evaluar_coherencia_visual_vs_ficha(
         # 7. Manejo de fallo definitivo
         if parsed is None:
             logging.error(f"❌ No se pudo obtener JSON válido del LLM: {err}")
+            registrar_fallo_parseo()
             return {"error": f"No se pudo parsear JSON: {str(err)}", "raw": raw}
 
         # ✅ Devuelve el dict JSON directamente
         return parsed
 
+    except CasoCancelado:
+        raise
     except Exception as e:
         logging.error(f"❌ Error al evaluar coherencia visual vs ficha: {e}", exc_info=True)
         return {"error": str(e)}
@@ -1,24 +1,42 @@
+import re
 import mimetypes
+import unicodedata
 import logging
+import contextvars
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 
-from app.commons.services.miscelaneous import load_prompts_generales
-from langchain_core.messages import SystemMessage, HumanMessage
+from app.commons.services.prompt_registry import obtener_prompt
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.audio_preprocess import (
+    preprocesar_audio,
+    config_audio,
+    duracion_contenedor,
+    analizar_silencios,
+    planear_segmentos,
+    extraer_segmento,
+)
+from app.commons.services.context_cache import mensajes_con_prefijo
+from app.commons.services.cancelacion import CasoCancelado
 
 
-def transcribir_audio_gemini(ruta_audio: str, llm) -> str:
+def transcribir_audio_gemini(ruta_audio: str, llm, preprocesar: Optional[bool] = None) -> str:
     """
     Transcribe un archivo de audio usando Gemini multimodal con prompt cargado desde YAML.
 
     Args:
         ruta_audio: Ruta local del archivo de audio.
         llm: Objeto LLM ya inicializado (ej. Gemini Pro)
+        preprocesar: Reduce el audio (mono, voz, sin silencios largos, Opus) antes
+            de enviarlo. None = según `audio_preprocess.habilitado` en la config.
 
     Returns:
         Texto transcrito como string limpio.
     """
     try:
-        system_prompt = load_prompts_generales("transcription_audio")
+        system_prompt = obtener_prompt("transcription_audio")
         if not system_prompt:
             raise ValueError("❌ Prompt 'transcripcion_audio' no encontrado en YAML.")
 
@@ -27,17 +45,38 @@ def transcribir_audio_gemini(ruta_audio: str, llm) -> str:
         if not mime_type:
             raise ValueError("No se pudo determinar el tipo MIME del archivo de audio.")
 
-        with open(ruta_audio, "rb") as f:
-            audio_content = f.read()
+        # Audios largos: transcripción literal por tramos en paralelo + análisis sobre el texto
+        cfg_seg = load_pipeline_parameters("audio_segmentado")
+        if cfg_seg.get("habilitado", False):
+            umbral_duracion = float(cfg_seg.get("umbral_duracion_s", 300))
+            # La cabecera basta para descartar audios cortos; silencedetect decodifica el audio completo
+            estimada = duracion_contenedor(ruta_audio)
+            if estimada is None or estimada > umbral_duracion:
+                duracion, silencios = analizar_silencios(
+                    ruta_audio,
+                    float(cfg_seg.get("umbral_silencio_db", -35)),
+                    float(cfg_seg.get("silencio_min_s", 0.5)),
+                )
+                if duracion and duracion > umbral_duracion:
+                    transcripcion = transcribir_audio_por_segmentos(ruta_audio, llm, duracion, silencios, cfg_seg)
+                    return _analizar_transcripcion(system_prompt, transcripcion, llm)
+
+        if preprocesar is None:
+            preprocesar = bool(config_audio().get("habilitado", False))
+
+        reducido = preprocesar_audio(ruta_audio) if preprocesar else None
+        if reducido is not None:
+            audio_content, mime_type = reducido.data, reducido.mime_type
+        else:
+            with open(ruta_audio, "rb") as f:
+                audio_content = f.read()
 
         # 3. Estructurar mensaje multimodal
-        messages_for_llm: list[SystemMessage | HumanMessage] = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=[
-                {"type": "text", "text": "Procesa el siguiente audio según las instrucciones del sistema:"},
-                {"type": "media", "data": audio_content, "mime_type": mime_type}
-            ])
-        ]
+        messages_for_llm = mensajes_con_prefijo(
+            system_prompt,
+            ["Procesa el siguiente audio según las instrucciones del sistema:"],
+            [{"type": "media", "data": audio_content, "mime_type": mime_type}],
+        )
 
         logging.info(f"🎙️ Enviando audio '{ruta_audio}' a Gemini para transcripción...")
 
@@ -48,6 +87,132 @@ def transcribir_audio_gemini(ruta_audio: str, llm) -> str:
         # 5. Extraer texto entre <TRANSCRIPCION>...</TRANSCRIPCION>
         return xml_response
 
+    except CasoCancelado:
+        raise  # no devolver "" como transcripción: el scheduler la registra como cancelación
     except Exception as e:
         logging.error(f"❌ Error durante la transcripción con Gemini: {e}")
         return ""
+
+
+# ============================================================
+# TRANSCRIPCIÓN POR SEGMENTOS (audios largos)
+# ============================================================
+_RE_PALABRA = re.compile(r"\w+", re.UNICODE)
+
+
+def _normalizar_palabra(p: str) -> str:
+    # minúsculas, sin tildes ni puntuación: "Detrás," == "detras"
+    p = unicodedata.normalize("NFKD", p.lower()).encode("ascii", "ignore").decode("ascii")
+    m = _RE_PALABRA.search(p)
+    return m.group(0) if m else p
+
+
+def _unir_transcripciones(textos: List[str], ventana_palabras: int = 80, min_coincidencia: int = 3) -> str:
+    """
+    Une transcripciones consecutivas que comparten un tramo solapado de audio.
+    Busca el bloque común más largo entre la cola del texto acumulado y la
+    cabeza del siguiente, y continúa justo después de él para no duplicar texto.
+    """
+    palabras: List[str] = []
+    for texto in textos:
+        nuevas = texto.split()
+        if not nuevas:
+            continue
+        if not palabras:
+            palabras = nuevas
+            continue
+
+        cola = palabras[-ventana_palabras:]
+        cabeza = nuevas[:ventana_palabras]
+        matcher = SequenceMatcher(
+            None,
+            [_normalizar_palabra(p) for p in cola],
+            [_normalizar_palabra(p) for p in cabeza],
+            autojunk=False,
+        )
+        bloque = matcher.find_longest_match(0, len(cola), 0, len(cabeza))
+        if bloque.size >= min_coincidencia:
+            corte_cola = len(palabras) - len(cola) + bloque.a + bloque.size
+            palabras = palabras[:corte_cola] + nuevas[bloque.b + bloque.size:]
+        else:
+            palabras += nuevas
+    return " ".join(palabras)
+
+
+def transcribir_audio_por_segmentos(
+        ruta_audio: str,
+        llm,
+        duracion: float,
+        silencios: List[Tuple[float, float]],
+        cfg: Dict[str, Any],
+) -> str:
+    """
+    Corta el audio en silencios (tramos solapados), transcribe los tramos en
+    paralelo con concurrencia acotada y une el texto en orden quitando el
+    contenido duplicado del solape.
+    """
+    prompt_segmento = obtener_prompt("transcripcion_segmento_audio")
+    if not prompt_segmento:
+        raise ValueError("❌ Prompt 'transcripcion_segmento_audio' no encontrado en YAML.")
+
+    segmentos = planear_segmentos(
+        duracion,
+        silencios,
+        objetivo_s=float(cfg.get("segmento_objetivo_s", 120)),
+        max_s=float(cfg.get("segmento_max_s", 180)),
+        solape_s=float(cfg.get("solape_s", 4)),
+    )
+    logging.info(f"✂️ Audio de {duracion:.0f}s dividido en {len(segmentos)} segmento(s) para transcripción paralela")
+
+    reintentos = max(0, int(cfg.get("reintentos_segmento", 1)))
+
+    def _transcribir_tramo(inicio: float, fin: float) -> str:
+        data, mime = extraer_segmento(ruta_audio, inicio, fin)
+        respuesta = llm.invoke(mensajes_con_prefijo(
+            prompt_segmento,
+            ["Transcribe literalmente el siguiente fragmento de audio:"],
+            [{"type": "media", "data": data, "mime_type": mime}],
+        ))
+        texto = respuesta.content if hasattr(respuesta, "content") else str(respuesta)
+        return texto.strip() if isinstance(texto, str) else str(texto)
+
+    def _transcribir(tramo: Tuple[float, float]) -> str:
+        inicio, fin = tramo
+        intento = 0
+        while True:
+            try:
+                return _transcribir_tramo(inicio, fin)
+            except CasoCancelado:
+                raise
+            except Exception as e:
+                intento += 1
+                if intento > reintentos:
+                    # Un hueco en medio del testimonio no se puede unir: falla la transcripción entera
+                    raise RuntimeError(
+                        f"Tramo {inicio:.1f}-{fin:.1f}s sin transcripción tras {intento} intento(s): {e}"
+                    ) from e
+                logging.warning(f"⚠️ Tramo {inicio:.1f}-{fin:.1f}s falló ({e}); reintento {intento}/{reintentos}")
+
+    with ThreadPoolExecutor(max_workers=max(1, int(cfg.get("max_paralelo", 4))),
+                            thread_name_prefix="segmento_audio") as pool:
+        # Cada tramo hereda los contextvars de la etapa (métricas por etapa)
+        futuros = [pool.submit(contextvars.copy_context().run, _transcribir, t) for t in segmentos]
+        try:
+            textos = [f.result() for f in futuros]  # en el orden de los tramos
+        except BaseException:
+            for f in futuros:
+                f.cancel()  # los tramos que aún no arrancaron ya no sirven
+            raise
+
+    return _unir_transcripciones(textos)
+
+
+def _analizar_transcripcion(system_prompt: str, transcripcion: str, llm) -> str:
+    """Aplica el prompt de análisis del testimonio sobre la transcripción ya unida."""
+    logging.info(f"🧾 Analizando transcripción unida ({len(transcripcion.split())} palabras)...")
+    response_obj = llm.invoke(mensajes_con_prefijo(
+        system_prompt,
+        ["Procesa el siguiente testimonio transcrito según las instrucciones del sistema:"],
+        [{"type": "text", "text": transcripcion}],
+    ))
+    return response_obj.content if hasattr(response_obj, "content") else str(response_obj)
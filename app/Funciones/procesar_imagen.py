@@ -2,12 +2,18 @@ import os
 import json
 import logging
 import mimetypes
-from typing import List, Dict, Tuple, Any
+from typing import List, Dict, Any
 
 import fitz  # PyMuPDF
-from langchain_core.messages import SystemMessage, HumanMessage
 
-from app.commons.services.miscelaneous import load_prompts_generales
+from app.commons.services.prompt_registry import obtener_prompt
+from app.commons.services.pdf_render import paginas_pdf
+from app.commons.services.image_budget import aplicar_presupuesto
+from app.commons.services.context_cache import mensajes_con_prefijo
+from app.commons.services.json_respuesta import extraer_json, quitar_fences
+from app.commons.services.esquemas_etapas import ErrorEsquema, invocar_estructurado, validar_salida
+from app.commons.services.metrics import registrar_fallo_parseo
+from app.commons.services.cancelacion import CasoCancelado
 
 # =========================
 # Config básica de logging
@@ -19,62 +25,6 @@ logging.basicConfig(
 )
 
 
-# =========================
-# Utilidades JSON / Normalización
-# =========================
-def _clean_markdown_fences(texto: str) -> str:
-    """
-    Elimina fences de Markdown (```json ... ``` o ``` ... ```) si el modelo los incluyó.
-    """
-    if not isinstance(texto, str):
-        return str(texto)
-    t = texto.strip()
-    if t.startswith("```json"):
-        t = t.removeprefix("```json").strip()
-        if t.endswith("```"):
-            t = t.removesuffix("```").strip()
-        return t
-    if t.startswith("```"):
-        t = t.removeprefix("```").strip()
-        if t.endswith("```"):
-            t = t.removesuffix("```").strip()
-        return t
-    return t
-
-
-def _normalize_schema(d: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Acepta variantes de clave del modelo y las mapea al contrato esperado.
-    Para tu prompt actual, el contrato usa 'inferencias_tecnicas'.
-    """
-    # Si viniera de versiones previas con 'inferencias_preliminares', mapea -> inferencias_tecnicas
-    if "inferencias_preliminares" in d and "inferencias_tecnicas" not in d:
-        d["inferencias_tecnicas"] = d.pop("inferencias_preliminares")
-
-    # También aceptamos 'observaciones' -> 'observaciones_objetivas' si alguna iteración del prompt lo cambió
-    if "observaciones" in d and "observaciones_objetivas" not in d:
-        d["observaciones_objetivas"] = d.pop("observaciones")
-
-    return d
-
-
-def _validate_schema(d: Dict[str, Any]) -> Tuple[bool, str]:
-    """
-    Valida presencia de claves esenciales del contrato.
-    (No confundir con JSON malformado: esto es esquema inesperado.)
-    """
-    required = [
-        "metadata_analisis",
-        "observaciones_objetivas",
-        "inferencias_tecnicas",
-        "limitaciones_y_incertidumbres",
-    ]
-    missing = [k for k in required if k not in d]
-    if missing:
-        return False, f"Faltan claves esperadas: {', '.join(missing)}"
-    return True, ""
-
-
 # =========================
 # Conversión de PDF a JPG
 # =========================
@@ -82,6 +32,9 @@ def convertir_pdf_a_jpgs(pdf_path: str, dpi: int = 150) -> List[str]:
     """
     Convierte todas las páginas de un PDF a imágenes JPG usando PyMuPDF.
     Devuelve una lista de rutas de salida.
+
+    Legado: el pipeline usa `pdf_render.paginas_pdf`, que renderiza en memoria.
+    Quien use esta función es responsable de borrar los JPG generados.
     """
     rutas: List[str] = []
     if not os.path.isfile(pdf_path):
@@ -139,45 +92,39 @@ def procesar_imagen(ruta_archivo: str, llm) -> Dict[str, Any]:
         if not os.path.isfile(ruta_archivo):
             return {"error": f"Ruta no válida o archivo no existe: {ruta_archivo}"}
 
-        prompt = load_prompts_generales("extraction_visual")
+        prompt = obtener_prompt("extraction_visual")
         if not prompt:
             raise ValueError("❌ Prompt 'extraction_visual' no encontrado en YAML.")
 
-        # Convertir si es PDF
+        # Construir bloques multimedia (PDF → páginas renderizadas en memoria)
+        media_blocks: List[Dict[str, Any]] = []
         if ruta_archivo.lower().endswith(".pdf"):
-            logging.info(f"📄 Convirtiendo PDF '{ruta_archivo}' a imágenes JPG con PyMuPDF...")
-            rutas_imagenes = convertir_pdf_a_jpgs(ruta_archivo, dpi=150)
-            if not rutas_imagenes:
+            logging.info(f"📄 Renderizando PDF '{ruta_archivo}' en memoria con PyMuPDF...")
+            with paginas_pdf(ruta_archivo) as paginas:
+                media_blocks = [p.como_media_block() for p in paginas]
+            if not media_blocks:
                 return {"error": "No se generaron imágenes a partir del PDF."}
         else:
-            rutas_imagenes = [ruta_archivo]
-
-        # Construir bloques multimedia
-        media_blocks: List[Dict[str, Any]] = []
-        for ruta_img in rutas_imagenes:
-            mime_type = _guess_mime(ruta_img)
             try:
-                with open(ruta_img, "rb") as f:
+                with open(ruta_archivo, "rb") as f:
                     data = f.read()
             except Exception as e:
-                logging.error(f"❌ No se pudo leer '{ruta_img}': {e}")
-                return {"error": f"No se pudo leer la imagen: {ruta_img}", "detalle": str(e)}
+                logging.error(f"❌ No se pudo leer '{ruta_archivo}': {e}")
+                return {"error": f"No se pudo leer la imagen: {ruta_archivo}", "detalle": str(e)}
+            media_blocks.append({"type": "media", "data": data, "mime_type": _guess_mime(ruta_archivo)})
 
-            media_blocks.append({
-                "type": "media",
-                "data": data,
-                "mime_type": mime_type
-            })
+        # Presupuesto: sin páginas casi duplicadas, redimensionado y re-codificado
+        media_blocks, _ = aplicar_presupuesto(media_blocks, etapa="visual")
 
         # Construir mensajes para LLM
-        messages_for_llm = [
-            SystemMessage(content=prompt),
-            HumanMessage(content=[{"type": "text",
-                                   "text": "Analiza todas las imágenes siguientes según el formato establecido:"}] + media_blocks)
-        ]
+        messages_for_llm = mensajes_con_prefijo(
+            prompt,
+            ["Analiza todas las imágenes siguientes según el formato establecido:"],
+            media_blocks,
+        )
 
         logging.info("🧠 Enviando imágenes al LLM para análisis visual consolidado...")
-        respuesta = llm.invoke(messages_for_llm)
+        respuesta = invocar_estructurado(llm, messages_for_llm, etapa="visual")
 
         # Extraer texto devolviendo siempre str
         texto = getattr(respuesta, "content", None)
@@ -185,16 +132,16 @@ def procesar_imagen(ruta_archivo: str, llm) -> Dict[str, Any]:
             texto = str(respuesta)
 
         # Limpieza de fences
-        texto = _clean_markdown_fences(texto)
+        texto = quitar_fences(texto)
 
-        # Parseo JSON
-        try:
-            json_resultado = json.loads(texto)
-        except json.JSONDecodeError as e:
+        # Parseo JSON (con escaneo y reparación local)
+        json_resultado, e = extraer_json(texto)
+        if json_resultado is None:
             lines = texto.splitlines()
             line_number = getattr(e, "lineno", -1)
             col_number = getattr(e, "colno", -1)
             error_line = lines[line_number - 1] if 0 < line_number <= len(lines) else "<línea no encontrada>"
+            registrar_fallo_parseo()
 
             logging.warning(
                 f"⚠️ JSON MALFORMADO en línea {line_number}, columna {col_number}: {e}\n"
@@ -208,10 +155,11 @@ def procesar_imagen(ruta_archivo: str, llm) -> Dict[str, Any]:
                 "raw_response": texto
             }
 
-        # Normalización de esquema y validación
-        json_resultado = _normalize_schema(json_resultado)
-        ok, msg = _validate_schema(json_resultado)
-        if not ok:
+        # Normalización y validación contra el esquema de la etapa
+        try:
+            json_resultado = validar_salida("visual", json_resultado)
+        except ErrorEsquema as err_esquema:
+            msg = str(err_esquema)
             logging.warning(
                 f"⚠️ Esquema inesperado: {msg}\n🔍 JSON recibido (truncado): {json.dumps(json_resultado, ensure_ascii=False)[:2000]}...")
             return {
@@ -227,6 +175,8 @@ def procesar_imagen(ruta_archivo: str, llm) -> Dict[str, Any]:
             "resultado": json_resultado
         }
 
+    except CasoCancelado:
+        raise
     except Exception as e:
         logging.error(f"❌ Error en procesar_imagen: {e}")
         return {"error": str(e)}
@@ -239,7 +189,6 @@ def procesar_imagen_ficha(ruta_archivo: str, llm) -> Dict[str, Any]:
     """
     import os, json, logging
     from typing import Dict, Any, List
-    from langchain_core.messages import SystemMessage, HumanMessage
 
     try:
         # Validar archivo
@@ -247,49 +196,54 @@ def procesar_imagen_ficha(ruta_archivo: str, llm) -> Dict[str, Any]:
             return {"error": f"Ruta no válida o archivo no existe: {ruta_archivo}"}
 
         # Cargar prompt
-        prompt = load_prompts_generales("extraction_visual_Ficha")
+        prompt = obtener_prompt("extraction_visual_Ficha")
         if not prompt:
             raise ValueError("❌ Prompt 'extraction_visual_Ficha' no encontrado en YAML.")
 
-        # Si es PDF → convertir a JPG
+        # Si es PDF → páginas en memoria; si no, la imagen tal cual
         if ruta_archivo.lower().endswith(".pdf"):
-            rutas_imagenes = convertir_pdf_a_jpgs(ruta_archivo, dpi=150)
-            if not rutas_imagenes:
+            with paginas_pdf(ruta_archivo) as paginas:
+                media_blocks = [p.como_media_block() for p in paginas]
+            if not media_blocks:
                 return {"error": "No se generaron imágenes a partir del PDF."}
         else:
-            rutas_imagenes = [ruta_archivo]
-
-        # Construir bloques multimedia
-        media_blocks: List[Dict[str, Any]] = []
-        for ruta_img in rutas_imagenes:
-            mime_type = _guess_mime(ruta_img)
-            with open(ruta_img, "rb") as f:
+            with open(ruta_archivo, "rb") as f:
                 data = f.read()
-            media_blocks.append({"type": "media", "data": data, "mime_type": mime_type})
+            media_blocks = [{"type": "media", "data": data, "mime_type": _guess_mime(ruta_archivo)}]
+
+        media_blocks, _ = aplicar_presupuesto(media_blocks, etapa="ficha")
 
         # Preparar mensajes
-        messages_for_llm = [
-            SystemMessage(content=prompt),
-            HumanMessage(content=[{"type": "text", "text": "Extrae exactamente el JSON solicitado:"}] + media_blocks)
-        ]
+        messages_for_llm = mensajes_con_prefijo(
+            prompt, ["Extrae exactamente el JSON solicitado:"], media_blocks
+        )
 
         # Llamar al modelo
-        respuesta = llm.invoke(messages_for_llm)
+        respuesta = invocar_estructurado(llm, messages_for_llm, etapa="ficha")
         texto = getattr(respuesta, "content", None)
         if texto is None:
             texto = str(respuesta)
 
-        # Limpiar fences markdown
-        texto = _clean_markdown_fences(texto)
-
-        # Parsear y devolver directamente el JSON
-        return json.loads(texto)
+        # Parsear (sin fences, con reparación local), validar y devolver el JSON normalizado
+        resultado, err = extraer_json(texto)
+        if resultado is None:
+            registrar_fallo_parseo()
+            return {
+                "error": "Respuesta no es JSON válido (mal formado)",
+                "detalle": str(err),
+            }
+        try:
+            return validar_salida("ficha", resultado)
+        except ErrorEsquema as err_esquema:
+            logging.warning(f"⚠️ Ficha con esquema inesperado: {err_esquema}")
+            return {
+                "error": "Respuesta JSON válida pero con esquema inesperado",
+                "schema_issue": str(err_esquema),
+                "raw_response": resultado,
+            }
 
-    except json.JSONDecodeError as e:
-        return {
-            "error": "Respuesta no es JSON válido (mal formado)",
-            "detalle": str(e),
-        }
+    except CasoCancelado:
+        raise
     except Exception as e:
         logging.error(f"❌ Error en procesar_imagen_ficha: {e}")
         return {"error": str(e)}
@@ -0,0 +1,310 @@
+import os
+import re
+import wave
+import shutil
+import logging
+import tempfile
+import subprocess
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.cancelacion import CANCELACION_ACTUAL, verificar_cancelacion
+
+# Códec de salida -> (argumentos ffmpeg, formato contenedor, extensión, MIME)
+_CODECS: Dict[str, tuple] = {
+    "opus": (["-c:a", "libopus", "-application", "voip"], "ogg", ".ogg", "audio/ogg"),
+    "mp3": (["-c:a", "libmp3lame"], "mp3", ".mp3", "audio/mpeg"),
+    "flac": (["-c:a", "flac"], "flac", ".flac", "audio/flac"),
+}
+
+_RE_TIME = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+_RE_DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@dataclass
+class AudioPreprocesado:
+    data: bytes
+    mime_type: str
+    bytes_originales: int
+    bytes_finales: int
+    duracion_original: Optional[float]
+    duracion_final: Optional[float]
+
+    def resumen(self) -> Dict[str, Any]:
+        return {
+            "bytes_originales": self.bytes_originales,
+            "bytes_finales": self.bytes_finales,
+            "duracion_original_s": self.duracion_original,
+            "duracion_final_s": self.duracion_final,
+        }
+
+
+def config_audio() -> Dict[str, Any]:
+    return load_pipeline_parameters("audio_preprocess")
+
+
+def ffmpeg_bin() -> Optional[str]:
+    """Ruta al ejecutable de ffmpeg (env `FFMPEG_BIN` o el del PATH)."""
+    candidato = os.environ.get("FFMPEG_BIN") or "ffmpeg"
+    return shutil.which(candidato) or (candidato if os.path.isfile(candidato) else None)
+
+
+def ffprobe_bin() -> Optional[str]:
+    """Ruta a ffprobe (env `FFPROBE_BIN`, junto a ffmpeg o el del PATH)."""
+    candidato = os.environ.get("FFPROBE_BIN")
+    if not candidato:
+        ffmpeg = ffmpeg_bin()
+        junto = os.path.join(os.path.dirname(ffmpeg), "ffprobe") if ffmpeg and os.path.dirname(ffmpeg) else None
+        candidato = junto if junto and os.path.isfile(junto) else "ffprobe"
+    return shutil.which(candidato) or (candidato if os.path.isfile(candidato) else None)
+
+
+def _timeout_subproceso() -> Optional[float]:
+    """Tope `timeout_ffmpeg_s` de la config, recortado a lo que le queda al plazo del caso/etapa."""
+    tope = float(config_audio().get("timeout_ffmpeg_s") or 0) or None
+    cancelacion = CANCELACION_ACTUAL.get()
+    restante = cancelacion.restante() if cancelacion is not None else None
+    limites = [t for t in (tope, restante) if t is not None]
+    return min(limites) if limites else None
+
+
+def _ejecutar(cmd: List[str], text: bool = True) -> subprocess.CompletedProcess:
+    """
+    `subprocess.run` acotado en tiempo. Si ffmpeg/ffprobe se pasa del plazo del
+    caso lanza `CasoCancelado` (por plazo); si se pasa del tope de la config,
+    `RuntimeError` (error de la etapa).
+    """
+    verificar_cancelacion()
+    timeout = _timeout_subproceso()
+    try:
+        return subprocess.run(cmd, capture_output=True, text=text, timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        verificar_cancelacion()
+        raise RuntimeError(f"{os.path.basename(cmd[0])} superó el tiempo máximo de {timeout:g}s") from e
+
+
+def _a_segundos(h: str, m: str, s: str) -> float:
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def duracion_audio(ruta: str) -> Optional[float]:
+    """Duración real decodificando con ffmpeg (sin depender de ffprobe)."""
+    ffmpeg = ffmpeg_bin()
+    if not ffmpeg:
+        return None
+    proc = _ejecutar([ffmpeg, "-hide_banner", "-nostdin", "-i", ruta, "-f", "null", "-"])
+    tiempos = _RE_TIME.findall(proc.stderr)
+    if tiempos:
+        return round(_a_segundos(*tiempos[-1]), 2)
+    dur = _RE_DURATION.search(proc.stderr)
+    return round(_a_segundos(*dur.groups()), 2) if dur else None
+
+
+def duracion_contenedor(ruta: str) -> Optional[float]:
+    """
+    Duración declarada en la cabecera, sin decodificar el audio: WAV con la
+    librería estándar; el resto con ffprobe o, si no está, `ffmpeg -i` sin
+    salida. Es aproximada en formatos sin índice (p. ej. MP3 VBR): sirve para
+    decidir si vale la pena analizar el audio, no como duración exacta.
+    """
+    if ruta.lower().endswith(".wav"):
+        try:
+            with wave.open(ruta, "rb") as w:
+                return round(w.getnframes() / float(w.getframerate()), 2)
+        except (wave.Error, EOFError, OSError, ZeroDivisionError):
+            pass  # WAV no PCM o cabecera rara: se pregunta a ffprobe/ffmpeg
+
+    ffprobe = ffprobe_bin()
+    if ffprobe:
+        proc = _ejecutar(
+            [ffprobe, "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", ruta]
+        )
+        try:
+            return round(float(proc.stdout.strip()), 2)
+        except ValueError:
+            pass
+
+    ffmpeg = ffmpeg_bin()
+    if not ffmpeg:
+        return None
+    # Sin salida ffmpeg termina con error tras leer la cabecera, que ya trae "Duration:"
+    proc = _ejecutar([ffmpeg, "-hide_banner", "-nostdin", "-i", ruta])
+    dur = _RE_DURATION.search(proc.stderr)
+    return round(_a_segundos(*dur.groups()), 2) if dur else None
+
+
+def _filtro_silencios(umbral_db: float, silencio_min_s: float, pausa_conservada_s: float) -> str:
+    # Recorta el silencio inicial y compacta cualquier silencio (interno o final)
+    # más largo que `silencio_min_s`, dejando una pausa corta de `pausa_conservada_s`.
+    return (
+        "silenceremove="
+        f"start_periods=1:start_threshold={umbral_db}dB:start_silence=0.2:"
+        f"stop_periods=-1:stop_threshold={umbral_db}dB:stop_duration={silencio_min_s}:"
+        f"stop_silence={pausa_conservada_s}"
+    )
+
+
+def preprocesar_audio(ruta_audio: str, **overrides) -> Optional[AudioPreprocesado]:
+    """
+    Reduce el audio antes de enviarlo al LLM: mono, frecuencia de voz,
+    sin silencios largos y re-codificado a un códec compacto (por defecto Opus).
+
+    Devuelve None si ffmpeg no está disponible, si falla la conversión o si el
+    resultado no es más pequeño que el original; el llamador debe enviar el
+    audio original en ese caso.
+    Si ffmpeg se pasa de tiempo no hay fallback: ver `_ejecutar`.
+    """
+    cfg = {**config_audio(), **overrides}
+    ffmpeg = ffmpeg_bin()
+    if not ffmpeg:
+        logging.warning("⚠️ ffmpeg no disponible; se envía el audio sin preprocesar.")
+        return None
+
+    bytes_originales = os.path.getsize(ruta_audio)
+    if bytes_originales < int(float(cfg.get("min_kb", 256)) * 1024):
+        return None
+
+    codec = str(cfg.get("codec", "opus")).lower()
+    args_codec, formato, ext, mime = _CODECS[codec]
+
+    filtros: List[str] = []
+    if cfg.get("recortar_silencios", True):
+        filtros.append(_filtro_silencios(
+            float(cfg.get("umbral_silencio_db", -40)),
+            float(cfg.get("silencio_min_s", 1.0)),
+            float(cfg.get("pausa_conservada_s", 0.4)),
+        ))
+
+    fd, salida = tempfile.mkstemp(suffix=ext)
+    os.close(fd)
+    try:
+        cmd = [
+            ffmpeg, "-hide_banner", "-nostdin", "-y", "-i", ruta_audio,
+            "-vn", "-ac", "1", "-ar", str(int(cfg.get("sample_rate", 16000))),
+        ]
+        if filtros:
+            cmd += ["-af", ",".join(filtros)]
+        cmd += args_codec
+        if codec != "flac":
+            cmd += ["-b:a", str(cfg.get("bitrate", "24k"))]
+        if codec == "opus":
+            # Nivel 3 ≈ 6x más rápido que el 10 por defecto con tamaño casi igual en voz
+            cmd += ["-compression_level", str(int(cfg.get("compression_level", 3)))]
+        cmd += ["-f", formato, salida]
+
+        proc = _ejecutar(cmd)
+        if proc.returncode != 0:
+            logging.warning(f"⚠️ ffmpeg falló preprocesando '{ruta_audio}': {proc.stderr[-500:]}")
+            return None
+
+        dur_original = _RE_DURATION.search(proc.stderr)
+        with open(salida, "rb") as f:
+            data = f.read()
+
+        resultado = AudioPreprocesado(
+            data=data,
+            mime_type=mime,
+            bytes_originales=bytes_originales,
+            bytes_finales=len(data),
+            duracion_original=round(_a_segundos(*dur_original.groups()), 2) if dur_original else None,
+            duracion_final=duracion_audio(salida),
+        )
+    finally:
+        try:
+            os.remove(salida)
+        except OSError:
+            pass
+
+    if resultado.bytes_finales >= bytes_originales:
+        logging.info("🎚️ El preprocesado no reduce el audio; se envía el original.")
+        return None
+
+    logging.info(
+        f"🎚️ Audio preprocesado: {bytes_originales / 1024:.0f} KB → {resultado.bytes_finales / 1024:.0f} KB, "
+        f"{resultado.duracion_original}s → {resultado.duracion_final}s"
+    )
+    return resultado
+
+
+# ============================================================
+# SEGMENTACIÓN EN SILENCIOS (transcripción por tramos)
+# ============================================================
+_RE_SIL_INICIO = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_RE_SIL_FIN = re.compile(r"silence_end: (-?\d+(?:\.\d+)?)")
+
+
+def analizar_silencios(
+        ruta_audio: str,
+        umbral_db: float = -35,
+        silencio_min_s: float = 0.5,
+) -> Tuple[Optional[float], List[Tuple[float, float]]]:
+    """
+    Una sola pasada de ffmpeg `silencedetect`: devuelve (duración, [(inicio, fin), ...])
+    de los silencios de al menos `silencio_min_s`.
+    """
+    ffmpeg = ffmpeg_bin()
+    if not ffmpeg:
+        return None, []
+    proc = _ejecutar(
+        [ffmpeg, "-hide_banner", "-nostdin", "-i", ruta_audio, "-vn", "-ac", "1",
+         "-af", f"silencedetect=noise={umbral_db}dB:d={silencio_min_s}", "-f", "null", "-"]
+    )
+    tiempos = _RE_TIME.findall(proc.stderr)
+    duracion = round(_a_segundos(*tiempos[-1]), 2) if tiempos else None
+    inicios = [float(x) for x in _RE_SIL_INICIO.findall(proc.stderr)]
+    fines = [float(x) for x in _RE_SIL_FIN.findall(proc.stderr)]
+    if duracion is not None and len(inicios) > len(fines):
+        fines.append(duracion)  # silencio que llega hasta el final
+    return duracion, [(max(0.0, i), f) for i, f in zip(inicios, fines)]
+
+
+def planear_segmentos(
+        duracion: float,
+        silencios: List[Tuple[float, float]],
+        objetivo_s: float,
+        max_s: float,
+        solape_s: float,
+) -> List[Tuple[float, float]]:
+    """
+    Corta el audio en tramos de ~`objetivo_s` (nunca más de `max_s`) usando
+    como punto de corte el centro del silencio más cercano al objetivo. Cada
+    tramo (salvo el primero) empieza `solape_s` antes del corte para que las
+    palabras en la frontera aparezcan en ambos tramos.
+    """
+    centros = sorted((i + f) / 2 for i, f in silencios)
+    cortes: List[float] = []
+    inicio = 0.0
+    while duracion - inicio > max_s:
+        minimo, objetivo, maximo = inicio + objetivo_s * 0.6, inicio + objetivo_s, inicio + max_s
+        en_rango = [c for c in centros if minimo <= c <= maximo]
+        corte = min(en_rango, key=lambda c: abs(c - objetivo)) if en_rango else maximo
+        cortes.append(corte)
+        inicio = corte
+
+    limites = [0.0] + cortes + [duracion]
+    return [
+        (max(0.0, limites[k] - (solape_s if k else 0.0)), limites[k + 1])
+        for k in range(len(limites) - 1)
+    ]
+
+
+def extraer_segmento(ruta_audio: str, inicio: float, fin: float, **overrides) -> Tuple[bytes, str]:
+    """Extrae [inicio, fin) como Opus mono 16 kHz en memoria. Devuelve (bytes, mime)."""
+    cfg = {**config_audio(), **overrides}
+    ffmpeg = ffmpeg_bin()
+    if not ffmpeg:
+        raise RuntimeError("ffmpeg no disponible para segmentar el audio.")
+    proc = _ejecutar(
+        [ffmpeg, "-hide_banner", "-nostdin", "-loglevel", "error",
+         "-ss", f"{inicio:.3f}", "-i", ruta_audio, "-t", f"{fin - inicio:.3f}",
+         "-vn", "-ac", "1", "-ar", str(int(cfg.get("sample_rate", 16000))),
+         "-c:a", "libopus", "-application", "voip", "-b:a", str(cfg.get("bitrate", "24k")),
+         "-compression_level", str(int(cfg.get("compression_level", 3))),
+         "-f", "ogg", "pipe:1"],
+        text=False,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg falló extrayendo {inicio:.1f}-{fin:.1f}s: {proc.stderr[-300:]!r}")
+    return proc.stdout, "audio/ogg"
@@ -0,0 +1,105 @@
+import time
+import threading
+import contextvars
+from typing import Any, Dict, Optional
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+
+
+class CasoCancelado(Exception):
+    """El caso (o una etapa) se canceló: cliente desconectado o plazo excedido."""
+
+    def __init__(self, motivo: str, por_plazo: bool = False, detalle: Optional[Dict[str, Any]] = None):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.por_plazo = por_plazo
+        self.detalle = detalle or {}
+
+
+class Cancelacion:
+    """
+    Señal de cancelación cooperativa con plazo opcional. Una hija (p. ej. la de
+    una etapa) queda cancelada si se cancela ella, vence su plazo o se cancela
+    su padre (el caso). El código que hace trabajo caro (llamadas al LLM,
+    reintentos) consulta `verificar()` antes de gastar cuota.
+    """
+
+    def __init__(self, plazo_s: Optional[float] = None, padre: Optional["Cancelacion"] = None):
+        self.plazo_s = plazo_s
+        self.limite = time.monotonic() + plazo_s if plazo_s else None
+        self.padre = padre
+        self._evento = threading.Event()
+        self._motivo: Optional[str] = None
+
+    def hija(self, plazo_s: Optional[float] = None) -> "Cancelacion":
+        return Cancelacion(plazo_s, padre=self)
+
+    def cancelar(self, motivo: str = "cancelado"):
+        if not self._evento.is_set():
+            self._motivo = motivo
+            self._evento.set()
+
+    def estado(self) -> Optional[CasoCancelado]:
+        """None si sigue vigente; si no, la excepción que describe por qué."""
+        if self._evento.is_set():
+            return CasoCancelado(self._motivo or "cancelado")
+        if self.limite is not None and time.monotonic() >= self.limite:
+            return CasoCancelado(f"plazo de {self.plazo_s:g}s excedido", por_plazo=True)
+        return self.padre.estado() if self.padre is not None else None
+
+    def restante(self) -> Optional[float]:
+        """Segundos hasta el plazo más cercano (propio o de un ancestro); None si no hay plazo."""
+        propio = max(0.0, self.limite - time.monotonic()) if self.limite is not None else None
+        del_padre = self.padre.restante() if self.padre is not None else None
+        plazos = [r for r in (propio, del_padre) if r is not None]
+        return min(plazos) if plazos else None
+
+    @property
+    def cancelada(self) -> bool:
+        return self.estado() is not None
+
+    def verificar(self):
+        error = self.estado()
+        if error is not None:
+            raise error
+
+    def esperar(self, segundos: float):
+        """`time.sleep` que se interrumpe (con `CasoCancelado`) si se cancela o vence el plazo."""
+        fin = time.monotonic() + segundos
+        while True:
+            self.verificar()
+            restante = fin - time.monotonic()
+            if restante <= 0:
+                return
+            self._evento.wait(min(restante, 0.25))
+
+
+# Cancelación del caso/etapa que corre en el hilo actual (la propaga el scheduler)
+CANCELACION_ACTUAL: contextvars.ContextVar[Optional[Cancelacion]] = contextvars.ContextVar(
+    "cancelacion_actual", default=None
+)
+
+
+def verificar_cancelacion():
+    """Lanza `CasoCancelado` si el caso/etapa en curso fue cancelado; sin contexto no hace nada."""
+    cancelacion = CANCELACION_ACTUAL.get()
+    if cancelacion is not None:
+        cancelacion.verificar()
+
+
+def esperar_cancelable(segundos: float):
+    cancelacion = CANCELACION_ACTUAL.get()
+    if cancelacion is None:
+        time.sleep(segundos)
+    else:
+        cancelacion.esperar(segundos)
+
+
+def config_plazos() -> Dict[str, Any]:
+    return load_pipeline_parameters("plazos")
+
+
+def cancelacion_caso(padre: Optional[Cancelacion] = None) -> Cancelacion:
+    """Cancelación de un caso con el plazo `plazos.caso_s` (0/null = sin plazo)."""
+    plazo = config_plazos().get("caso_s") or None
+    return padre.hija(plazo) if padre is not None else Cancelacion(plazo)
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+NOMBRE_CHECKPOINT = ".checkpoint.json"
+
+
+def hash_archivo(ruta: str, bloque: int = 1024 * 1024) -> str:
+    """SHA-256 del contenido, leyendo en bloques."""
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        while True:
+            data = f.read(bloque)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def hash_texto(texto: str) -> str:
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def huella(*partes: str) -> str:
+    """Combina hashes/strings en una sola huella estable."""
+    return hashlib.sha256("\x1f".join(partes).encode("utf-8")).hexdigest()
+
+
+def es_resultado_error(resultado: Any) -> bool:
+    # Las fases devuelven {"error": ...} en vez de lanzar excepción; audio devuelve "" al fallar
+    if isinstance(resultado, str):
+        return not resultado.strip()
+    return isinstance(resultado, dict) and "error" in resultado
+
+
+class CheckpointCaso:
+    """
+    Checkpoint por etapa de un caso, guardado en `<out_case_dir>/.checkpoint.json`
+    como `{etapa: {"huella", "archivo", "guardado"}}`.
+
+    Una etapa se reutiliza solo si su huella coincide (hash de entradas, prompt
+    y dependencias) y su archivo de salida sigue existiendo.
+    """
+
+    def __init__(self, out_case_dir: Path):
+        self.out_case_dir = Path(out_case_dir)
+        self.ruta = self.out_case_dir / NOMBRE_CHECKPOINT
+        self._lock = threading.Lock()
+        try:
+            self._estado: Dict[str, Dict[str, Any]] = json.loads(self.ruta.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._estado = {}
+
+    def cargar(self, etapa: str, huella_etapa: str) -> Optional[Any]:
+        """Devuelve la salida guardada de la etapa, o None si no es reutilizable."""
+        entrada = self._estado.get(etapa)
+        if not entrada or entrada.get("huella") != huella_etapa:
+            return None
+        ruta = self.out_case_dir / entrada["archivo"]
+        try:
+            texto = ruta.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        if ruta.suffix == ".json":
+            try:
+                return json.loads(texto)
+            except json.JSONDecodeError:
+                return None
+        return texto
+
+    def registrar(self, etapa: str, huella_etapa: str, archivo: str):
+        """Marca la etapa como completada; se llama después de escribir su salida."""
+        with self._lock:
+            self._estado[etapa] = {"huella": huella_etapa, "archivo": archivo, "guardado": time.time()}
+            self._persistir()
+
+    def invalidar(self, etapas: Iterable[str]):
+        with self._lock:
+            for etapa in etapas:
+                self._estado.pop(etapa, None)
+            self._persistir()
+
+    def _persistir(self):
+        # Escritura atómica: un corte a mitad nunca deja un checkpoint corrupto
+        tmp = self.ruta.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._estado, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.ruta)
+        logging.debug(f"💾 Checkpoint actualizado: {self.ruta}")
@@ -0,0 +1,248 @@
+import time
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.rate_limiter import estimar_tokens
+from app.commons.services.stage_scheduler import ETAPA_ACTUAL
+
+# Marca en un bloque de texto: forma parte del prefijo estable del mensaje
+MARCA_PREFIJO = "prefijo_estable"
+
+
+# ============================================================
+# LAYOUT: prefijo estable (idéntico byte a byte) + parte variable
+# ============================================================
+def bloque_estable(texto: str) -> Dict[str, Any]:
+    return {"type": "text", "text": texto, MARCA_PREFIJO: True}
+
+
+def mensajes_con_prefijo(sistema: str, estables: List[str], variables: List[Dict[str, Any]]) -> list:
+    """
+    Mensajes con las partes estáticas primero: el system prompt y los textos
+    fijos (instrucciones) forman un prefijo idéntico entre llamadas,
+    y lo que cambia por caso (JSON, imágenes, audio) va al final.
+    """
+    return [
+        SystemMessage(content=sistema),
+        HumanMessage(content=[bloque_estable(t) for t in estables] + list(variables)),
+    ]
+
+
+def separar_prefijo(mensajes: list) -> Tuple[str, list, list]:
+    """
+    Devuelve (clave_prefijo, mensajes_prefijo, mensajes_sin_marcas). El prefijo
+    son los SystemMessage iniciales más los bloques marcados al inicio del
+    primer HumanMessage. Las marcas se quitan antes de enviar al proveedor.
+    """
+    h = hashlib.sha256()
+    prefijo: list = []
+    limpios: list = []
+    en_prefijo = True
+    for msg in mensajes if isinstance(mensajes, (list, tuple)) else [mensajes]:
+        contenido = getattr(msg, "content", None)
+        if isinstance(msg, SystemMessage) and en_prefijo:
+            h.update(b"S\x00" + str(contenido).encode("utf-8"))
+            prefijo.append(msg)
+            limpios.append(msg)
+            continue
+        if isinstance(msg, HumanMessage) and isinstance(contenido, list) and any(
+                isinstance(b, dict) and b.get(MARCA_PREFIJO) for b in contenido):
+            bloques_prefijo, bloques = [], []
+            for b in contenido:
+                if isinstance(b, dict) and b.get(MARCA_PREFIJO):
+                    b = {k: v for k, v in b.items() if k != MARCA_PREFIJO}
+                    if en_prefijo:
+                        h.update(b"H\x00" + str(b.get("text", "")).encode("utf-8"))
+                        bloques_prefijo.append(b)
+                else:
+                    en_prefijo = False
+                bloques.append(b)
+            if bloques_prefijo:
+                prefijo.append(HumanMessage(content=bloques_prefijo))
+            limpios.append(msg.model_copy(update={"content": bloques}))
+            en_prefijo = False
+            continue
+        en_prefijo = False
+        limpios.append(msg)
+    return h.hexdigest(), prefijo, limpios
+
+
+# ============================================================
+# CACHE DE CONTEXTO DEL PROVEEDOR
+# ============================================================
+class ContextCache(ABC):
+    """
+    Interfaz de cache de contexto del lado del proveedor: el prefijo se
+    registra una vez y las llamadas siguientes lo referencian.
+    """
+
+    @abstractmethod
+    def buscar(self, clave: str) -> Optional[str]:
+        """Referencia al contexto ya registrado para `clave`, o None."""
+
+    @abstractmethod
+    def registrar(self, clave: str, mensajes_prefijo: list, tokens: int) -> Optional[str]:
+        """Registra el prefijo y devuelve su referencia (None si no procede)."""
+
+    def aplicar(self, mensajes: list, referencia: str) -> Tuple[list, Dict[str, Any]]:
+        """Adapta mensajes/kwargs para usar el contexto cacheado (p. ej. `cached_content=`)."""
+        return mensajes, {}
+
+
+class LocalContextCache(ContextCache):
+    """
+    Simulación local: recuerda qué prefijos ya se "registraron" (con TTL y
+    LRU) para medir cuántos tokens se habrían servido desde cache. No cambia
+    lo que se envía al proveedor.
+    """
+
+    def __init__(self, ttl_s: float = 3600, max_entradas: int = 128):
+        self.ttl_s = ttl_s
+        self.max_entradas = max_entradas
+        self._entradas: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def buscar(self, clave: str) -> Optional[str]:
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            referencia, expira = entrada
+            if time.time() > expira:
+                self._entradas.pop(clave, None)
+                return None
+            self._entradas.move_to_end(clave)
+            return referencia
+
+    def registrar(self, clave: str, mensajes_prefijo: list, tokens: int) -> Optional[str]:
+        with self._lock:
+            referencia = f"local/{clave[:16]}"
+            self._entradas[clave] = (referencia, time.time() + self.ttl_s)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+            return referencia
+
+
+class MetricasContextCache:
+    """Tokens de entrada cacheados vs. no cacheados, por etapa del pipeline."""
+
+    def __init__(self):
+        self._por_etapa: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa: Optional[str], hit: bool, tokens_cacheados: int, tokens_no_cacheados: int):
+        with self._lock:
+            m = self._por_etapa.setdefault(etapa or "sin_etapa", {
+                "llamadas": 0, "hits": 0, "tokens_cacheados": 0, "tokens_no_cacheados": 0,
+            })
+            m["llamadas"] += 1
+            m["hits"] += int(hit)
+            m["tokens_cacheados"] += tokens_cacheados
+            m["tokens_no_cacheados"] += tokens_no_cacheados
+
+    def resumen(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            salida = {}
+            for etapa, m in self._por_etapa.items():
+                total = m["tokens_cacheados"] + m["tokens_no_cacheados"]
+                salida[etapa] = {**m, "ratio_cacheado": round(m["tokens_cacheados"] / total, 3) if total else 0.0}
+            return salida
+
+
+def _tokens_cacheados_reales(respuesta: Any) -> Optional[int]:
+    uso = getattr(respuesta, "usage_metadata", None) or {}
+    detalle = uso.get("input_token_details") if isinstance(uso, dict) else None
+    valor = (detalle or {}).get("cache_read")
+    return int(valor) if valor is not None else None
+
+
+class ContextCachedLLM:
+    """
+    Envuelve un chat model: separa el prefijo estable de cada llamada, lo
+    busca/registra en la `ContextCache` y contabiliza tokens cacheados y no
+    cacheados por etapa. Siempre quita las marcas de prefijo antes de enviar.
+    """
+
+    def __init__(self, llm, cache: Optional[ContextCache], metricas: MetricasContextCache,
+                 modelo: str = "", min_tokens_prefijo: int = 1024):
+        self.llm = llm
+        self.cache = cache
+        self.metricas = metricas
+        self.modelo = modelo
+        self.min_tokens_prefijo = min_tokens_prefijo
+
+    def invoke(self, mensajes, **kwargs):
+        clave, prefijo, limpios = separar_prefijo(mensajes)
+        tokens_total = estimar_tokens(limpios)
+        tokens_prefijo = estimar_tokens(prefijo) if prefijo else 0
+        clave = hashlib.sha256(f"{self.modelo}\x00{clave}".encode("utf-8")).hexdigest()
+
+        hit = False
+        extra: Dict[str, Any] = {}
+        if self.cache is not None and tokens_prefijo >= self.min_tokens_prefijo:
+            referencia = self.cache.buscar(clave)
+            if referencia is not None:
+                hit = True
+                limpios, extra = self.cache.aplicar(limpios, referencia)
+            else:
+                self.cache.registrar(clave, prefijo, tokens_prefijo)
+
+        respuesta = self.llm.invoke(limpios, **kwargs, **extra)
+
+        cacheados = _tokens_cacheados_reales(respuesta)
+        if cacheados is None:
+            cacheados = tokens_prefijo if hit else 0
+        self.metricas.registrar(ETAPA_ACTUAL.get(), hit, cacheados, max(0, tokens_total - cacheados))
+        return respuesta
+
+    def __getattr__(self, item):
+        return getattr(self.llm, item)
+
+
+# ============================================================
+# INSTANCIAS COMPARTIDAS DEL PROCESO
+# ============================================================
+metricas_context_cache = MetricasContextCache()
+_cache_global: Optional[ContextCache] = None
+_cache_lock = threading.Lock()
+
+
+def config_context_cache() -> Dict[str, Any]:
+    return load_pipeline_parameters("context_cache")
+
+
+def obtener_context_cache() -> Optional[ContextCache]:
+    global _cache_global
+    cfg = config_context_cache()
+    if not cfg.get("habilitado", True):
+        return None
+    with _cache_lock:
+        if _cache_global is None:
+            backend = cfg.get("backend", "local")
+            if backend != "local":
+                raise ValueError(f"Backend de context cache no soportado: {backend}")
+            _cache_global = LocalContextCache(
+                ttl_s=float(cfg.get("ttl_s", 3600)),
+                max_entradas=int(cfg.get("max_entradas", 128)),
+            )
+            logging.info("🧩 Context cache local (simulación) inicializada")
+        return _cache_global
+
+
+def envolver_con_context_cache(llm, modelo: str):
+    cfg = config_context_cache()
+    return ContextCachedLLM(
+        llm,
+        obtener_context_cache(),
+        metricas_context_cache,
+        modelo=modelo,
+        min_tokens_prefijo=int(cfg.get("min_tokens_prefijo", 1024)),
+    )
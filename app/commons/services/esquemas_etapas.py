@@ -0,0 +1,366 @@
+import re
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Literal, Optional, Set, Type
+
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, ValidationError, model_validator
+from typing_extensions import Annotated
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.metrics import registrar_validacion_esquema
+from app.commons.services.cancelacion import verificar_cancelacion
+from app.commons.services.json_respuesta import extraer_json
+from app.commons.services.llm_cache import validar_antes_de_cachear
+
+
+class ErrorEsquema(ValueError):
+    """Respuesta JSON válida pero que no cumple el esquema de la etapa."""
+
+
+# ============================================================
+# NORMALIZADORES (un solo lugar para las variantes del LLM)
+# ============================================================
+_RE_NUMERO = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+
+def _a_texto(valor: Any) -> Any:
+    # Números/booleanos donde se espera texto (placas, códigos, teléfonos)
+    if isinstance(valor, (int, float, bool)):
+        return str(valor)
+    return valor
+
+
+def _a_porcentaje(valor: Any) -> Optional[float]:
+    """60 | "60" | "60%" | "60,5 %" -> número; "indeterminable"/vacío -> None."""
+    if valor is None or isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    m = _RE_NUMERO.search(str(valor))
+    return float(m.group().replace(",", ".")) if m else None
+
+
+def _a_rol(valor: Any) -> Any:
+    """"Vehiculo_A" | "vehículo a" | "A" -> "vehiculo_a"."""
+    if not isinstance(valor, str):
+        return valor
+    v = re.sub(r"[\s\-]+", "_", valor.strip().lower().replace("í", "i"))
+    if v in ("a", "vehiculo_a"):
+        return "vehiculo_a"
+    if v in ("b", "vehiculo_b"):
+        return "vehiculo_b"
+    return v
+
+
+def _a_clave(valor: Any) -> Any:
+    """Valores enumerados: minúsculas, sin espacios ni guiones."""
+    return re.sub(r"[\s\-]+", "_", valor.strip().lower()) if isinstance(valor, str) else valor
+
+
+def _renombrar(datos: Any, alias: Dict[str, str]) -> Any:
+    # Claves de versiones previas del prompt -> contrato actual
+    if isinstance(datos, dict):
+        for viejo, nuevo in alias.items():
+            if viejo in datos and nuevo not in datos:
+                datos[nuevo] = datos.pop(viejo)
+    return datos
+
+
+Texto = Annotated[Optional[str], BeforeValidator(_a_texto)]
+Porcentaje = Annotated[Optional[float], BeforeValidator(_a_porcentaje), Field(default=None, ge=0, le=100)]
+Seccion = Dict[str, Any]
+
+
+class _Esquema(BaseModel):
+    # Se validan las claves que usa el pipeline; el resto del JSON se conserva tal cual
+    model_config = ConfigDict(extra="allow")
+
+
+# ============================================================
+# VISUAL
+# ============================================================
+class HechosVisuales(_Esquema):
+    metadata_analisis: Seccion
+    observaciones_objetivas: Seccion
+    inferencias_tecnicas: Seccion
+    limitaciones_y_incertidumbres: Seccion
+
+    @model_validator(mode="before")
+    @classmethod
+    def _alias(cls, datos: Any) -> Any:
+        return _renombrar(datos, {
+            "inferencias_preliminares": "inferencias_tecnicas",
+            "observaciones": "observaciones_objetivas",
+        })
+
+
+# ============================================================
+# FICHA DEL SINIESTRO
+# ============================================================
+class DatosSiniestroFicha(_Esquema):
+    causa: Texto = None
+    descripcion_detallada_relato: Texto = None
+
+
+class VehiculoFicha(_Esquema):
+    placa: Texto = None
+
+
+class FichaSiniestro(_Esquema):
+    metadata_extraccion: Seccion = Field(default_factory=dict)
+    poliza: Seccion = Field(default_factory=dict)
+    datos_siniestro: DatosSiniestroFicha
+    vehiculo_asegurado: VehiculoFicha
+    datos_tercero: VehiculoFicha
+    validacion: Seccion = Field(default_factory=dict)
+    limitaciones: Seccion = Field(default_factory=dict)
+
+
+# ============================================================
+# CIRCUNSTANCIAS MARCUS
+# ============================================================
+class CircunstanciaMarcus(_Esquema):
+    id: Texto
+    descripcion: Texto = None
+
+
+class VehiculoCircunstancias(_Esquema):
+    circunstancia_marcus: CircunstanciaMarcus
+
+
+class AnalisisPorVehiculo(_Esquema):
+    vehiculo_a: VehiculoCircunstancias
+    vehiculo_b: VehiculoCircunstancias
+
+
+class PorcentajeResponsabilidad(_Esquema):
+    vehiculo_a: Porcentaje
+    vehiculo_b: Porcentaje
+    justificacion_porcentajes: Texto = None
+
+
+class ConclusionCaso(_Esquema):
+    determinacion_responsabilidad_primaria: Texto = None
+    porcentaje_responsabilidad: PorcentajeResponsabilidad = Field(default_factory=PorcentajeResponsabilidad)
+
+
+class ResultadoCircunstancias(_Esquema):
+    resumen_fuentes_informacion: Seccion = Field(default_factory=dict)
+    analisis_por_vehiculo: AnalisisPorVehiculo
+    analisis_comparativo: Seccion = Field(default_factory=dict)
+    conclusion_general_del_caso: ConclusionCaso
+
+
+# ============================================================
+# PRECISIÓN VISUAL VS. FICHA
+# ============================================================
+Rol = Annotated[Literal["vehiculo_a", "vehiculo_b", "no_asociado"], BeforeValidator(_a_rol)]
+Responsable = Annotated[Literal["vehiculo_a", "vehiculo_b", "no_determinado"], BeforeValidator(_a_rol)]
+Coherencia = Annotated[
+    Literal["alta", "media", "baja", "no_evaluable_por_falta_de_asociacion"], BeforeValidator(_a_clave)
+]
+
+
+class AsociacionVehiculo(_Esquema):
+    placa_ficha: Texto = None
+    rol_visual: Rol
+
+
+class ResponsabilidadVisual(_Esquema):
+    responsable_primario_visual: Responsable = "no_determinado"
+    porcentaje_vehiculo_a: Porcentaje
+    porcentaje_vehiculo_b: Porcentaje
+    porcentaje_vehiculo_ficha: Porcentaje
+
+
+class EvaluacionPrecision(_Esquema):
+    coherencia_cualitativa: Coherencia
+    precision_global: Annotated[float, BeforeValidator(_a_porcentaje), Field(ge=0, le=100)]
+    explicacion_detallada: Texto = None
+
+
+class ObservacionesPrecision(_Esquema):
+    alertas_inconsistencias: List[Any] = Field(default_factory=list)
+    limitaciones: List[Any] = Field(default_factory=list)
+
+
+class ResultadoPrecision(_Esquema):
+    asociacion_vehiculo: AsociacionVehiculo
+    interpretacion_causa: Seccion = Field(default_factory=dict)
+    responsabilidad_visual: ResponsabilidadVisual = Field(default_factory=ResponsabilidadVisual)
+    evaluacion_precision: EvaluacionPrecision
+    observaciones: ObservacionesPrecision = Field(default_factory=ObservacionesPrecision)
+
+
+# Salidas JSON por etapa (audio devuelve texto)
+ESQUEMAS_ETAPA: Dict[str, Type[BaseModel]] = {
+    "visual": HechosVisuales,
+    "ficha": FichaSiniestro,
+    "circunstancias": ResultadoCircunstancias,
+    "precision": ResultadoPrecision,
+}
+
+
+# ============================================================
+# VALIDACIÓN
+# ============================================================
+def _resumen_errores(e: ValidationError, max_errores: int = 8) -> str:
+    partes = []
+    for err in e.errors()[:max_errores]:
+        ruta = ".".join(str(p) for p in err["loc"]) or "<raíz>"
+        partes.append(f"{ruta}: {err['msg']}")
+    extra = len(e.errors()) - max_errores
+    return "; ".join(partes) + (f" (+{extra} más)" if extra > 0 else "")
+
+
+def validar_salida(etapa: str, datos: Any) -> Dict[str, Any]:
+    """
+    Valida y normaliza la salida JSON de una etapa contra su esquema.
+    Devuelve el dict normalizado (con las claves extra intactas) o lanza
+    `ErrorEsquema` con un resumen legible, útil también para pedir al LLM que corrija.
+    """
+    esquema = ESQUEMAS_ETAPA[etapa]
+    if not isinstance(datos, dict):
+        registrar_validacion_esquema(etapa, "invalido")
+        raise ErrorEsquema(f"Se esperaba un objeto JSON, llegó {type(datos).__name__}")
+    try:
+        modelo = esquema.model_validate(datos)
+    except ValidationError as e:
+        registrar_validacion_esquema(etapa, "invalido")
+        raise ErrorEsquema(_resumen_errores(e)) from e
+    registrar_validacion_esquema(etapa, "ok")
+    # Solo lo que vino (normalizado): no se agregan campos por defecto a la salida
+    return modelo.model_dump(mode="json", exclude_unset=True)
+
+
+def validador_etapa(etapa: str) -> Callable[[Any], Dict[str, Any]]:
+    """Para el parámetro `schema_validator` de las etapas."""
+    return lambda datos: validar_salida(etapa, datos)
+
+
+# ============================================================
+# SALIDA ESTRUCTURADA NATIVA DEL PROVEEDOR
+# ============================================================
+# Claves de JSON Schema que el esquema OpenAPI del proveedor no acepta
+_CLAVES_NO_SOPORTADAS = {"title", "default", "additionalProperties", "$defs"}
+# Restricciones que pydantic deja con su nombre propio cuando hay un BeforeValidator delante
+_CLAVES_RENOMBRADAS = {"ge": "minimum", "le": "maximum"}
+
+
+def _a_esquema_proveedor(nodo: Any, defs: Dict[str, Any]) -> Any:
+    # Resuelve $ref en línea y convierte Optional (anyOf [X, null]) en `nullable`
+    if isinstance(nodo, list):
+        return [_a_esquema_proveedor(v, defs) for v in nodo]
+    if not isinstance(nodo, dict):
+        return nodo
+    if "$ref" in nodo:
+        return _a_esquema_proveedor(defs[nodo["$ref"].rsplit("/", 1)[-1]], defs)
+    variantes = nodo.get("anyOf")
+    if variantes:
+        no_nulas = [v for v in variantes if v.get("type") != "null"]
+        if len(no_nulas) == 1:
+            base = _a_esquema_proveedor(no_nulas[0], defs)
+            return {**base, "nullable": True} if len(no_nulas) < len(variantes) else base
+    salida = {}
+    for clave, valor in nodo.items():
+        if clave in _CLAVES_NO_SOPORTADAS:
+            continue
+        if clave == "properties":  # los nombres de campo no se filtran (p. ej. un campo "title")
+            salida[clave] = {campo: _a_esquema_proveedor(v, defs) for campo, v in valor.items()}
+        else:
+            salida[_CLAVES_RENOMBRADAS.get(clave, clave)] = _a_esquema_proveedor(valor, defs)
+    return salida
+
+
+@lru_cache(maxsize=None)
+def esquema_respuesta(etapa: str) -> Dict[str, Any]:
+    """`model_json_schema()` del esquema de la etapa en el formato de `response_schema` del proveedor."""
+    esquema = ESQUEMAS_ETAPA[etapa].model_json_schema()
+    return _a_esquema_proveedor(esquema, esquema.get("$defs", {}))
+
+
+# Clientes (id del modelo base) que rechazaron los parámetros nativos
+_clientes_sin_nativo: Set[int] = set()
+_clientes_lock = threading.Lock()
+
+
+def _cliente_base(llm) -> Any:
+    # Los envoltorios (cache, limitador, hedging, métricas) guardan el cliente en `self.llm`
+    while "llm" in getattr(llm, "__dict__", {}):
+        llm = llm.__dict__["llm"]
+    return llm
+
+
+def config_salida_estructurada() -> Dict[str, Any]:
+    return load_pipeline_parameters("salida_estructurada")
+
+
+def kwargs_salida_estructurada(etapa: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Parámetros de invocación para la salida estructurada nativa:
+    `response_mime_type` y, con `enviar_esquema`, el `response_schema` de la etapa.
+    """
+    cfg = config_salida_estructurada()
+    if not cfg.get("habilitado", True) or not cfg.get("nativo", True):
+        return {}
+    extra = dict(cfg.get("parametros_nativos") or {})
+    if etapa in ESQUEMAS_ETAPA and cfg.get("enviar_esquema", True):
+        extra["response_schema"] = esquema_respuesta(etapa)
+    return extra
+
+
+def respuesta_valida(etapa: Optional[str], texto: str) -> bool:
+    """
+    ¿La etapa aceptaría este texto? JSON extraíble y, si la etapa tiene
+    esquema, conforme a él. Sin tocar métricas: es el chequeo de la cache.
+    """
+    datos, _ = extraer_json(texto, medir=False)
+    if datos is None:
+        return False
+    if etapa not in ESQUEMAS_ETAPA:
+        return True
+    if not isinstance(datos, dict):
+        return False
+    try:
+        ESQUEMAS_ETAPA[etapa].model_validate(datos)
+    except ValidationError:
+        return False
+    return True
+
+
+def invocar_estructurado(llm, mensajes, etapa: Optional[str] = None):
+    """
+    `llm.invoke` pidiendo salida JSON nativa restringida al esquema de `etapa`.
+    Si el cliente no acepta esos parámetros se desactiva el modo nativo para
+    ese cliente (no para los demás) y se reintenta sin ellos; la validación
+    local sigue aplicando. La cache de respuestas solo guarda lo que pasa
+    `respuesta_valida`: lo que la etapa rechazaría no se reutiliza después.
+    """
+    # Cada intento de corrección de JSON pasa por aquí: se corta si el caso ya se canceló
+    verificar_cancelacion()
+    with validar_antes_de_cachear(lambda texto: respuesta_valida(etapa, texto)):
+        return _invocar_estructurado(llm, mensajes, etapa)
+
+
+def _invocar_estructurado(llm, mensajes, etapa: Optional[str]):
+    extra = kwargs_salida_estructurada(etapa)
+    cliente = id(_cliente_base(llm))
+    with _clientes_lock:
+        sin_nativo = cliente in _clientes_sin_nativo
+    if not extra or sin_nativo:
+        return llm.invoke(mensajes)
+    try:
+        return llm.invoke(mensajes, **extra)
+    except Exception as e:
+        if not (isinstance(e, TypeError) or any(k in str(e) for k in extra)):
+            raise
+        with _clientes_lock:
+            primera_vez = cliente not in _clientes_sin_nativo
+            _clientes_sin_nativo.add(cliente)
+        if primera_vez:
+            logging.warning(
+                f"⚠️ El modelo {type(_cliente_base(llm)).__name__} no acepta salida estructurada nativa "
+                f"({e}); se continúa sin ella para ese cliente."
+            )
+        return llm.invoke(mensajes)
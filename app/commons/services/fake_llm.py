@@ -0,0 +1,109 @@
+import time
+import random
+import threading
+from collections import deque
+from typing import Any, Callable, Optional, Union
+
+from langchain_core.messages import AIMessage
+
+
+class ErrorCuotaSimulado(Exception):
+    """429 simulado, con la forma que exponen los SDKs (`status_code` + `response.headers`)."""
+
+    status_code = 429
+
+    def __init__(self, mensaje: str = "429 RESOURCE_EXHAUSTED (simulado)", retry_after: Optional[float] = None):
+        super().__init__(mensaje)
+        self.response = type("RespuestaSimulada", (), {
+            "status_code": 429,
+            "headers": {"retry-after": str(retry_after)} if retry_after is not None else {},
+        })()
+
+
+class ErrorProveedorSimulado(Exception):
+    """Falla no relacionada con cuota (500/timeout del proveedor), simulada."""
+
+    status_code = 500
+
+
+class FakeLLM:
+    """
+    Chat model local para pruebas y benchmarks, sin red. Simula latencia
+    (`latencia_s` ± `jitter_s`) y la cuota del proveedor: responde 429 si se
+    superan `cuota_rpm` llamadas en la ventana de `ventana_s` segundos, si hay
+    más de `max_concurrencia` llamadas simultáneas, o al azar con `prob_429`.
+    Con `prob_error` falla al azar con un error que no es de cuota y con
+    `prob_lenta` una llamada se "atasca" `latencia_lenta_s` (cola larga).
+
+    `respuesta` puede ser un texto fijo o una función `mensajes -> texto`.
+    """
+
+    def __init__(
+            self,
+            respuesta: Union[str, Callable[[Any], str]] = '{"ok": true}',
+            latencia_s: float = 0.05,
+            jitter_s: float = 0.0,
+            cuota_rpm: Optional[int] = None,
+            ventana_s: float = 60.0,
+            max_concurrencia: Optional[int] = None,
+            prob_429: float = 0.0,
+            prob_error: float = 0.0,
+            prob_lenta: float = 0.0,
+            latencia_lenta_s: float = 5.0,
+            semilla: Optional[int] = None,
+    ):
+        self.respuesta = respuesta
+        self.latencia_s = latencia_s
+        self.jitter_s = jitter_s
+        self.cuota_rpm = cuota_rpm
+        self.ventana_s = ventana_s
+        self.max_concurrencia = max_concurrencia
+        self.prob_429 = prob_429
+        self.prob_error = prob_error
+        self.prob_lenta = prob_lenta
+        self.latencia_lenta_s = latencia_lenta_s
+        self._rnd = random.Random(semilla)
+        self._llamadas: deque = deque()
+        self._en_vuelo = 0
+        self._lock = threading.Lock()
+        self.stats = {"llamadas": 0, "ok": 0, "rechazadas_429": 0, "errores": 0, "lentas": 0, "max_en_vuelo": 0}
+
+    def _admitir(self):
+        with self._lock:
+            self.stats["llamadas"] += 1
+            ahora = time.monotonic()
+            while self._llamadas and ahora - self._llamadas[0] > self.ventana_s:
+                self._llamadas.popleft()
+            rechazo = None
+            if self.cuota_rpm is not None and len(self._llamadas) >= self.cuota_rpm:
+                rechazo = ErrorCuotaSimulado(retry_after=None)
+            elif self.max_concurrencia is not None and self._en_vuelo >= self.max_concurrencia:
+                rechazo = ErrorCuotaSimulado("429 demasiadas solicitudes concurrentes (simulado)")
+            elif self.prob_429 and self._rnd.random() < self.prob_429:
+                rechazo = ErrorCuotaSimulado()
+            if rechazo is not None:
+                self.stats["rechazadas_429"] += 1
+                raise rechazo
+            if self.prob_error and self._rnd.random() < self.prob_error:
+                self.stats["errores"] += 1
+                raise ErrorProveedorSimulado("500 INTERNAL (simulado)")
+            self._llamadas.append(ahora)
+            self._en_vuelo += 1
+            self.stats["max_en_vuelo"] = max(self.stats["max_en_vuelo"], self._en_vuelo)
+
+    def invoke(self, mensajes, **kwargs):
+        self._admitir()
+        try:
+            with self._lock:
+                latencia = max(0.0, self.latencia_s + self._rnd.uniform(-self.jitter_s, self.jitter_s))
+                if self.prob_lenta and self._rnd.random() < self.prob_lenta:
+                    latencia = self.latencia_lenta_s
+                    self.stats["lentas"] += 1
+            time.sleep(latencia)
+            texto = self.respuesta(mensajes) if callable(self.respuesta) else self.respuesta
+        finally:
+            with self._lock:
+                self._en_vuelo -= 1
+        with self._lock:
+            self.stats["ok"] += 1
+        return AIMessage(content=texto, response_metadata={"fake": True})
@@ -0,0 +1,211 @@
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, Optional
+
+from app.commons.services.miscelaneous import load_pipeline_parameters, load_all_llm_parameters
+from app.commons.services.stage_scheduler import ETAPA_ACTUAL
+from app.commons.services.metrics import registrar_hedge
+
+
+def _percentil(valores, p: float) -> float:
+    orden = sorted(valores)
+    k = (len(orden) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(orden) - 1)
+    return orden[i] + (orden[j] - orden[i]) * (k - i)
+
+
+# ============================================================
+# PRESUPUESTO DE HEDGES
+# ============================================================
+class PresupuestoHedge:
+    """
+    Cada llamada primaria deposita `tasa_maxima` créditos (hasta `rafaga`) y
+    cada hedge gasta 1: a largo plazo los duplicados no superan `tasa_maxima`
+    de las llamadas, aunque el proveedor se degrade por completo.
+    """
+
+    def __init__(self, tasa_maxima: float = 0.05, rafaga: float = 2.0):
+        self.tasa_maxima = float(tasa_maxima)
+        self.rafaga = max(1.0, float(rafaga))
+        self._saldo = 0.0
+        self._lock = threading.Lock()
+
+    def depositar(self):
+        with self._lock:
+            self._saldo = min(self.rafaga, self._saldo + self.tasa_maxima)
+
+    def gastar(self) -> bool:
+        with self._lock:
+            if self._saldo < 1.0:
+                return False
+            self._saldo -= 1.0
+            return True
+
+
+# ============================================================
+# ESTADO COMPARTIDO POR MODELO
+# ============================================================
+class EstadoHedge:
+    """Ventanas de latencia por etapa, presupuesto, hilos y estadísticas de un modelo."""
+
+    def __init__(self, nombre: str, cfg: Dict[str, Any]):
+        self.nombre = nombre
+        self.percentil = float(cfg.get("percentil", 95))
+        self.min_muestras = int(cfg.get("min_muestras", 20))
+        self.ventana = int(cfg.get("ventana", 200))
+        self.umbral_minimo_s = float(cfg.get("umbral_minimo_s", 2.0))
+        self.etapas = set(cfg["etapas"]) if cfg.get("etapas") else None
+        self.presupuesto = PresupuestoHedge(cfg.get("tasa_maxima", 0.05), cfg.get("rafaga", 2))
+        max_hilos = max(2, int(cfg.get("max_hilos", 32)))
+        # Cupos no bloqueantes: sin hilo libre la llamada corre en línea, nunca espera en cola
+        self.hilos = threading.BoundedSemaphore(max_hilos)
+        self.pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix=f"hedge-{nombre}")
+        self._latencias: Dict[str, Deque[float]] = {}
+        self.stats = {"llamadas": 0, "hedges": 0, "gano_hedge": 0, "sin_presupuesto": 0, "sin_hilos": 0}
+        self._lock = threading.Lock()
+
+    def _sumar(self, clave: str):
+        with self._lock:
+            self.stats[clave] += 1
+
+    def aplica(self, etapa: str) -> bool:
+        return self.etapas is None or etapa in self.etapas
+
+    def observar(self, etapa: str, segundos: float):
+        with self._lock:
+            self._latencias.setdefault(etapa, deque(maxlen=self.ventana)).append(segundos)
+
+    def umbral(self, etapa: str) -> Optional[float]:
+        """Percentil configurado de la latencia observada de la etapa (None si aún no hay muestras suficientes)."""
+        with self._lock:
+            muestras = list(self._latencias.get(etapa, ()))
+        if len(muestras) < self.min_muestras:
+            return None
+        return max(self.umbral_minimo_s, _percentil(muestras, self.percentil))
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            etapas = list(self._latencias)
+        umbrales = {}
+        for etapa in etapas:
+            u = self.umbral(etapa)
+            umbrales[etapa] = round(u, 3) if u is not None else None
+        return {
+            **stats,
+            "tasa_hedge": round(stats["hedges"] / stats["llamadas"], 4) if stats["llamadas"] else 0.0,
+            "umbral_s": umbrales,
+        }
+
+
+class HedgedLLM:
+    """
+    Envuelve un chat model: si `invoke` no responde dentro del percentil
+    configurado de la latencia observada de su etapa, envía un duplicado y
+    devuelve la primera respuesta exitosa. La perdedora no se puede abortar
+    (la llamada HTTP es bloqueante): sigue en su hilo y su resultado se descarta.
+    Solo se duplica si el presupuesto y los hilos lo permiten.
+    """
+
+    def __init__(self, llm, estado: EstadoHedge):
+        self.llm = llm
+        self.estado = estado
+
+    def _llamar(self, etapa: str, mensajes, kwargs):
+        t0 = time.perf_counter()
+        respuesta = self.llm.invoke(mensajes, **kwargs)
+        # Solo los éxitos alimentan la distribución (un error rápido bajaría el umbral)
+        self.estado.observar(etapa, time.perf_counter() - t0)
+        return respuesta
+
+    def _lanzar(self, etapa: str, mensajes, kwargs) -> Future:
+        # Cada hilo corre en su propia copia del contexto: conserva ETAPA_ACTUAL para métricas/cache
+        futuro = self.estado.pool.submit(contextvars.copy_context().run, self._llamar, etapa, mensajes, kwargs)
+        futuro.add_done_callback(lambda _: self.estado.hilos.release())
+        return futuro
+
+    def invoke(self, mensajes, **kwargs):
+        est = self.estado
+        etapa = ETAPA_ACTUAL.get() or "sin_etapa"
+        if not est.aplica(etapa):
+            return self.llm.invoke(mensajes, **kwargs)
+
+        est._sumar("llamadas")
+        est.presupuesto.depositar()
+        umbral = est.umbral(etapa)
+        if umbral is None or not est.hilos.acquire(blocking=False):
+            return self._llamar(etapa, mensajes, kwargs)
+
+        primario = self._lanzar(etapa, mensajes, kwargs)
+        hechos, _ = wait([primario], timeout=umbral)
+        if hechos:
+            return primario.result()
+
+        if not est.presupuesto.gastar():
+            est._sumar("sin_presupuesto")
+            registrar_hedge(est.nombre, "sin_presupuesto", etapa)
+            return primario.result()
+        if not est.hilos.acquire(blocking=False):
+            est._sumar("sin_hilos")
+            registrar_hedge(est.nombre, "sin_hilos", etapa)
+            return primario.result()
+
+        est._sumar("hedges")
+        registrar_hedge(est.nombre, "lanzado", etapa)
+        logging.info(f"🪃 [{est.nombre}/{etapa}] Sin respuesta en {umbral:.1f}s; se envía solicitud duplicada")
+        hedge = self._lanzar(etapa, mensajes, kwargs)
+
+        pendientes = {primario, hedge}
+        while pendientes:
+            hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                if futuro.exception() is None:
+                    gano_hedge = futuro is hedge
+                    if gano_hedge:
+                        est._sumar("gano_hedge")
+                    registrar_hedge(est.nombre, "gano_hedge" if gano_hedge else "gano_primario", etapa)
+                    return futuro.result()
+        # Ambas fallaron: se propaga el error de la primaria
+        raise primario.exception()
+
+    def __getattr__(self, item):
+        return getattr(self.llm, item)
+
+
+# ============================================================
+# ESTADO COMPARTIDO DEL PROCESO
+# ============================================================
+_estados: Dict[str, EstadoHedge] = {}
+_estados_lock = threading.Lock()
+
+
+def config_hedging(clave_modelo: str) -> Dict[str, Any]:
+    """Sección `hedging` de pipeline_parameters.json con overrides de `hedging` del modelo."""
+    cfg = dict(load_pipeline_parameters("hedging"))
+    cfg.update(load_all_llm_parameters().get(clave_modelo, {}).get("hedging", {}) or {})
+    return cfg
+
+
+def obtener_estado_hedge(clave_modelo: str) -> EstadoHedge:
+    with _estados_lock:
+        if clave_modelo not in _estados:
+            _estados[clave_modelo] = EstadoHedge(clave_modelo, config_hedging(clave_modelo))
+        return _estados[clave_modelo]
+
+
+def resumen_hedging() -> Dict[str, Dict[str, Any]]:
+    with _estados_lock:
+        estados = dict(_estados)
+    return {n: e.resumen() for n, e in estados.items()}
+
+
+def envolver_con_hedging(llm, clave_modelo: str):
+    """Aplica hedging solo si `hedging.habilitado` es true (opt-in: duplica llamadas y costo)."""
+    if not config_hedging(clave_modelo).get("habilitado", False):
+        return llm
+    return HedgedLLM(llm, obtener_estado_hedge(clave_modelo))
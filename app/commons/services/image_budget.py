@@ -0,0 +1,227 @@
+import io
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Pillow es opcional: sin él no se aplica presupuesto
+    Image = ImageChops = None
+
+_FORMATOS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+@dataclass
+class ResumenPresupuesto:
+    imagenes_entrada: int = 0
+    imagenes_salida: int = 0
+    duplicadas_descartadas: List[int] = field(default_factory=list)  # índices 0-based
+    bytes_originales: int = 0
+    bytes_finales: int = 0
+
+    @property
+    def bytes_ahorrados(self) -> int:
+        return self.bytes_originales - self.bytes_finales
+
+
+def config_presupuesto(etapa: Optional[str] = None) -> Dict[str, Any]:
+    """Config de `pipeline_parameters.json` (sección `image_budget`) con overrides por etapa."""
+    cfg = dict(load_pipeline_parameters("image_budget"))
+    por_etapa = cfg.pop("por_etapa", {}) or {}
+    if etapa and etapa in por_etapa:
+        cfg.update(por_etapa[etapa])
+    return cfg
+
+
+# =========================
+# Hash perceptual (dHash)
+# =========================
+def dhash(img, lado: int = 16) -> int:
+    """
+    Hash de diferencias de lado² bits: escala de grises, (lado+1)x(lado) y compara
+    píxeles vecinos. Imágenes casi idénticas dan hashes a poca distancia Hamming.
+    """
+    gris = img.convert("L").resize((lado + 1, lado), Image.BILINEAR)
+    px = list(gris.getdata())
+    bits = 0
+    for fila in range(lado):
+        for col in range(lado):
+            izq = px[fila * (lado + 1) + col]
+            der = px[fila * (lado + 1) + col + 1]
+            bits = (bits << 1) | (1 if izq > der else 0)
+    return bits
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _miniatura(img, ancho: int = 256):
+    return img.convert("L").resize((ancho, max(1, round(ancho * img.height / img.width))), Image.BILINEAR)
+
+
+def _misma_pagina(a, b, tolerancia: int) -> bool:
+    # El dHash no ve el texto: dos páginas del mismo formulario con datos distintos
+    # dan distancia 0. Un trazo distinto en la miniatura basta para separarlas.
+    return a.size == b.size and ImageChops.difference(a, b).getextrema()[1] <= tolerancia
+
+
+# =========================
+# Re-encode con presupuesto
+# =========================
+def _redimensionar(img, max_lado_px: int, max_pixeles: int):
+    ancho, alto = img.size
+    escala = 1.0
+    if max_lado_px and max(ancho, alto) > max_lado_px:
+        escala = max_lado_px / max(ancho, alto)
+    if max_pixeles and ancho * alto * escala * escala > max_pixeles:
+        escala = (max_pixeles / (ancho * alto)) ** 0.5
+    if escala < 1.0:
+        img = img.resize((max(1, int(ancho * escala)), max(1, int(alto * escala))), Image.LANCZOS)
+    return img
+
+
+def _codificar(img, formato_pil: str, calidad: int) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=formato_pil, quality=calidad, optimize=True)
+    return buf.getvalue()
+
+
+def _bytes_bloque(bloque: Dict[str, Any]) -> int:
+    # Una página sin codificar (`imagen`, ver pdf_render) cuenta por sus píxeles RGB
+    img = bloque.get("imagen")
+    if img is not None:
+        return img.width * img.height * len(img.getbands())
+    return len(bloque.get("data") or b"")
+
+
+def aplicar_presupuesto(
+        media_blocks: List[Dict[str, Any]],
+        etapa: Optional[str] = None,
+        **overrides,
+) -> Tuple[List[Dict[str, Any]], ResumenPresupuesto]:
+    """
+    Preprocesa bloques de imagen antes de enviarlos al LLM:
+    1. Descarta páginas duplicadas: candidatas por dHash (distancia <=
+       `umbral_duplicado`; -1 desactiva el descarte), confirmadas si ningún
+       píxel de la miniatura difiere más de `tolerancia_pixel`. Registra cuáles.
+    2. Limita lado máximo / píxeles por imagen y re-codifica a JPEG o WebP.
+    3. Si el total supera `max_bytes_total_mb`, baja la calidad hasta
+       `calidad_minima` y luego reduce la escala hasta cumplir.
+
+    Los bloques que no son imagen (o no se pueden decodificar) pasan intactos.
+    Los que traen la página sin codificar (`imagen`) se codifican aquí una
+    sola vez, también con el presupuesto deshabilitado (sin redimensionar).
+    """
+    cfg = {**config_presupuesto(etapa), **overrides}
+    resumen = ResumenPresupuesto(
+        imagenes_entrada=len(media_blocks),
+        bytes_originales=sum(_bytes_bloque(b) for b in media_blocks),
+    )
+
+    formato_pil, mime = _FORMATOS[str(cfg.get("formato", "jpeg")).lower()]
+    if Image is None or not cfg.get("habilitado", True):
+        if Image is None:
+            logging.warning("⚠️ Pillow no está instalado; se omite el presupuesto de imágenes.")
+        calidad_fija = int(cfg.get("calidad", 80))
+        media_blocks = [
+            {"type": "media", "data": _codificar(b["imagen"], formato_pil, calidad_fija), "mime_type": mime}
+            if b.get("imagen") is not None else b
+            for b in media_blocks
+        ]
+        resumen.imagenes_salida = len(media_blocks)
+        resumen.bytes_finales = sum(_bytes_bloque(b) for b in media_blocks)
+        return media_blocks, resumen
+
+    calidad = int(cfg.get("calidad", 80))
+    calidad_minima = int(cfg.get("calidad_minima", 50))
+    max_lado_px = int(cfg.get("max_lado_px", 1600))
+    max_pixeles = int(cfg.get("max_pixeles", 0))
+    max_bytes_total = int(float(cfg.get("max_bytes_total_mb", 8)) * 1024 * 1024)
+    umbral_duplicado = int(cfg.get("umbral_duplicado", 1))
+    lado_hash = int(cfg.get("lado_hash", 16))
+    tolerancia_pixel = int(cfg.get("tolerancia_pixel", 32))
+
+    # 1) Decodificar + descartar duplicadas
+    candidatas: List[Tuple[int, Any, Dict[str, Any], Tuple[int, int]]] = []  # (pos, imagen, original, tamaño)
+    vistas: List[Tuple[int, int, Any]] = []  # (índice, hash, miniatura)
+    salida: List[Optional[Dict[str, Any]]] = []
+    for idx, bloque in enumerate(media_blocks):
+        data = bloque.get("data")
+        if bloque.get("imagen") is not None:
+            img = bloque["imagen"]  # ya decodificada: nada que abrir
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+        elif not str(bloque.get("mime_type", "")).startswith("image/") or not isinstance(data, (bytes, bytearray)):
+            salida.append(bloque)
+            continue
+        else:
+            try:
+                img = Image.open(io.BytesIO(data))
+                img.load()
+                img = img.convert("RGB")
+            except Exception as e:
+                logging.warning(f"⚠️ Imagen {idx + 1} no decodificable, se envía tal cual: {e}")
+                salida.append(bloque)
+                continue
+
+        if umbral_duplicado >= 0:
+            h, mini = dhash(img, lado_hash), _miniatura(img)
+            igual = next((i for i, previo, mini_previa in vistas
+                          if _hamming(h, previo) <= umbral_duplicado
+                          and _misma_pagina(mini, mini_previa, tolerancia_pixel)), None)
+            if igual is not None:
+                logging.info(
+                    f"🗑️ Imagen {idx + 1}{f' [{etapa}]' if etapa else ''} descartada: duplicada de la imagen {igual + 1}"
+                )
+                resumen.duplicadas_descartadas.append(idx)
+                continue
+            vistas.append((idx, h, mini))
+
+        candidatas.append((len(salida), _redimensionar(img, max_lado_px, max_pixeles), bloque, img.size))
+        salida.append(None)  # se rellena al codificar
+
+    # 2) Codificar respetando el presupuesto total
+    bytes_fijos = sum(_bytes_bloque(b) for b in salida if b is not None)
+    escala = 1.0
+    while True:
+        codificadas = []
+        for pos, img, original, tam_original in candidatas:
+            if escala < 1.0:
+                img = img.resize((max(1, int(img.width * escala)), max(1, int(img.height * escala))), Image.LANCZOS)
+            data = _codificar(img, formato_pil, calidad)
+            # Si re-codificar no ahorra nada y el original no se redimensionó, se conserva
+            # (una página sin codificar no tiene original que conservar)
+            if original.get("imagen") is None and len(data) >= len(original["data"]) and img.size == tam_original:
+                codificadas.append((pos, original))
+            else:
+                codificadas.append((pos, {"type": "media", "data": data, "mime_type": mime}))
+        total = bytes_fijos + sum(len(b["data"]) for _, b in codificadas)
+        if total <= max_bytes_total or not candidatas:
+            break
+        if calidad > calidad_minima:
+            calidad = max(calidad_minima, calidad - 10)
+        elif escala > 0.25:
+            escala *= 0.8
+        else:
+            logging.warning(f"⚠️ No se logró cumplir el presupuesto de {max_bytes_total} bytes ({total} bytes).")
+            break
+
+    for pos, bloque in codificadas:
+        salida[pos] = bloque
+
+    bloques = [b for b in salida if b is not None]
+    resumen.imagenes_salida = len(bloques)
+    resumen.bytes_finales = sum(len(b.get("data") or b"") for b in bloques)
+    logging.info(
+        f"🗜️ Presupuesto de imágenes{f' [{etapa}]' if etapa else ''}: "
+        f"{resumen.imagenes_entrada}→{resumen.imagenes_salida} imagen(es), "
+        f"{resumen.bytes_originales / 1024:.0f} KB → {resumen.bytes_finales / 1024:.0f} KB "
+        f"(ahorro {resumen.bytes_ahorrados / 1024:.0f} KB, duplicadas: {len(resumen.duplicadas_descartadas)})"
+    )
+    return bloques, resumen
@@ -0,0 +1,253 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from abc import ABC, abstractmethod
+from enum import Enum
+from dataclasses import dataclass, field, asdict, replace
+from typing import Any, Callable, Dict, List, Optional
+
+
+class EstadoJob(str, Enum):
+    EN_COLA = "en_cola"
+    EN_PROCESO = "en_proceso"
+    COMPLETADO = "completado"
+    FALLIDO = "fallido"
+
+
+class ColaLlena(Exception):
+    """La cola de trabajos alcanzó su profundidad máxima."""
+
+
+class CasoEnCurso(Exception):
+    """Ya hay un job en cola o en proceso para ese case_id."""
+
+
+@dataclass
+class Job:
+    id: str
+    case_id: Optional[str] = None
+    estado: EstadoJob = EstadoJob.EN_COLA
+    etapas_en_curso: List[str] = field(default_factory=list)
+    etapas_completadas: List[str] = field(default_factory=list)
+    resultado: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    # Detalle estructurado del fallo (p. ej. errores por etapa) si la excepción lo trae
+    detalle_error: Optional[Dict[str, Any]] = None
+    creado: float = field(default_factory=time.time)
+    iniciado: Optional[float] = None
+    finalizado: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        d["estado"] = self.estado.value
+        return d
+
+
+# ============================================================
+# BACKEND DE ALMACENAMIENTO DE JOBS
+# ============================================================
+class JobStore(ABC):
+    """Interfaz del almacenamiento de estado de jobs."""
+
+    @abstractmethod
+    def guardar(self, job: Job) -> None:
+        """Inserta o reemplaza el job."""
+
+    @abstractmethod
+    def obtener(self, job_id: str) -> Optional[Job]:
+        """Copia del job, o None si no existe (o ya se purgó)."""
+
+    @abstractmethod
+    def actualizar(self, job_id: str, fn: Callable[[Job], None]) -> None:
+        """Aplica `fn` al job de forma atómica."""
+
+    @abstractmethod
+    def activo_para_caso(self, case_id: str) -> Optional[Job]:
+        """Job en cola o en proceso para `case_id`, si lo hay."""
+
+
+class LocalJobStore(JobStore):
+    """
+    Estado en memoria del proceso. Los jobs terminados se purgan pasado
+    `ttl_segundos` o cuando se supera `max_jobs`.
+    """
+
+    def __init__(self, max_jobs: int = 1000, ttl_segundos: float = 3600):
+        self.max_jobs = max_jobs
+        self.ttl_segundos = ttl_segundos
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _purgar(self):
+        ahora = time.time()
+        terminados = [j for j in self._jobs.values() if j.finalizado is not None]
+        for j in terminados:
+            if ahora - j.finalizado > self.ttl_segundos:
+                self._jobs.pop(j.id, None)
+        if len(self._jobs) > self.max_jobs:
+            for j in sorted(terminados, key=lambda j: j.finalizado)[:len(self._jobs) - self.max_jobs]:
+                self._jobs.pop(j.id, None)
+
+    def guardar(self, job: Job) -> None:
+        with self._lock:
+            self._purgar()
+            self._jobs[job.id] = job
+
+    def obtener(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            # Copia para que el llamador no vea mutaciones a medias de los workers
+            return replace(job, etapas_en_curso=list(job.etapas_en_curso),
+                           etapas_completadas=list(job.etapas_completadas))
+
+    def actualizar(self, job_id: str, fn: Callable[[Job], None]) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                fn(job)
+
+    def activo_para_caso(self, case_id: str) -> Optional[Job]:
+        with self._lock:
+            for job in self._jobs.values():
+                if job.case_id == case_id and job.finalizado is None:
+                    return job
+            return None
+
+
+def crear_store(backend: str = "local", **kwargs) -> JobStore:
+    if backend == "local":
+        return LocalJobStore(**kwargs)
+    raise ValueError(f"Backend de jobs no soportado: {backend}")
+
+
+# ============================================================
+# COLA + WORKERS
+# ============================================================
+class ColaTrabajos:
+    """
+    Cola acotada en proceso con `workers` hilos. `procesar(job_id, reportar, **payload)`
+    ejecuta el trabajo (el payload incluye `case_id`); `reportar(evento, etapa)`
+    con evento "inicio"/"fin" actualiza el progreso visible en el store.
+    El id del job siempre lo genera la cola: dos envíos del mismo case_id no
+    comparten job, y mientras uno siga activo el segundo se rechaza.
+    """
+
+    def __init__(
+            self,
+            procesar: Callable[..., Dict[str, Any]],
+            store: Optional[JobStore] = None,
+            workers: int = 2,
+            max_cola: int = 50,
+    ):
+        self.procesar = procesar
+        self.store = store or LocalJobStore()
+        self.workers = workers
+        self._cola: "queue.Queue" = queue.Queue(maxsize=max_cola)
+        self._hilos: List[threading.Thread] = []
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        for i in range(self.workers):
+            hilo = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+        logging.info(f"🧵 Cola de jobs iniciada: {self.workers} worker(s), profundidad {self._cola.maxsize}")
+
+    def detener(self, timeout: float = 5.0):
+        self._detener.set()
+        for hilo in self._hilos:
+            hilo.join(timeout=timeout)
+
+    def profundidad(self) -> int:
+        return self._cola.qsize()
+
+    def reservar(self, case_id: Optional[str] = None) -> Job:
+        """
+        Registra el job (en cola, sin payload todavía) y devuelve su id, de modo
+        que el llamador pueda preparar archivos propios del envío antes de
+        `despachar`. Mientras la reserva exista el caso cuenta como activo.
+        """
+        job_id = uuid.uuid4().hex
+        job = Job(id=job_id, case_id=case_id or job_id)
+        # Comprobar y registrar bajo el mismo lock: dos envíos simultáneos no pasan ambos
+        with self._lock:
+            activo = self.store.activo_para_caso(job.case_id)
+            if activo is not None:
+                raise CasoEnCurso(f"El caso {job.case_id} ya tiene un job activo: {activo.id}")
+            self.store.guardar(job)
+        return job
+
+    def despachar(self, job: Job, **payload) -> Job:
+        """Pone en la cola un job reservado; si la cola está llena lo marca fallido."""
+        try:
+            self._cola.put_nowait((job.id, {**payload, "case_id": job.case_id}))
+        except queue.Full:
+            self.store.actualizar(job.id, self._marcar_fallido("Cola llena"))
+            raise ColaLlena(f"La cola de jobs está llena ({self._cola.maxsize}).")
+        return job
+
+    def descartar(self, job_id: str, motivo: str):
+        """Cierra una reserva que no llegó a despacharse (libera el caso)."""
+        self.store.actualizar(job_id, self._marcar_fallido(motivo))
+
+    def encolar(self, case_id: Optional[str] = None, **payload) -> Job:
+        return self.despachar(self.reservar(case_id), **payload)
+
+    @staticmethod
+    def _marcar_fallido(error: str, detalle: Optional[Dict[str, Any]] = None):
+        def _fn(job: Job):
+            job.estado = EstadoJob.FALLIDO
+            job.error = error
+            job.detalle_error = detalle
+            job.etapas_en_curso = []
+            job.finalizado = time.time()
+        return _fn
+
+    def _loop(self):
+        while not self._detener.is_set():
+            try:
+                job_id, payload = self._cola.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._ejecutar(job_id, payload)
+            finally:
+                self._cola.task_done()
+
+    def _ejecutar(self, job_id: str, payload: Dict[str, Any]):
+        def _inicio(job: Job):
+            job.estado = EstadoJob.EN_PROCESO
+            job.iniciado = time.time()
+
+        self.store.actualizar(job_id, _inicio)
+
+        def reportar(evento: str, etapa: str):
+            def _fn(job: Job):
+                if evento == "inicio":
+                    job.etapas_en_curso.append(etapa)
+                elif evento == "fin":
+                    if etapa in job.etapas_en_curso:
+                        job.etapas_en_curso.remove(etapa)
+                    job.etapas_completadas.append(etapa)
+            self.store.actualizar(job_id, _fn)
+
+        try:
+            resultado = self.procesar(job_id, reportar, **payload)
+        except Exception as e:
+            logging.error(f"❌ Job {job_id} falló: {e}", exc_info=True)
+            self.store.actualizar(job_id, self._marcar_fallido(str(e), getattr(e, "detalle", None) or None))
+            return
+
+        def _fin(job: Job):
+            job.estado = EstadoJob.COMPLETADO
+            job.resultado = resultado
+            job.etapas_en_curso = []
+            job.finalizado = time.time()
+
+        self.store.actualizar(job_id, _fin)
+        logging.info(f"✅ Job {job_id} completado")
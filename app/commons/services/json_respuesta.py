@@ -0,0 +1,212 @@
+import re
+import json
+from typing import Any, List, Optional, Tuple
+
+from app.commons.services.metrics import registrar_parseo_json
+
+try:
+    import orjson  # opcional: parseo más rápido
+except ImportError:
+    orjson = None
+
+# Caracteres que cambian el estado del escáner (el resto se salta con la regex)
+_RE_ESTRUCTURA = re.compile(r'[\\"{}\[\]]')
+_RE_FENCE_INICIO = re.compile(r"^```[a-zA-Z0-9_-]*\s*")
+_RE_APERTURA = re.compile(r"[{\[]")
+_COMILLAS_TIPOGRAFICAS = "“”„‟″"
+_MAX_CANDIDATOS = 5
+
+
+def cargar_json(texto: str) -> Any:
+    """json.loads con orjson si está instalado."""
+    if orjson is not None:
+        return orjson.loads(texto)
+    return json.loads(texto)
+
+
+def quitar_fences(texto: Any) -> str:
+    """Quita fences Markdown (```json ... ``` o ``` ... ```) si el modelo los incluyó."""
+    if not isinstance(texto, str):
+        return str(texto)
+    t = texto.strip()
+    if t.startswith("```"):
+        t = _RE_FENCE_INICIO.sub("", t, count=1)
+        if t.endswith("```"):
+            t = t[:-3]
+        t = t.strip()
+    return t
+
+
+# ============================================================
+# ESCÁNER DE LLAVES BALANCEADAS (una pasada)
+# ============================================================
+def escanear_json(texto: str, inicio: int) -> Tuple[Optional[int], List[str]]:
+    """
+    Desde `texto[inicio]` ('{' o '[') busca el cierre balanceado respetando
+    cadenas y escapes. Devuelve (índice del cierre, []) o (None, pila de
+    aperturas sin cerrar) si el texto termina antes (respuesta truncada).
+    """
+    pila: List[str] = []
+    en_cadena = False
+    saltar_hasta = -1
+    for m in _RE_ESTRUCTURA.finditer(texto, inicio):
+        i = m.start()
+        if i < saltar_hasta:
+            continue
+        c = m.group()
+        if en_cadena:
+            if c == "\\":
+                saltar_hasta = i + 2
+            elif c == '"':
+                en_cadena = False
+            continue
+        if c == '"':
+            en_cadena = True
+        elif c in "{[":
+            pila.append(c)
+        elif c in "}]":
+            if pila:
+                pila.pop()
+            if not pila:
+                return i, []
+    return None, pila
+
+
+# ============================================================
+# REPARACIÓN LOCAL
+# ============================================================
+def _quitar_coma_final(salida: List[str]):
+    j = len(salida) - 1
+    while j >= 0 and salida[j].isspace():
+        j -= 1
+    if j >= 0 and salida[j] == ",":
+        del salida[j]
+
+
+def _ultimo_no_blanco(salida: List[str]) -> str:
+    for c in reversed(salida):
+        if not c.isspace():
+            return c
+    return ""
+
+
+def reparar_json(texto: str) -> str:
+    """
+    Arreglos locales de los errores típicos del LLM, sin volver a llamarlo:
+    comas finales, comillas tipográficas como delimitadores, saltos de línea
+    y tabs sin escapar dentro de cadenas, y cierres faltantes por truncamiento.
+    """
+    salida: List[str] = []
+    pila: List[str] = []
+    en_cadena = False
+    tipografica = False
+    escape = False
+    for c in texto:
+        if en_cadena:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif (c == '"' and not tipografica) or (tipografica and c in _COMILLAS_TIPOGRAFICAS):
+                en_cadena = False
+                c = '"'
+            elif tipografica and c == '"':
+                c = '\\"'
+            elif c == "\n":
+                c = "\\n"
+            elif c == "\r":
+                c = "\\r"
+            elif c == "\t":
+                c = "\\t"
+            elif ord(c) < 0x20:
+                c = f"\\u{ord(c):04x}"
+            salida.append(c)
+            continue
+        if c == '"' or c in _COMILLAS_TIPOGRAFICAS:
+            en_cadena = True
+            tipografica = c != '"'
+            c = '"'
+        elif c in "{[":
+            pila.append(c)
+        elif c in "}]":
+            _quitar_coma_final(salida)
+            if pila:
+                pila.pop()
+        salida.append(c)
+
+    # Truncado: cerrar cadena, completar valor pendiente y cerrar estructuras
+    if escape:
+        salida.pop()
+    if en_cadena:
+        salida.append('"')
+    if pila:
+        if _ultimo_no_blanco(salida) == ":":
+            salida.append("null")
+        for abierto in reversed(pila):
+            _quitar_coma_final(salida)
+            salida.append("}" if abierto == "{" else "]")
+    return "".join(salida)
+
+
+# ============================================================
+# EXTRACCIÓN
+# ============================================================
+def extraer_json(
+        texto: Any, etapa: Optional[str] = None, medir: bool = True
+) -> Tuple[Optional[Any], Optional[Exception]]:
+    """
+    Extrae el JSON de la respuesta del LLM. Devuelve (objeto, None) o
+    (None, error). Caminos, de más barato a más caro (cada uno con su contador):
+      - directo:  la respuesta ya es JSON.
+      - escaneo:  sin fences, el primer objeto/array balanceado del texto.
+      - reparado: el candidato tras `reparar_json`.
+    Si todo falla, recién ahí vale la pena pedirle al LLM que corrija.
+    `medir=False` no toca los contadores (chequeos internos, p. ej. la cache).
+    """
+    registrar = registrar_parseo_json if medir else (lambda camino, etapa=None: None)
+    if texto is None:
+        registrar("fallido", etapa)
+        return None, ValueError("Empty response")
+    if not isinstance(texto, str):
+        texto = str(texto)
+
+    t = texto.strip()
+    if t[:1] in ("{", "["):
+        try:
+            valor = cargar_json(t)
+            registrar("directo", etapa)
+            return valor, None
+        except ValueError:
+            pass
+
+    t = quitar_fences(t)
+    error: Exception = ValueError("No se encontró un objeto JSON en la respuesta")
+    candidatos: List[str] = []
+    # Candidatos de nivel superior: tras uno fallido se sigue después de su cierre
+    # (nunca dentro de él, o se devolvería un objeto anidado como si fuera el todo)
+    m = _RE_APERTURA.search(t)
+    while m is not None and len(candidatos) < _MAX_CANDIDATOS:
+        fin, _ = escanear_json(t, m.start())
+        candidato = t[m.start():fin + 1] if fin is not None else t[m.start():]
+        try:
+            valor = cargar_json(candidato)
+            registrar("escaneo", etapa)
+            return valor, None
+        except ValueError as e:
+            if not candidatos:
+                error = e  # el error del candidato principal es el más útil para diagnosticar
+            candidatos.append(candidato)
+        if fin is None:
+            break
+        m = _RE_APERTURA.search(t, fin + 1)
+
+    for candidato in candidatos:
+        try:
+            valor = cargar_json(reparar_json(candidato))
+            registrar("reparado", etapa)
+            return valor, None
+        except ValueError:
+            continue
+
+    registrar("fallido", etapa)
+    return None, error
@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from langchain_core.messages import AIMessage
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+
+
+# ============================================================
+# CLAVE DE CACHE (contenido direccionable)
+# ============================================================
+def clave_cache(mensajes: Any, parametros_modelo: Optional[Dict[str, Any]] = None, **kwargs) -> str:
+    """
+    SHA-256 del texto de los prompts, los parámetros del modelo y los bytes
+    de los bloques multimedia. Los bytes se hashean directamente (sin base64).
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(parametros_modelo or {}, sort_keys=True, default=str).encode("utf-8"))
+    h.update(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8"))
+
+    for msg in mensajes if isinstance(mensajes, (list, tuple)) else [mensajes]:
+        h.update(b"\x00" + type(msg).__name__.encode("utf-8") + b"\x00")
+        contenido = getattr(msg, "content", msg)
+        bloques = contenido if isinstance(contenido, list) else [contenido]
+        for bloque in bloques:
+            if isinstance(bloque, dict):
+                data = bloque.get("data")
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    h.update(b"\x01" + str(bloque.get("mime_type", "")).encode("utf-8") + b"\x01")
+                    h.update(data)
+                else:
+                    h.update(json.dumps(bloque, sort_keys=True, default=str).encode("utf-8"))
+            elif isinstance(bloque, (bytes, bytearray)):
+                h.update(bloque)
+            else:
+                h.update(str(bloque).encode("utf-8"))
+    return h.hexdigest()
+
+
+# ============================================================
+# CACHE EN DOS NIVELES: LRU EN MEMORIA + DISCO
+# ============================================================
+class LlmResultCache:
+    """
+    Cache de respuestas LLM con un nivel LRU en memoria (límite por número de
+    entradas) y un nivel en disco (límite por tamaño total). Ambos niveles
+    expiran entradas por TTL.
+    """
+
+    def __init__(
+            self,
+            directorio: Optional[str] = None,
+            max_entradas_memoria: int = 256,
+            max_bytes_disco: int = 512 * 1024 * 1024,
+            ttl_segundos: float = 72 * 3600,
+    ):
+        self.max_entradas_memoria = max_entradas_memoria
+        self.max_bytes_disco = max_bytes_disco
+        self.ttl_segundos = ttl_segundos
+        self.directorio = Path(directorio) if directorio else None
+
+        self._memoria: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes_disco = 0
+        self.stats: Dict[str, int] = {
+            "hits_memoria": 0,
+            "hits_disco": 0,
+            "misses": 0,
+            "bypass": 0,
+            "escrituras": 0,
+            "evicciones_memoria": 0,
+            "evicciones_disco": 0,
+            "expiradas": 0,
+            "invalidadas": 0,
+            "rechazadas": 0,
+        }
+
+        if self.directorio:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            self._bytes_disco = sum(p.stat().st_size for p in self.directorio.glob("*/*.json"))
+
+    # ---------------- utilidades internas ----------------
+    def _ruta(self, clave: str) -> Path:
+        return self.directorio / clave[:2] / f"{clave}.json"
+
+    def _expirada(self, creado: float) -> bool:
+        return self.ttl_segundos > 0 and (time.time() - creado) > self.ttl_segundos
+
+    def _guardar_memoria(self, clave: str, creado: float, contenido: str):
+        self._memoria[clave] = (creado, contenido)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_entradas_memoria:
+            self._memoria.popitem(last=False)
+            self.stats["evicciones_memoria"] += 1
+
+    def _borrar_disco(self, ruta: Path):
+        try:
+            tam = ruta.stat().st_size
+            ruta.unlink()
+            self._bytes_disco -= tam
+        except FileNotFoundError:
+            pass
+
+    def _evictar_disco(self):
+        if self._bytes_disco <= self.max_bytes_disco:
+            return
+        archivos = sorted(self.directorio.glob("*/*.json"), key=lambda p: p.stat().st_mtime)
+        for ruta in archivos:
+            if self._bytes_disco <= self.max_bytes_disco:
+                break
+            self._borrar_disco(ruta)
+            self.stats["evicciones_disco"] += 1
+
+    def _invalidar(self, clave: str):
+        self._memoria.pop(clave, None)
+        if self.directorio:
+            self._borrar_disco(self._ruta(clave))
+        self.stats["invalidadas"] += 1
+
+    # ---------------- API pública ----------------
+    def get(self, clave: str, valida: Optional[Callable[[str], bool]] = None) -> Optional[str]:
+        """
+        Contenido cacheado para `clave`, o None. Con `valida`, una entrada que
+        no la pasa se invalida y cuenta como miss.
+        """
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                creado, contenido = entrada
+                if self._expirada(creado):
+                    self._memoria.pop(clave, None)
+                    self.stats["expiradas"] += 1
+                elif valida is not None and not valida(contenido):
+                    self._invalidar(clave)
+                    self.stats["misses"] += 1
+                    return None
+                else:
+                    self._memoria.move_to_end(clave)
+                    self.stats["hits_memoria"] += 1
+                    return contenido
+
+            if self.directorio:
+                ruta = self._ruta(clave)
+                if ruta.exists():
+                    try:
+                        registro = json.loads(ruta.read_text(encoding="utf-8"))
+                    except Exception as e:
+                        logging.warning(f"⚠️ Entrada de cache corrupta '{ruta}': {e}")
+                        self._borrar_disco(ruta)
+                        registro = None
+                    if registro is not None:
+                        if self._expirada(registro["creado"]):
+                            self._borrar_disco(ruta)
+                            self.stats["expiradas"] += 1
+                        elif valida is not None and not valida(registro["contenido"]):
+                            self._invalidar(clave)
+                        else:
+                            self._guardar_memoria(clave, registro["creado"], registro["contenido"])
+                            self.stats["hits_disco"] += 1
+                            return registro["contenido"]
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, clave: str, contenido: str):
+        creado = time.time()
+        with self._lock:
+            self._guardar_memoria(clave, creado, contenido)
+            self.stats["escrituras"] += 1
+            if not self.directorio:
+                return
+            ruta = self._ruta(clave)
+            ruta.parent.mkdir(parents=True, exist_ok=True)
+            tmp = ruta.with_suffix(".tmp")
+            try:
+                data = json.dumps({"creado": creado, "contenido": contenido}, ensure_ascii=False)
+                tmp.write_text(data, encoding="utf-8")
+                self._borrar_disco(ruta)
+                os.replace(tmp, ruta)
+                self._bytes_disco += ruta.stat().st_size
+                self._evictar_disco()
+            except Exception as e:
+                logging.warning(f"⚠️ No se pudo escribir cache en disco '{ruta}': {e}")
+
+    def invalidar(self, clave: str):
+        """Borra la entrada (memoria y disco), p. ej. si resultó no ser válida."""
+        with self._lock:
+            self._invalidar(clave)
+
+    def registrar_rechazo(self):
+        with self._lock:
+            self.stats["rechazadas"] += 1
+
+    def registrar_bypass(self):
+        with self._lock:
+            self.stats["bypass"] += 1
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.stats["hits_memoria"] + self.stats["hits_disco"]
+            consultas = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_ratio": round(hits / consultas, 4) if consultas else 0.0,
+                "entradas_memoria": len(self._memoria),
+                "bytes_disco": self._bytes_disco,
+            }
+
+
+# ============================================================
+# WRAPPER DEL LLM
+# ============================================================
+# Chequeo del contenido antes de guardarlo / servirlo desde cache; lo fija
+# quien sabe validar la respuesta (p. ej. `invocar_estructurado` por etapa)
+VALIDADOR_RESPUESTA: contextvars.ContextVar[Optional[Callable[[str], bool]]] = contextvars.ContextVar(
+    "validador_respuesta_cache", default=None
+)
+
+
+@contextmanager
+def validar_antes_de_cachear(valida: Optional[Callable[[str], bool]]) -> Iterator[None]:
+    """Dentro del bloque solo se cachean (y se sirven) respuestas que pasan `valida`."""
+    token = VALIDADOR_RESPUESTA.set(valida)
+    try:
+        yield
+    finally:
+        VALIDADOR_RESPUESTA.reset(token)
+
+
+def _segura(valida: Callable[[str], bool]) -> Callable[[str], bool]:
+    def _fn(contenido: str) -> bool:
+        try:
+            return bool(valida(contenido))
+        except Exception:
+            return False
+    return _fn
+
+
+class CachedLLM:
+    """
+    Envuelve un chat model de LangChain y cachea `invoke` por contenido.
+    Solo se cachean respuestas exitosas con contenido de texto que, si hay un
+    validador activo (`validar_antes_de_cachear`), además lo pasan.
+    """
+
+    def __init__(self, llm, cache: LlmResultCache, parametros_modelo: Optional[Dict[str, Any]] = None,
+                 bypass: bool = False):
+        self.llm = llm
+        self.cache = cache
+        self.parametros_modelo = parametros_modelo or {}
+        self.bypass = bypass
+
+    def sin_cache(self) -> "CachedLLM":
+        """Vista del mismo LLM que ignora la cache (bypass por request)."""
+        return CachedLLM(self.llm, self.cache, self.parametros_modelo, bypass=True)
+
+    def invoke(self, mensajes, **kwargs):
+        if self.bypass:
+            self.cache.registrar_bypass()
+            return self.llm.invoke(mensajes, **kwargs)
+
+        valida = VALIDADOR_RESPUESTA.get()
+        valida = _segura(valida) if valida is not None else None
+        clave = clave_cache(mensajes, self.parametros_modelo, **kwargs)
+        contenido = self.cache.get(clave, valida)
+        if contenido is not None:
+            logging.info(f"⚡ Respuesta LLM servida desde cache ({clave[:12]})")
+            return AIMessage(content=contenido, response_metadata={"cache": "hit"})
+
+        respuesta = self.llm.invoke(mensajes, **kwargs)
+        contenido = getattr(respuesta, "content", None)
+        if isinstance(contenido, str) and contenido.strip():
+            if valida is None or valida(contenido):
+                self.cache.set(clave, contenido)
+            else:
+                # La etapa va a rechazarla: cachearla repetiría el mismo fallo en la próxima ejecución
+                self.cache.registrar_rechazo()
+        return respuesta
+
+    def __getattr__(self, item):
+        return getattr(self.llm, item)
+
+
+# ============================================================
+# CACHE COMPARTIDA DEL PROCESO
+# ============================================================
+_cache_global: Optional[LlmResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def obtener_cache() -> Optional[LlmResultCache]:
+    """
+    Devuelve la cache compartida configurada en `pipeline_parameters.json`
+    (sección `llm_cache`), o None si está deshabilitada.
+    """
+    global _cache_global
+    with _cache_lock:
+        if _cache_global is None:
+            cfg = load_pipeline_parameters("llm_cache")
+            if not cfg.get("habilitado", True):
+                return None
+            directorio = (
+                os.environ.get("LLM_CACHE_DIR")
+                or cfg.get("directorio")
+                or str(Path(os.environ.get("WORKDIR", "/tmp/motor_resp")) / "llm_cache")
+            )
+            _cache_global = LlmResultCache(
+                directorio=directorio,
+                max_entradas_memoria=int(cfg.get("max_entradas_memoria", 256)),
+                max_bytes_disco=int(float(cfg.get("max_mb_disco", 512)) * 1024 * 1024),
+                ttl_segundos=float(cfg.get("ttl_horas", 72)) * 3600,
+            )
+            logging.info(f"🗄️ Cache LLM inicializada en '{directorio}'")
+        return _cache_global
+
+
+def envolver_con_cache(llm, parametros_modelo: Optional[Dict[str, Any]] = None):
+    """Envuelve `llm` con la cache compartida (si está habilitada)."""
+    cache = obtener_cache()
+    if cache is None:
+        return llm
+    return CachedLLM(llm, cache, parametros_modelo)
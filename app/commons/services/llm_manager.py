@@ -1,51 +1,109 @@
 import os
 import logging
+import threading
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional
+
 from ia_transversal_langchain_python_lib.llm.llm_middleware import LlmMiddleware
-from app.commons.services.miscelaneous import load_llm_parameters
+from app.commons.services.miscelaneous import load_all_llm_parameters
+from app.commons.services.llm_cache import envolver_con_cache
+from app.commons.services.rate_limiter import envolver_con_limitador
+from app.commons.services.hedging import envolver_con_hedging
+from app.commons.services.context_cache import envolver_con_context_cache
+from app.commons.services.metrics import envolver_con_metricas
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 
-def load_llms():
-    """Inicializa y devuelve los modelos LLM configurados."""
-
-    middleware = LlmMiddleware()
-
-    modelos = {
-        "gpt": {
-            "config": load_llm_parameters("gpt-4o-mini").get("model_config", {}),
-            "params": load_llm_parameters("gpt-4o-mini").get("model_parameters", {})
-        },
-        "gemini_pro": {
-            "config": load_llm_parameters("gemini-1.5-pro").get("model_config", {}),
-            "params": load_llm_parameters("gemini-1.5-pro").get("model_parameters", {})
-        },
-        "gemini_flash": {
-            "config": load_llm_parameters("gemini-1.5-flash").get("model_config", {}),
-            "params": load_llm_parameters("gemini-1.5-flash").get("model_parameters", {})
-        }
-    }
-
-    llms = {
-        "gpt": middleware.get_chat(
-            platform=modelos["gpt"]["config"]["plataform"],
-            provider=modelos["gpt"]["config"]["provider"],
-            model_name=modelos["gpt"]["config"]["model_name"],
-            model_parameters=modelos["gpt"]["params"]
-        ),
-        "gemini_pro": middleware.get_chat(
-            platform=modelos["gemini_pro"]["config"]["plataform"],
-            provider=modelos["gemini_pro"]["config"]["provider"],
-            model_name=modelos["gemini_pro"]["config"]["model_name"],
-            model_parameters=modelos["gemini_pro"]["params"]
-        ),
-        "gemini_flash": middleware.get_chat(
-            platform=modelos["gemini_flash"]["config"]["plataform"],
-            provider=modelos["gemini_flash"]["config"]["provider"],
-            model_name=modelos["gemini_flash"]["config"]["model_name"],
-            model_parameters=modelos["gemini_flash"]["params"]
+# Nombre lógico del modelo -> clave en llm_parameters.json
+MODELOS: Dict[str, str] = {
+    "gpt": "gpt-4o-mini",
+    "gemini_pro": "gemini-1.5-pro",
+    "gemini_flash": "gemini-1.5-flash",
+}
+
+
+class ModelRegistry(Mapping):
+    """
+    Registro perezoso de modelos: `llm_parameters.json` se parsea una sola vez
+    y cada cliente se construye en su primer uso. Es seguro entre hilos y se
+    comporta como el dict que devolvía `load_llms()` (`llms["gemini_pro"]`,
+    `llms.get(...)`).
+    """
+
+    def __init__(self, modelos: Optional[Dict[str, str]] = None):
+        self._modelos = dict(modelos or MODELOS)
+        parametros = load_all_llm_parameters()
+        self._config: Dict[str, Dict[str, Any]] = {}
+        for nombre, clave in self._modelos.items():
+            entrada = parametros.get(clave, {})
+            self._config[nombre] = {
+                "config": entrada.get("model_config", {}),
+                "params": entrada.get("model_parameters", {}),
+            }
+        self._clientes: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {n: threading.Lock() for n in self._modelos}
+        self._middleware = None
+        self._middleware_lock = threading.Lock()
+
+    def _get_middleware(self):
+        if self._middleware is None:
+            with self._middleware_lock:
+                if self._middleware is None:
+                    self._middleware = LlmMiddleware()
+        return self._middleware
+
+    def _construir(self, nombre: str):
+        # Orden: cache → context cache → hedging → limitador → métricas → cliente. Los hits de cache no
+        # consumen cuota, los duplicados del hedging sí pasan por el limitador y las métricas ven cada
+        # llamada real al proveedor (incluidos reintentos por 429).
+        config = self._config[nombre]["config"]
+        params = self._config[nombre]["params"]
+        llm = self._get_middleware().get_chat(
+            platform=config["plataform"],
+            provider=config["provider"],
+            model_name=config["model_name"],
+            model_parameters=params,
         )
-    }
+        llm = envolver_con_metricas(llm, self._modelos[nombre])
+        llm = envolver_con_limitador(llm, self._modelos[nombre])
+        llm = envolver_con_hedging(llm, self._modelos[nombre])
+        llm = envolver_con_context_cache(llm, self._modelos[nombre])
+        # Cache por contenido delante del modelo (clave incluye sus parámetros)
+        return envolver_con_cache(llm, {**config, **params})
+
+    def __getitem__(self, nombre: str):
+        if nombre not in self._modelos:
+            raise KeyError(nombre)
+        cliente = self._clientes.get(nombre)
+        if cliente is not None:
+            return cliente
+        with self._locks[nombre]:
+            if nombre not in self._clientes:
+                self._clientes[nombre] = self._construir(nombre)
+                logging.info(f"✅ Modelo '{nombre}' inicializado")
+            return self._clientes[nombre]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._modelos)
+
+    def __len__(self) -> int:
+        return len(self._modelos)
+
+    def warm_models(self) -> List[str]:
+        """Modelos cuyo cliente ya fue construido."""
+        return [n for n in self._modelos if n in self._clientes]
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
 
-    logging.info("✅ Modelos cargados desde llm_manager.py")
-    return llms
+def load_llms() -> ModelRegistry:
+    """Devuelve el registro (compartido) de modelos LLM configurados."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+            logging.info("✅ Registro de modelos listo en llm_manager.py (carga perezosa)")
+        return _registry
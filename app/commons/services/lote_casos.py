@@ -0,0 +1,174 @@
+import json
+import zipfile
+import logging
+from pathlib import Path, PurePosixPath
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.upload_stream import UploadRechazado, firma_valida, limite_bytes
+
+# Campo del manifiesto -> extensiones aceptadas
+EXTENSIONES_CAMPO = {
+    "visual_pdf": {".pdf"},
+    "ficha_png": {".png"},
+    "audio": {".mp3", ".wav", ".m4a", ".ogg"},
+}
+
+NOMBRE_MANIFIESTO = "manifest.json"
+
+
+@dataclass
+class CasoLote:
+    case_id: str
+    archivos: Dict[str, str]  # campo -> nombre (en el multipart) o ruta relativa (en el zip)
+
+
+def config_lotes() -> Dict[str, Any]:
+    return load_pipeline_parameters("lotes")
+
+
+def _error(detalle: str) -> UploadRechazado:
+    return UploadRechazado(400, detalle)
+
+
+def case_id_valido(case_id: str) -> bool:
+    # Se usa en nombres de archivo y carpetas de salida
+    return bool(case_id) and "/" not in case_id and "\\" not in case_id and case_id not in (".", "..")
+
+
+# =========================
+# Manifiesto
+# =========================
+def parsear_manifiesto(texto: str) -> List[CasoLote]:
+    """
+    Manifiesto JSON: lista (o `{"casos": [...]}`) de objetos
+    `{"case_id": ..., "visual_pdf": ..., "ficha_png": ..., "audio": ...}`
+    donde cada campo es el nombre del archivo dentro del lote.
+    """
+    try:
+        data = json.loads(texto)
+    except json.JSONDecodeError as e:
+        raise _error(f"Manifiesto JSON inválido: {e}")
+    if isinstance(data, dict):
+        data = data.get("casos")
+    if not isinstance(data, list) or not data:
+        raise _error("El manifiesto debe ser una lista no vacía de casos.")
+
+    casos: List[CasoLote] = []
+    vistos = set()
+    for i, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise _error(f"Caso {i} del manifiesto no es un objeto.")
+        case_id = str(item.get("case_id") or "").strip()
+        if not case_id_valido(case_id):
+            raise _error(f"Caso {i}: 'case_id' vacío o inválido.")
+        if case_id in vistos:
+            raise _error(f"case_id duplicado en el manifiesto: {case_id}")
+        vistos.add(case_id)
+
+        archivos = {}
+        for campo, extensiones in EXTENSIONES_CAMPO.items():
+            nombre = item.get(campo)
+            if not nombre:
+                raise _error(f"Caso '{case_id}': falta '{campo}'.")
+            if Path(nombre).suffix.lower() not in extensiones:
+                raise _error(f"Caso '{case_id}': '{campo}' debe ser {sorted(extensiones)}.")
+            archivos[campo] = str(nombre)
+        casos.append(CasoLote(case_id=case_id, archivos=archivos))
+    return _validar_cantidad(casos)
+
+
+def _validar_cantidad(casos: List[CasoLote]) -> List[CasoLote]:
+    max_casos = int(config_lotes().get("max_casos", 50))
+    if len(casos) > max_casos:
+        raise UploadRechazado(413, f"El lote tiene {len(casos)} casos; el máximo es {max_casos}.")
+    return casos
+
+
+def _inferir_casos_por_carpeta(nombres: List[str]) -> List[CasoLote]:
+    """Sin manifiesto: cada carpeta de primer nivel es un caso con un pdf, un png y un audio."""
+    por_carpeta: Dict[str, Dict[str, List[str]]] = {}
+    for nombre in nombres:
+        partes = PurePosixPath(nombre).parts
+        if len(partes) != 2:
+            continue
+        ext = PurePosixPath(nombre).suffix.lower()
+        for campo, extensiones in EXTENSIONES_CAMPO.items():
+            if ext in extensiones:
+                por_carpeta.setdefault(partes[0], {}).setdefault(campo, []).append(nombre)
+
+    casos = []
+    for carpeta, encontrados in sorted(por_carpeta.items()):
+        if not case_id_valido(carpeta):
+            raise _error(f"Carpeta inválida en el zip: '{carpeta}'.")
+        for campo in EXTENSIONES_CAMPO:
+            if len(encontrados.get(campo, [])) != 1:
+                raise _error(f"Carpeta '{carpeta}' del zip: se esperaba exactamente un archivo para '{campo}'.")
+        casos.append(CasoLote(case_id=carpeta, archivos={c: v[0] for c, v in encontrados.items()}))
+    return _validar_cantidad(casos)
+
+
+# =========================
+# Zip
+# =========================
+def extraer_zip_lote(ruta_zip: Path, destino: Path) -> Dict[str, Dict[str, Path]]:
+    """
+    Extrae un lote en zip a `destino`. Usa `manifest.json` de la raíz si existe;
+    si no, infiere los casos por carpeta. Valida tamaños declarados antes de
+    extraer (anti zip-bomb) y magic bytes; las rutas de destino se construyen
+    a partir del case_id, nunca con las rutas internas del zip.
+
+    Devuelve `{case_id: {campo: ruta_extraida}}` en el orden del lote.
+    """
+    cfg = config_lotes()
+    max_descomprimido = int(float(cfg.get("max_mb_descomprimido", 1024)) * 1024 * 1024)
+
+    try:
+        zf = zipfile.ZipFile(ruta_zip)
+    except zipfile.BadZipFile:
+        raise _error("El archivo del lote no es un zip válido.")
+
+    with zf:
+        miembros = {i.filename: i for i in zf.infolist() if not i.is_dir()}
+        if sum(i.file_size for i in miembros.values()) > max_descomprimido:
+            raise UploadRechazado(413, "El zip descomprimido supera el máximo permitido.")
+
+        if NOMBRE_MANIFIESTO in miembros:
+            casos = parsear_manifiesto(zf.read(NOMBRE_MANIFIESTO).decode("utf-8"))
+        else:
+            casos = _inferir_casos_por_carpeta(list(miembros))
+            if not casos:
+                raise _error(f"El zip no tiene '{NOMBRE_MANIFIESTO}' ni carpetas de casos.")
+
+        rutas: Dict[str, Dict[str, Path]] = {}
+        for caso in casos:
+            rutas[caso.case_id] = {}
+            for campo, nombre in caso.archivos.items():
+                info = miembros.get(nombre)
+                if info is None:
+                    raise _error(f"Caso '{caso.case_id}': '{nombre}' no está en el zip.")
+                if info.file_size > limite_bytes(campo):
+                    raise UploadRechazado(413, f"Caso '{caso.case_id}': '{nombre}' supera el máximo para '{campo}'.")
+                ruta = destino / f"{caso.case_id}_{campo}{PurePosixPath(nombre).suffix.lower()}"
+                with zf.open(info) as src, open(ruta, "wb") as dst:
+                    cabecera = src.read(16)
+                    if not firma_valida(ruta.suffix, cabecera):
+                        raise UploadRechazado(
+                            415, f"Caso '{caso.case_id}': '{nombre}' no corresponde a un archivo {ruta.suffix}."
+                        )
+                    dst.write(cabecera)
+                    while True:
+                        bloque = src.read(1024 * 1024)
+                        if not bloque:
+                            break
+                        dst.write(bloque)
+                rutas[caso.case_id][campo] = ruta
+
+    logging.info(f"📦 Lote zip extraído: {len(rutas)} caso(s)")
+    return rutas
+
+
+def limite_bytes_lote() -> int:
+    """Máximo del cuerpo de un request de lote (reemplaza a `max_mb_request`)."""
+    return int(float(config_lotes().get("max_mb_request", 1024)) * 1024 * 1024)
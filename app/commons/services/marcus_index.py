@@ -0,0 +1,189 @@
+import json
+import math
+import re
+import logging
+import hashlib
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.matrix_loader import cargar_filas_marcus, construir_contexto_marcus
+
+_RE_PALABRA = re.compile(r"[a-z0-9ñ]+")
+
+_STOPWORDS = frozenset("""
+a al algo ante como con contra cual cuando de del desde donde durante el ella ellos en entre era es esa ese
+esta este esto fue ha hay la las le les lo los mas me mi muy no nos o otra otro para pero por que se sea ser
+si sin sobre su sus tambien te tiene un una uno unos y ya yo
+""".split())
+
+# Expresiones coloquiales de los relatos -> vocabulario de la matriz
+_SINONIMOS = {
+    "retrocedia": "reversa", "retroceso": "reversa", "reversando": "reversa", "reversaba": "reversa",
+    "alcance": "trasera", "atras": "trasera", "detras": "trasera", "posterior": "trasera",
+    "giraba": "volteaba", "giro": "volteaba", "doblaba": "volteaba", "doblo": "volteaba",
+    "parqueado": "estacionado", "parqueo": "estacionamiento", "parqueadero": "estacionamiento",
+    "aparcado": "estacionado", "quieto": "detenido", "parado": "detenido", "pare": "senal",
+    "semaforo": "senal", "adelantamiento": "adelantaba", "sobrepaso": "adelantaba", "adelanto": "adelantaba",
+    "frenado": "frenaba", "freno": "frenaba", "rotonda": "glorieta", "contramano": "contravia",
+}
+
+
+def _normalizar(texto: str) -> str:
+    texto = unicodedata.normalize("NFKD", str(texto).lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def tokenizar(texto: str) -> List[str]:
+    """Minúsculas sin tildes, sin stopwords, sinónimos y 'stemming' por prefijo de 5 letras."""
+    tokens = []
+    for palabra in _RE_PALABRA.findall(_normalizar(texto)):
+        if len(palabra) < 3 or palabra in _STOPWORDS:
+            continue
+        palabra = _SINONIMOS.get(palabra, palabra)
+        tokens.append(palabra[:5])
+    return tokens
+
+
+def _textos_de(valor: Any) -> List[str]:
+    """Solo los valores de texto de un JSON (las claves son iguales en todos los casos)."""
+    if isinstance(valor, dict):
+        return [t for v in valor.values() for t in _textos_de(v)]
+    if isinstance(valor, (list, tuple)):
+        return [t for v in valor for t in _textos_de(v)]
+    if isinstance(valor, str):
+        try:
+            return _textos_de(json.loads(valor)) if valor.lstrip()[:1] in "{[" else [valor]
+        except json.JSONDecodeError:
+            return [valor]
+    return [] if valor is None else [str(valor)]
+
+
+@dataclass
+class SeleccionMarcus:
+    contexto: str
+    ids: List[str] = field(default_factory=list)
+    completo: bool = False
+    motivo: str = ""
+    puntajes: Dict[str, float] = field(default_factory=dict)
+
+
+class IndiceMarcus:
+    """
+    Índice BM25 en memoria sobre las circunstancias de la matriz Marcus.
+    El título de la circunstancia pesa más que la descripción CESVI y el
+    fundamento legal. Se construye una vez en el arranque (15 documentos).
+
+    `str(indice)` es el contexto completo, así puede usarse donde antes se
+    pasaba el string de `cargar_matriz_marcus`.
+    """
+
+    def __init__(self, filas: List[Dict[str, str]], k1: float = 1.5, b: float = 0.75, peso_titulo: int = 3):
+        self.filas = filas
+        self.k1 = k1
+        self.b = b
+        self.contexto_completo = construir_contexto_marcus(filas)
+        self._docs: List[Counter] = []
+        for fila in filas:
+            tokens = tokenizar(fila["id"]) * peso_titulo
+            for campo in ("descripcion", "codigo"):
+                if fila.get(campo) and fila[campo] != "nan":
+                    tokens += tokenizar(fila[campo])
+            self._docs.append(Counter(tokens))
+        self._largos = [sum(d.values()) for d in self._docs]
+        self._largo_medio = (sum(self._largos) / len(self._largos)) if self._largos else 0.0
+        n = len(self._docs)
+        df = Counter(t for d in self._docs for t in d)
+        self._idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in df.items()}
+
+    @classmethod
+    def desde_excel(cls, ruta_excel: str, hoja: str = "Descripción") -> "IndiceMarcus":
+        return cls(cargar_filas_marcus(ruta_excel, hoja))
+
+    def __str__(self) -> str:
+        return self.contexto_completo
+
+    def firma(self) -> str:
+        """Hash del contexto completo + config del filtro (entra en la huella de checkpoints)."""
+        cfg = json.dumps(config_filtro(), sort_keys=True)
+        return hashlib.sha256((self.contexto_completo + cfg).encode("utf-8")).hexdigest()
+
+    def puntuar(self, consulta: str) -> List[Tuple[int, float]]:
+        """[(índice de fila, puntaje BM25)] ordenado de mayor a menor."""
+        terminos = Counter(tokenizar(consulta))
+        puntajes = []
+        for i, doc in enumerate(self._docs):
+            norma = self.k1 * (1 - self.b + self.b * self._largos[i] / (self._largo_medio or 1))
+            s = 0.0
+            for termino, qtf in terminos.items():
+                tf = doc.get(termino)
+                if tf:
+                    # Peso sublineal del término en la consulta: relatos largos repiten mucho
+                    s += self._idf[termino] * (tf * (self.k1 + 1)) / (tf + norma) * (1 + math.log(qtf))
+            puntajes.append((i, s))
+        return sorted(puntajes, key=lambda x: x[1], reverse=True)
+
+    def seleccionar(self, *hechos: Any, **overrides) -> SeleccionMarcus:
+        """
+        Top-k circunstancias para los hechos del caso (JSON visual, transcripción...).
+        Si la confianza es baja (puntaje máximo bajo o relevancia muy repartida
+        entre todas las circunstancias) devuelve la matriz completa.
+        """
+        cfg = {**config_filtro(), **overrides}
+        if not cfg.get("habilitado", True):
+            return SeleccionMarcus(self.contexto_completo, completo=True, motivo="filtro deshabilitado")
+
+        consulta = " ".join(t for h in hechos for t in _textos_de(h))
+        ranking = self.puntuar(consulta)
+        top_k = int(cfg.get("top_k", 6))
+        elegidos = [(i, s) for i, s in ranking[:top_k] if s > 0]
+        puntajes = {self.filas[i]["id"].split(":")[0]: round(s, 3) for i, s in ranking}
+
+        masa = sum(s for _, s in ranking)
+        cobertura = (sum(s for _, s in elegidos) / masa) if masa else 0.0
+        motivo = ""
+        if len(tokenizar(consulta)) < int(cfg.get("min_terminos_consulta", 8)):
+            motivo = "hechos insuficientes"
+        elif not elegidos or elegidos[0][1] < float(cfg.get("puntaje_minimo", 2.0)):
+            motivo = "puntaje máximo bajo"
+        elif cobertura < float(cfg.get("cobertura_minima", 0.6)):
+            motivo = f"relevancia repartida (cobertura {cobertura:.2f})"
+        if motivo:
+            return SeleccionMarcus(self.contexto_completo, completo=True, motivo=motivo, puntajes=puntajes)
+
+        # Se conserva el orden original de la matriz (C1..C15)
+        filas = [self.filas[i] for i in sorted(i for i, _ in elegidos)]
+        encabezado = (
+            f"Estas son las {len(filas)} circunstancias Marcus (de {len(self.filas)}) más relevantes "
+            "para este caso, con su justificación legal y técnica:\n\n"
+        )
+        return SeleccionMarcus(
+            contexto=construir_contexto_marcus(filas, encabezado=encabezado),
+            ids=[f["id"].split(":")[0] for f in filas],
+            motivo=f"top-{top_k} (cobertura {cobertura:.2f})",
+            puntajes=puntajes,
+        )
+
+
+def config_filtro() -> Dict[str, Any]:
+    return load_pipeline_parameters("marcus_filtro")
+
+
+def contexto_para_caso(contexto_marcus: Any, *hechos: Any) -> str:
+    """
+    Contexto Marcus a enviar al LLM: filtrado si se recibe un `IndiceMarcus`,
+    o el string tal cual (compatibilidad con quien pase el contexto completo).
+    """
+    if not isinstance(contexto_marcus, IndiceMarcus):
+        return contexto_marcus
+    seleccion = contexto_marcus.seleccionar(*hechos)
+    if seleccion.completo:
+        logging.info(f"📚 Contexto Marcus completo ({seleccion.motivo})")
+    else:
+        logging.info(
+            f"📚 Contexto Marcus filtrado: {seleccion.ids} | {len(seleccion.contexto)} vs "
+            f"{len(contexto_marcus.contexto_completo)} caracteres ({seleccion.motivo})"
+        )
+    return seleccion.contexto
@@ -1,32 +1,149 @@
-import pandas as pd
+import os
+import sys
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Versión del formato del artefacto compilado; subirla invalida los existentes
+VERSION_ARTEFACTO = 1
+
+# Encabezado en el Excel -> campo del artefacto
+COLUMNAS = {
+    "CIRCUNSTANCIAS": "id",
+    "CODIGO NACIONAL DE TRANSITO": "codigo",
+    "DESCRIPCION CESVI": "descripcion",
+}
+
+
+def _sha256_archivo(ruta: str) -> str:
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def ruta_artefacto(ruta_excel: str) -> Path:
+    """Artefacto junto al Excel (`<nombre>.compilado.json`) o en env `MARCUS_ARTEFACTO`."""
+    if os.environ.get("MARCUS_ARTEFACTO"):
+        return Path(os.environ["MARCUS_ARTEFACTO"])
+    ruta = Path(ruta_excel)
+    return ruta.with_name(f"{ruta.stem}.compilado.json")
+
+
+# ============================================================
+# COMPILACIÓN (xlsx -> JSON), solo con openpyxl
+# ============================================================
+def _celda(valor: Any) -> str:
+    # Celdas vacías como "nan": mismo texto que generaba la versión con pandas,
+    # así el contexto (y las claves de cache del LLM) no cambian.
+    return "nan" if valor is None else str(valor)
+
+
+def compilar_matriz_marcus(ruta_excel: str, hoja: str = "Descripción") -> Dict[str, Any]:
+    """Lee la hoja con openpyxl (modo solo lectura) y devuelve el artefacto como dict."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(ruta_excel, read_only=True, data_only=True)
+    try:
+        filas_excel = wb[hoja].iter_rows(values_only=True)
+        encabezados = [str(c).strip() if c is not None else "" for c in next(filas_excel, ())]
+        indices = {campo: encabezados.index(col) for col, campo in COLUMNAS.items() if col in encabezados}
+        if len(indices) != len(COLUMNAS):
+            raise ValueError(
+                "La hoja debe contener las columnas 'CIRCUNSTANCIAS', 'CÓDIGO NACIONAL DE TRÁNSITO' y 'DESCRIPCION CESVI'."
+            )
+        filas: List[Dict[str, str]] = []
+        for fila in filas_excel:
+            if fila is None or all(v is None for v in fila):
+                continue
+            filas.append({
+                campo: _celda(fila[i] if i < len(fila) else None) for campo, i in indices.items()
+            })
+    finally:
+        wb.close()
+
+    return {
+        "version": VERSION_ARTEFACTO,
+        "sha256_xlsx": _sha256_archivo(ruta_excel),
+        "hoja": hoja,
+        "filas": filas,
+    }
+
+
+def guardar_artefacto(artefacto: Dict[str, Any], destino: Path) -> bool:
+    """Escritura atómica; devuelve False si el destino no es escribible (imagen de solo lectura)."""
+    tmp = destino.with_suffix(".tmp")
+    try:
+        tmp.write_text(json.dumps(artefacto, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, destino)
+        return True
+    except OSError as e:
+        logging.warning(f"⚠️ No se pudo guardar el artefacto Marcus en '{destino}': {e}")
+        return False
+
+
+# ============================================================
+# CARGA (sin pandas)
+# ============================================================
+def _leer_artefacto(destino: Path, sha256_xlsx: str, hoja: str) -> Optional[Dict[str, Any]]:
+    try:
+        artefacto = json.loads(destino.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    vigente = (
+        artefacto.get("version") == VERSION_ARTEFACTO
+        and artefacto.get("sha256_xlsx") == sha256_xlsx
+        and artefacto.get("hoja") == hoja
+    )
+    return artefacto if vigente else None
+
+
+def cargar_filas_marcus(ruta_excel: str, hoja: str = "Descripción") -> List[Dict[str, str]]:
+    """
+    Filas de la matriz desde el artefacto compilado. Si no existe o fue
+    generado desde otra versión del Excel (hash distinto), se recompila y se
+    intenta guardar para el próximo arranque.
+    """
+    destino = ruta_artefacto(ruta_excel)
+    artefacto = _leer_artefacto(destino, _sha256_archivo(ruta_excel), hoja)
+    if artefacto is None:
+        logging.info(f"🛠️ Artefacto Marcus ausente o desactualizado; compilando '{ruta_excel}'")
+        artefacto = compilar_matriz_marcus(ruta_excel, hoja)
+        guardar_artefacto(artefacto, destino)
+    return artefacto["filas"]
+
+
+ENCABEZADO_CONTEXTO = "Estas son las 15 circunstancias definidas por Marcus, con su justificación legal y técnica:\n\n"
+
+
+def construir_contexto_marcus(filas: List[Dict[str, str]], encabezado: str = ENCABEZADO_CONTEXTO) -> str:
+    partes = [encabezado]
+    partes.extend(
+        f"{fila['id']}:\n"
+        f"- Descripción CESVI: {fila['descripcion']}\n"
+        f"- Fundamento legal (Código Nacional de Tránsito): {fila['codigo']}\n\n"
+        for fila in filas
+    )
+    return "".join(partes).strip()
+
 
 def cargar_matriz_marcus(ruta_excel: str, hoja: str = "Descripción") -> str:
     """
     Carga la hoja de circunstancias del Excel de Marcus y genera un string legible como contexto para el LLM.
     Incluye también el Código Nacional de Tránsito como parte del razonamiento normativo.
     """
+    return construir_contexto_marcus(cargar_filas_marcus(ruta_excel, hoja))
+
 
-    # Leer la hoja
-    df = pd.read_excel(ruta_excel, sheet_name=hoja)
-
-    # Renombrar columnas para estandarizar
-    df = df.rename(columns={
-        "CIRCUNSTANCIAS": "id",
-        "CODIGO NACIONAL DE TRANSITO": "codigo",
-        "DESCRIPCION CESVI": "descripcion"
-    })
-
-    # Validación
-    if not {"id", "codigo", "descripcion"}.issubset(df.columns):
-        raise ValueError("La hoja debe contener las columnas 'CIRCUNSTANCIAS', 'CÓDIGO NACIONAL DE TRÁNSITO' y 'DESCRIPCION CESVI'.")
-
-    # Crear texto de contexto
-    texto_contexto = "Estas son las 15 circunstancias definidas por Marcus, con su justificación legal y técnica:\n\n"
-    for _, fila in df.iterrows():
-        texto_contexto += (
-            f"{fila['id']}:\n"
-            f"- Descripción CESVI: {fila['descripcion']}\n"
-            f"- Fundamento legal (Código Nacional de Tránsito): {fila['codigo']}\n\n"
-        )
-
-    return texto_contexto.strip()
+if __name__ == "__main__":
+    # Paso de build: python -m app.commons.services.matrix_loader "<ruta xlsx>" [hoja]
+    logging.basicConfig(level=logging.INFO)
+    ruta = sys.argv[1] if len(sys.argv) > 1 else "app/utils/Descripción Circunstancias.xlsx"
+    hoja_cli = sys.argv[2] if len(sys.argv) > 2 else "Descripción"
+    compilado = compilar_matriz_marcus(ruta, hoja_cli)
+    if not guardar_artefacto(compilado, ruta_artefacto(ruta)):
+        sys.exit(1)
+    print(f"✅ Artefacto Marcus: {ruta_artefacto(ruta)} ({len(compilado['filas'])} filas)")
@@ -0,0 +1,212 @@
+import time
+import logging
+import functools
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+from app.commons.services.stage_scheduler import ETAPA_ACTUAL
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+except ImportError:  # prometheus_client es opcional: sin él las métricas son no-op
+    CONTENT_TYPE_LATEST = "text/plain; charset=utf-8"
+    Counter = Gauge = Histogram = generate_latest = None
+
+# Etapas de varios minutos (audio largo) → buckets hasta 10 min
+_BUCKETS_S = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+
+class _NoOp:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def dec(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+
+def _metrica(tipo, nombre: str, descripcion: str, etiquetas=(), **kwargs):
+    if tipo is None:
+        return _NoOp()
+    return tipo(nombre, descripcion, list(etiquetas), **kwargs)
+
+
+# ============================================================
+# MÉTRICAS
+# ============================================================
+ETAPA_DURACION = _metrica(Histogram, "motor_etapa_duracion_segundos",
+                          "Duración de cada etapa del pipeline", ("etapa", "resultado"), buckets=_BUCKETS_S)
+LLM_DURACION = _metrica(Histogram, "motor_llm_invoke_duracion_segundos",
+                        "Latencia de cada llamada al proveedor LLM", ("modelo", "etapa", "resultado"),
+                        buckets=_BUCKETS_S)
+LLM_MEDIA_BYTES = _metrica(Counter, "motor_llm_media_bytes_total",
+                           "Bytes de imágenes/audio enviados al LLM", ("etapa", "tipo"))
+LLM_TOKENS = _metrica(Counter, "motor_llm_tokens_total",
+                      "Tokens reportados por el proveedor", ("modelo", "etapa", "tipo"))
+LLM_ERRORES = _metrica(Counter, "motor_llm_errores_total",
+                       "Llamadas LLM fallidas", ("modelo", "etapa", "tipo"))
+REINTENTOS_CUOTA = _metrica(Counter, "motor_llm_reintentos_cuota_total",
+                            "Reintentos por 429 del limitador", ("modelo",))
+REINTENTOS_JSON = _metrica(Counter, "motor_reintentos_json_total",
+                           "Reintentos de los bucles max_retries por JSON inválido", ("etapa",))
+PARSEO_JSON = _metrica(Counter, "motor_json_parseo_total",
+                      "Respuestas JSON por camino de extracción (directo/escaneo/reparado/fallido)",
+                      ("etapa", "via"))
+VALIDACION_ESQUEMA = _metrica(Counter, "motor_esquema_validacion_total",
+                             "Validaciones de la salida de cada etapa contra su esquema (ok/invalido)",
+                             ("etapa", "resultado"))
+FALLOS_PARSEO = _metrica(Counter, "motor_json_parse_fallos_total",
+                         "Respuestas del LLM que no se pudieron parsear como JSON", ("etapa",))
+ENRUTAMIENTO = _metrica(Counter, "motor_enrutamiento_total",
+                        "Ejecuciones de etapa con modelo rápido: aceptadas o escaladas (por motivo)",
+                        ("etapa", "modelo", "resultado"))
+LATENCIA_AHORRADA = _metrica(Counter, "motor_enrutamiento_latencia_ahorrada_segundos_total",
+                             "Latencia estimada ahorrada al aceptar el modelo rápido", ("etapa",))
+LATENCIA_DESPERDICIADA = _metrica(Counter, "motor_enrutamiento_latencia_desperdiciada_segundos_total",
+                                  "Tiempo del modelo rápido descartado al escalar", ("etapa",))
+HEDGES = _metrica(Counter, "motor_hedge_total",
+                  "Solicitudes duplicadas (hedging) por resultado: lanzado, gano_hedge, gano_primario, "
+                  "sin_presupuesto, sin_hilos", ("modelo", "etapa", "resultado"))
+CASOS_EN_CURSO = _metrica(Gauge, "motor_casos_en_curso", "Casos procesándose en este momento")
+CASOS_TOTAL = _metrica(Counter, "motor_casos_total", "Casos terminados", ("resultado",))
+
+
+def _etapa(etapa: Optional[str] = None) -> str:
+    return etapa or ETAPA_ACTUAL.get() or "sin_etapa"
+
+
+def exportar_metricas() -> bytes:
+    if generate_latest is None:
+        return b"# prometheus_client no instalado\n"
+    return generate_latest()
+
+
+# ============================================================
+# ETAPAS Y CASOS
+# ============================================================
+def instrumentar_etapa(nombre: str) -> Callable:
+    """Decorador: histograma de duración por etapa; un dict con "error" cuenta como error."""
+
+    def _decorador(funcion: Callable) -> Callable:
+        @functools.wraps(funcion)
+        def _envoltura(*args, **kwargs):
+            t0 = time.perf_counter()
+            resultado = "error"
+            try:
+                salida = funcion(*args, **kwargs)
+                if not (isinstance(salida, dict) and "error" in salida):
+                    resultado = "ok"
+                return salida
+            finally:
+                ETAPA_DURACION.labels(etapa=nombre, resultado=resultado).observe(time.perf_counter() - t0)
+        return _envoltura
+
+    return _decorador
+
+
+@contextmanager
+def caso_en_curso():
+    CASOS_EN_CURSO.inc()
+    resultado = "error"
+    try:
+        yield
+        resultado = "ok"
+    finally:
+        CASOS_EN_CURSO.dec()
+        CASOS_TOTAL.labels(resultado=resultado).inc()
+
+
+def registrar_reintento_json(etapa: Optional[str] = None):
+    REINTENTOS_JSON.labels(etapa=_etapa(etapa)).inc()
+
+
+def registrar_parseo_json(via: str, etapa: Optional[str] = None):
+    PARSEO_JSON.labels(etapa=_etapa(etapa), via=via).inc()
+
+
+def registrar_validacion_esquema(etapa: str, resultado: str):
+    VALIDACION_ESQUEMA.labels(etapa=etapa, resultado=resultado).inc()
+
+
+def registrar_enrutamiento(etapa: str, modelo: str, resultado: str, ahorro_s: float = 0.0,
+                           desperdicio_s: float = 0.0):
+    ENRUTAMIENTO.labels(etapa=etapa, modelo=modelo, resultado=resultado).inc()
+    if ahorro_s:
+        LATENCIA_AHORRADA.labels(etapa=etapa).inc(ahorro_s)
+    if desperdicio_s:
+        LATENCIA_DESPERDICIADA.labels(etapa=etapa).inc(desperdicio_s)
+
+
+def registrar_hedge(modelo: str, resultado: str, etapa: Optional[str] = None):
+    HEDGES.labels(modelo=modelo, etapa=_etapa(etapa), resultado=resultado).inc()
+
+
+def registrar_fallo_parseo(etapa: Optional[str] = None):
+    FALLOS_PARSEO.labels(etapa=_etapa(etapa)).inc()
+
+
+def registrar_reintento_cuota(modelo: str):
+    REINTENTOS_CUOTA.labels(modelo=modelo).inc()
+
+
+# ============================================================
+# LLM INSTRUMENTADO
+# ============================================================
+def _bytes_media(mensajes: Any):
+    for msg in mensajes if isinstance(mensajes, (list, tuple)) else [mensajes]:
+        contenido = getattr(msg, "content", None)
+        if not isinstance(contenido, list):
+            continue
+        for bloque in contenido:
+            if isinstance(bloque, dict) and isinstance(bloque.get("data"), (bytes, bytearray)):
+                yield str(bloque.get("mime_type", "")).split("/")[0] or "otro", len(bloque["data"])
+
+
+class InstrumentedLLM:
+    """
+    Envuelve el cliente del proveedor (cada llamada real, incluidos reintentos):
+    latencia, bytes multimedia enviados, tokens de entrada/salida y errores,
+    etiquetados por modelo y etapa (contextvar `ETAPA_ACTUAL`).
+    """
+
+    def __init__(self, llm, modelo: str):
+        self.llm = llm
+        self.modelo = modelo
+
+    def invoke(self, mensajes, **kwargs):
+        etapa = _etapa()
+        for tipo, n in _bytes_media(mensajes):
+            LLM_MEDIA_BYTES.labels(etapa=etapa, tipo=tipo).inc(n)
+
+        t0 = time.perf_counter()
+        try:
+            respuesta = self.llm.invoke(mensajes, **kwargs)
+        except Exception as e:
+            from app.commons.services.rate_limiter import es_error_cuota
+            LLM_DURACION.labels(modelo=self.modelo, etapa=etapa, resultado="error").observe(time.perf_counter() - t0)
+            LLM_ERRORES.labels(modelo=self.modelo, etapa=etapa, tipo="cuota" if es_error_cuota(e) else "otro").inc()
+            raise
+        LLM_DURACION.labels(modelo=self.modelo, etapa=etapa, resultado="ok").observe(time.perf_counter() - t0)
+
+        uso = getattr(respuesta, "usage_metadata", None) or {}
+        if isinstance(uso, dict):
+            if uso.get("input_tokens"):
+                LLM_TOKENS.labels(modelo=self.modelo, etapa=etapa, tipo="prompt").inc(uso["input_tokens"])
+            if uso.get("output_tokens"):
+                LLM_TOKENS.labels(modelo=self.modelo, etapa=etapa, tipo="completion").inc(uso["output_tokens"])
+        return respuesta
+
+    def __getattr__(self, item):
+        return getattr(self.llm, item)
+
+
+def envolver_con_metricas(llm, modelo: str):
+    if Histogram is None:
+        logging.warning("⚠️ prometheus_client no está instalado; métricas deshabilitadas.")
+        return llm
+    return InstrumentedLLM(llm, modelo)
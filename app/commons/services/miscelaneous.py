@@ -1,25 +1,42 @@
-import os
-import pdb
-import yaml
 import json
 
 from pathlib import Path
+from functools import lru_cache
 
 def load_prompts_generales(prompt_type: str) -> str:
-  prompt_files_path = Path(__file__).parent.parent.parent / "utils"
-  prompt_file_name: str = "prompts_generales.yaml"
-  prompt_file_path = str(prompt_files_path / prompt_file_name)
-  with open(prompt_file_path, "r", encoding="utf-8") as file:
-    prompts_variables = yaml.safe_load(file)
-    
-  return prompts_variables.get(prompt_type, "")
+  # Delegado al registro compilado: el YAML solo se parsea cuando cambia su mtime
+  from app.commons.services.prompt_registry import obtener_prompt
+  return obtener_prompt(prompt_type)
 
-def load_llm_parameters(model_name: str) -> dict:
+@lru_cache(maxsize=1)
+def load_all_llm_parameters() -> dict:
   llm_parameters_path = Path(__file__).parent.parent.parent / "config"
   llm_parameters_file_name: str = "llm_parameters.json"
   llm_parameters_file_path = str(llm_parameters_path / llm_parameters_file_name)
   with open(llm_parameters_file_path, 'r') as file:
     llm_parameters = json.load(file)
-    
-  return llm_parameters.get(model_name, {})
 
+  return llm_parameters
+
+def load_llm_parameters(model_name: str) -> dict:
+  return load_all_llm_parameters().get(model_name, {})
+
+@lru_cache(maxsize=1)
+def load_model_routing() -> dict:
+  model_routing_path = Path(__file__).parent.parent.parent / "config" / "model_routing.json"
+  with open(model_routing_path, 'r', encoding="utf-8") as file:
+    return json.load(file)
+
+@lru_cache(maxsize=1)
+def load_all_pipeline_parameters() -> dict:
+  pipeline_parameters_path = Path(__file__).parent.parent.parent / "config"
+  pipeline_parameters_file_name: str = "pipeline_parameters.json"
+  pipeline_parameters_file_path = str(pipeline_parameters_path / pipeline_parameters_file_name)
+  with open(pipeline_parameters_file_path, 'r', encoding="utf-8") as file:
+    pipeline_parameters = json.load(file)
+
+  return pipeline_parameters
+
+def load_pipeline_parameters(section: str) -> dict:
+  # Dict compartido del cache: quien necesite modificarlo debe copiarlo
+  return load_all_pipeline_parameters().get(section, {})
@@ -0,0 +1,170 @@
+import json
+import time
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.commons.services.miscelaneous import load_model_routing
+from app.commons.services.checkpoints import es_resultado_error
+from app.commons.services.metrics import registrar_enrutamiento
+
+
+@dataclass
+class PoliticaEtapa:
+    """Modelo de una etapa y cuándo escalar al siguiente (config/model_routing.json)."""
+
+    primario: str
+    escalar_a: Optional[str] = None
+    confianza_campo: Optional[str] = None
+    confianza_bajos: List[str] = field(default_factory=list)
+    latencia_referencia_s: Optional[float] = None
+
+
+def politica_etapa(etapa: str) -> PoliticaEtapa:
+    cfg = load_model_routing()
+    por_defecto = cfg.get("modelo_por_defecto", "gemini_pro")
+    if not cfg.get("habilitado", True):
+        return PoliticaEtapa(primario=por_defecto)
+    e = cfg.get("etapas", {}).get(etapa, {})
+    confianza = e.get("confianza") or {}
+    return PoliticaEtapa(
+        primario=e.get("primario", por_defecto),
+        escalar_a=e.get("escalar_a"),
+        confianza_campo=confianza.get("campo"),
+        confianza_bajos=[str(v).lower() for v in confianza.get("bajos", [])],
+        latencia_referencia_s=e.get("latencia_referencia_s"),
+    )
+
+
+def firma_politica(etapa: str) -> str:
+    """Entra en la huella del checkpoint: cambiar el modelo de una etapa la invalida."""
+    return json.dumps(asdict(politica_etapa(etapa)), sort_keys=True)
+
+
+# ============================================================
+# CRITERIOS DE ESCALAMIENTO
+# ============================================================
+def _valor_en_ruta(resultado: Any, ruta: str) -> Any:
+    # La salida visual viene envuelta en {"archivo", "resultado"}
+    for base in (resultado, resultado.get("resultado") if isinstance(resultado, dict) else None):
+        valor = base
+        for parte in ruta.split("."):
+            if not isinstance(valor, dict) or parte not in valor:
+                valor = None
+                break
+            valor = valor[parte]
+        if valor is not None:
+            return valor
+    return None
+
+
+def motivo_escalamiento(politica: PoliticaEtapa, resultado: Any) -> Optional[str]:
+    """None si la salida del modelo primario se acepta; si no, el motivo para escalar."""
+    if isinstance(resultado, str) and not resultado.strip():
+        return "vacio"
+    if es_resultado_error(resultado):
+        return "esquema" if "schema_issue" in resultado or "raw" in resultado else "error"
+    if politica.confianza_campo:
+        valor = _valor_en_ruta(resultado, politica.confianza_campo)
+        if isinstance(valor, str) and any(valor.strip().lower().startswith(b) for b in politica.confianza_bajos):
+            return "confianza_baja"
+    return None
+
+
+# ============================================================
+# ESTADÍSTICAS
+# ============================================================
+class EstadisticasEnrutamiento:
+    """
+    Por etapa: ejecuciones, escalamientos y latencia ahorrada/desperdiciada.
+    El ahorro se estima contra la latencia media (EWMA) observada del modelo
+    de escalamiento en esa etapa, o `latencia_referencia_s` si aún no hay datos.
+    """
+
+    def __init__(self, alfa: float = 0.2):
+        self.alfa = alfa
+        self._lock = threading.Lock()
+        self._por_etapa: Dict[str, Dict[str, Any]] = {}
+        self._latencias: Dict[Tuple[str, str], float] = {}
+
+    def observar_latencia(self, etapa: str, modelo: str, segundos: float):
+        with self._lock:
+            previa = self._latencias.get((etapa, modelo))
+            self._latencias[(etapa, modelo)] = segundos if previa is None else (
+                self.alfa * segundos + (1 - self.alfa) * previa)
+
+    def latencia_media(self, etapa: str, modelo: str) -> Optional[float]:
+        with self._lock:
+            return self._latencias.get((etapa, modelo))
+
+    def registrar(self, etapa: str, motivo: Optional[str], ahorro_s: float, desperdicio_s: float):
+        with self._lock:
+            m = self._por_etapa.setdefault(etapa, {
+                "ejecuciones": 0, "escalamientos": 0, "motivos": {}, "ahorro_s": 0.0, "desperdicio_s": 0.0,
+            })
+            m["ejecuciones"] += 1
+            if motivo:
+                m["escalamientos"] += 1
+                m["motivos"][motivo] = m["motivos"].get(motivo, 0) + 1
+            m["ahorro_s"] += ahorro_s
+            m["desperdicio_s"] += desperdicio_s
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            salida = {}
+            for etapa, m in self._por_etapa.items():
+                salida[etapa] = {
+                    **m,
+                    "ahorro_s": round(m["ahorro_s"], 3),
+                    "desperdicio_s": round(m["desperdicio_s"], 3),
+                    "tasa_escalamiento": round(m["escalamientos"] / m["ejecuciones"], 3) if m["ejecuciones"] else 0.0,
+                }
+            return {
+                "etapas": salida,
+                "latencia_media_s": {f"{e}/{mod}": round(v, 3) for (e, mod), v in self._latencias.items()},
+            }
+
+
+estadisticas_enrutamiento = EstadisticasEnrutamiento()
+
+
+# ============================================================
+# EJECUCIÓN
+# ============================================================
+def ejecutar_con_escalamiento(
+        etapa: str,
+        funcion: Callable[[Any], Any],
+        modelos: Callable[[str], Any],
+) -> Any:
+    """
+    Corre `funcion(llm)` con el modelo primario de la etapa y, si la salida no
+    se acepta (error/esquema, vacía o confianza baja), la repite con el modelo
+    de escalamiento.
+    """
+    politica = politica_etapa(etapa)
+    t0 = time.perf_counter()
+    resultado = funcion(modelos(politica.primario))
+    duracion = time.perf_counter() - t0
+    estadisticas_enrutamiento.observar_latencia(etapa, politica.primario, duracion)
+
+    if not politica.escalar_a or politica.escalar_a == politica.primario:
+        return resultado
+
+    motivo = motivo_escalamiento(politica, resultado)
+    if motivo is None:
+        referencia = estadisticas_enrutamiento.latencia_media(etapa, politica.escalar_a)
+        if referencia is None:
+            referencia = politica.latencia_referencia_s
+        ahorro = max(0.0, referencia - duracion) if referencia is not None else 0.0
+        estadisticas_enrutamiento.registrar(etapa, None, ahorro, 0.0)
+        registrar_enrutamiento(etapa, politica.primario, "aceptado", ahorro_s=ahorro)
+        return resultado
+
+    logging.info(f"⬆️ [{etapa}] {politica.primario} → {politica.escalar_a} (motivo: {motivo})")
+    t1 = time.perf_counter()
+    resultado = funcion(modelos(politica.escalar_a))
+    estadisticas_enrutamiento.observar_latencia(etapa, politica.escalar_a, time.perf_counter() - t1)
+    estadisticas_enrutamiento.registrar(etapa, motivo, 0.0, duracion)
+    registrar_enrutamiento(etapa, politica.primario, motivo, desperdicio_s=duracion)
+    return resultado
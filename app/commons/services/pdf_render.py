@@ -0,0 +1,222 @@
+import os
+import logging
+import threading
+import multiprocessing
+from pathlib import Path
+from dataclasses import dataclass
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+import fitz  # PyMuPDF
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+
+try:
+    from PIL import Image
+except ImportError:  # sin Pillow no hay presupuesto que codifique: se renderiza ya codificado
+    Image = None
+
+_MIME_POR_FORMATO = {
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "png": "image/png",
+}
+# Píxeles sin codificar: la única codificación la hace `image_budget.aplicar_presupuesto`
+FORMATO_CRUDO = "crudo"
+
+
+@dataclass
+class PaginaRenderizada:
+    numero: int  # 1-based
+    data: Optional[bytes] = None  # None si la página viene sin codificar
+    mime_type: Optional[str] = None
+    imagen: Any = None  # PIL.Image RGB (formato "crudo")
+
+    def como_media_block(self) -> dict:
+        if self.imagen is not None:
+            return {"type": "media", "imagen": self.imagen}
+        return {"type": "media", "data": self.data, "mime_type": self.mime_type}
+
+
+def _config_render() -> dict:
+    cfg = load_pipeline_parameters("pdf_render")
+    return {
+        "dpi": int(cfg.get("dpi", 150)),
+        "formato": str(cfg.get("formato", "jpeg")).lower(),
+        "calidad_jpeg": int(cfg.get("calidad_jpeg", 95)),
+        "spill_dir": os.environ.get("PDF_SPILL_DIR") or cfg.get("spill_dir"),
+        # null → automático según CPUs disponibles (1 CPU = render serial)
+        "workers": int(os.environ.get("PDF_RENDER_WORKERS") or cfg.get("workers") or min(os.cpu_count() or 1, 4)),
+        "max_paginas": int(os.environ.get("PDF_MAX_PAGINAS") or cfg.get("max_paginas") or 0),
+        "min_paginas_paralelo": int(cfg.get("min_paginas_paralelo", 4)),
+        "contexto_mp": cfg.get("contexto_mp"),
+    }
+
+
+def _render_pagina(page, dpi: int, formato: str, calidad_jpeg: int) -> Union[bytes, tuple]:
+    pix = page.get_pixmap(dpi=dpi)  # 150 dpi = buen balance calidad/memoria
+    if formato == FORMATO_CRUDO:
+        # Tupla simple (se serializa barato desde el pool): ancho, alto, stride, RGB
+        return pix.width, pix.height, pix.stride, pix.samples
+    if formato in ("jpeg", "jpg"):
+        return pix.tobytes("jpeg", jpg_quality=calidad_jpeg)
+    return pix.tobytes(formato)
+
+
+def _a_pagina(numero: int, render: Union[bytes, tuple], formato: str) -> PaginaRenderizada:
+    if formato == FORMATO_CRUDO:
+        ancho, alto, stride, muestras = render
+        imagen = Image.frombuffer("RGB", (ancho, alto), muestras, "raw", "RGB", stride, 1)
+        return PaginaRenderizada(numero=numero, imagen=imagen)
+    return PaginaRenderizada(numero=numero, data=render, mime_type=_MIME_POR_FORMATO[formato])
+
+
+def _render_rango(
+        pdf_path: str,
+        inicio: int,
+        fin: int,
+        dpi: int,
+        formato: str,
+        calidad_jpeg: int,
+) -> List[Tuple[int, Union[bytes, tuple]]]:
+    """Worker: abre el documento y renderiza las páginas [inicio, fin)."""
+    with fitz.open(pdf_path) as doc:
+        return [(i + 1, _render_pagina(doc[i], dpi, formato, calidad_jpeg)) for i in range(inicio, fin)]
+
+
+# Pool de procesos compartido (se crea en el primer PDF grande)
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _obtener_pool(workers: int, contexto_mp: Optional[str]) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # "spawn" por defecto: el pool se crea desde un hilo de etapa dentro de un servidor con
+            # otros hilos vivos (uvicorn, executor, limitador, hedging) y un fork podría heredar
+            # locks tomados y bloquear al hijo. "fork" queda como opción explícita.
+            metodo = contexto_mp or "spawn"
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(metodo))
+            _pool_workers = workers
+            logging.info(f"🧵 Pool de render PDF iniciado con {workers} proceso(s) ({metodo})")
+        return _pool
+
+
+def _rangos(total: int, partes: int) -> List[Tuple[int, int]]:
+    """Divide [0, total) en `partes` tramos contiguos de tamaño similar."""
+    partes = max(1, min(partes, total))
+    base, resto = divmod(total, partes)
+    rangos, inicio = [], 0
+    for k in range(partes):
+        fin = inicio + base + (1 if k < resto else 0)
+        rangos.append((inicio, fin))
+        inicio = fin
+    return rangos
+
+
+def renderizar_pdf_en_memoria(
+        pdf_path: str,
+        dpi: Optional[int] = None,
+        formato: Optional[str] = None,
+        calidad_jpeg: Optional[int] = None,
+        workers: Optional[int] = None,
+        max_paginas: Optional[int] = None,
+) -> List[PaginaRenderizada]:
+    """
+    Rasteriza las páginas del PDF directamente a buffers en memoria
+    (sin archivos temporales).
+
+    Con `workers` > 1 y suficientes páginas, cada proceso del pool abre el
+    documento y renderiza un tramo contiguo; el resultado conserva el orden
+    de páginas. `max_paginas` (> 0) limita cuántas páginas se renderizan.
+    Con formato "crudo" las páginas quedan como imágenes PIL sin codificar.
+    """
+    if not os.path.isfile(pdf_path):
+        raise FileNotFoundError(f"No existe el archivo PDF: {pdf_path}")
+
+    cfg = _config_render()
+    dpi = dpi or cfg["dpi"]
+    formato = (formato or cfg["formato"]).lower()
+    calidad_jpeg = calidad_jpeg or cfg["calidad_jpeg"]
+    workers = cfg["workers"] if workers is None else workers
+    max_paginas = cfg["max_paginas"] if max_paginas is None else max_paginas
+    if formato == FORMATO_CRUDO and Image is None:
+        logging.warning("⚠️ Pillow no está instalado; las páginas se renderizan como JPEG.")
+        formato = "jpeg"
+    if formato != FORMATO_CRUDO and formato not in _MIME_POR_FORMATO:
+        raise ValueError(f"Formato de render no soportado: {formato}")
+
+    with fitz.open(pdf_path) as doc:  # asegura cierre del documento
+        total = doc.page_count
+        if max_paginas and total > max_paginas:
+            logging.warning(f"⚠️ PDF con {total} páginas; se renderizan solo las primeras {max_paginas}.")
+            total = max_paginas
+
+        if workers <= 1 or total < cfg["min_paginas_paralelo"]:
+            renderizadas = [(i + 1, _render_pagina(doc[i], dpi, formato, calidad_jpeg)) for i in range(total)]
+        else:
+            renderizadas = None
+
+    if renderizadas is None:
+        pool = _obtener_pool(workers, cfg["contexto_mp"])
+        futuros = [
+            pool.submit(_render_rango, pdf_path, inicio, fin, dpi, formato, calidad_jpeg)
+            for inicio, fin in _rangos(total, workers)
+        ]
+        renderizadas = [pagina for f in futuros for pagina in f.result()]
+
+    paginas = [_a_pagina(numero, render, formato) for numero, render in renderizadas]
+    logging.info(
+        f"📄 PDF renderizado en memoria: {len(paginas)} página(s), "
+        f"{sum(len(r[3]) if formato == FORMATO_CRUDO else len(r) for _, r in renderizadas) / 1024:.0f} KB"
+    )
+    return paginas
+
+
+@contextmanager
+def paginas_pdf(
+        pdf_path: str,
+        dpi: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        conservar_spill: bool = False,
+) -> Iterator[List[PaginaRenderizada]]:
+    """
+    Context manager que entrega las páginas renderizadas en memoria.
+
+    Solo para depuración: si hay `spill_dir` (parámetro, env `PDF_SPILL_DIR`
+    o `pipeline_parameters.json`), también escribe cada página en disco.
+    Todo lo escrito se borra al salir del bloque, aunque haya excepción,
+    salvo que `conservar_spill=True`.
+    """
+    paginas = renderizar_pdf_en_memoria(pdf_path, dpi=dpi)
+    spill_dir = spill_dir or _config_render()["spill_dir"]
+    escritos: List[Path] = []
+    try:
+        if spill_dir:
+            destino = Path(spill_dir)
+            destino.mkdir(parents=True, exist_ok=True)
+            base = Path(pdf_path).stem
+            for p in paginas:
+                ext = ".jpg" if p.mime_type == "image/jpeg" else ".png"
+                ruta = destino / f"{base}_page{p.numero}{ext}"
+                if p.imagen is not None:
+                    p.imagen.save(ruta, format="PNG")
+                else:
+                    ruta.write_bytes(p.data)
+                escritos.append(ruta)
+            logging.info(f"🐞 Spill de depuración: {len(escritos)} página(s) en '{destino}'")
+        yield paginas
+    finally:
+        if not conservar_spill:
+            for ruta in escritos:
+                try:
+                    ruta.unlink()
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logging.warning(f"⚠️ No se pudo borrar '{ruta}': {e}")
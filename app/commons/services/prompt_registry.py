@@ -0,0 +1,75 @@
+import os
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import yaml
+
+# Loader en C si PyYAML fue compilado con libyaml (mucho más rápido)
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+RUTA_PROMPTS = Path(__file__).parent.parent.parent / "utils" / "prompts_generales.yaml"
+
+# Prompts que usan las 5 fases del pipeline (y la transcripción por segmentos)
+PROMPTS_REQUERIDOS = (
+    "transcription_audio",
+    "extraction_visual",
+    "extraction_visual_Ficha",
+    "evaluar_circunstancias_marcus",
+    "evcaluacion_presicion_",
+    "transcripcion_segmento_audio",
+)
+
+
+class PromptRegistry:
+    """
+    Registro de prompts cargado una sola vez desde YAML. Solo se vuelve a
+    parsear el archivo cuando cambia su mtime.
+    """
+
+    def __init__(self, ruta: Path = RUTA_PROMPTS):
+        self.ruta = Path(ruta)
+        self._prompts: Dict[str, str] = {}
+        self._mtime_ns: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _recargar_si_cambio(self):
+        mtime_ns = os.stat(self.ruta).st_mtime_ns
+        if mtime_ns == self._mtime_ns:
+            return
+        with self._lock:
+            if mtime_ns == self._mtime_ns:
+                return
+            with open(self.ruta, "r", encoding="utf-8") as file:
+                data = yaml.load(file, Loader=_YamlLoader) or {}
+            if not isinstance(data, dict):
+                raise ValueError(f"El archivo de prompts '{self.ruta}' no contiene un mapeo clave → prompt.")
+            self._prompts = {str(k): v for k, v in data.items()}
+            self._mtime_ns = mtime_ns
+            logging.info(f"📚 Prompts cargados desde '{self.ruta.name}' ({len(self._prompts)} claves)")
+
+    def get(self, clave: str, default: str = "") -> str:
+        self._recargar_si_cambio()
+        return self._prompts.get(clave, default)
+
+    def validar(self, claves: Iterable[str] = PROMPTS_REQUERIDOS):
+        """Falla si falta algún prompt o no es un string no vacío."""
+        self._recargar_si_cambio()
+        faltantes = [
+            c for c in claves
+            if not isinstance(self._prompts.get(c), str) or not self._prompts[c].strip()
+        ]
+        if faltantes:
+            raise RuntimeError(f"Prompts faltantes o vacíos en '{self.ruta.name}': {faltantes}")
+
+
+prompt_registry = PromptRegistry()
+
+
+def obtener_prompt(clave: str) -> str:
+    return prompt_registry.get(clave)
+
+
+def validar_prompts(claves: Iterable[str] = PROMPTS_REQUERIDOS):
+    prompt_registry.validar(claves)
@@ -0,0 +1,324 @@
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from app.commons.services.miscelaneous import load_pipeline_parameters, load_all_llm_parameters
+from app.commons.services.metrics import registrar_reintento_cuota
+from app.commons.services.cancelacion import esperar_cancelable, verificar_cancelacion
+
+# Tokens aproximados por bloque multimedia (Gemini: ~258 por imagen; audio ~32/s)
+_TOKENS_IMAGEN = 258
+_BYTES_POR_TOKEN_AUDIO = 750  # ≈ 24 kbit/s Opus → 3 KB/s → ~32 tokens/s
+
+
+# ============================================================
+# TOKEN BUCKET
+# ============================================================
+class TokenBucket:
+    """
+    Cubeta de `capacidad` unidades que se rellena a `capacidad / periodo_s`
+    por segundo. `adquirir(n)` bloquea hasta que haya saldo o se cancele el
+    caso en curso. Un pedido mayor que la capacidad se recorta a la capacidad
+    (nunca bloquea para siempre).
+    """
+
+    def __init__(self, capacidad: float, periodo_s: float = 60.0):
+        self.capacidad = float(capacidad)
+        self.tasa = self.capacidad / periodo_s
+        self._saldo = self.capacidad
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self._saldo = min(self.capacidad, self._saldo + (ahora - self._t) * self.tasa)
+        self._t = ahora
+
+    def adquirir(self, n: float = 1.0) -> float:
+        """Consume `n` unidades; devuelve los segundos que tuvo que esperar."""
+        n = min(float(n), self.capacidad)
+        esperado = 0.0
+        while True:
+            with self._lock:
+                self._rellenar()
+                if self._saldo >= n:
+                    self._saldo -= n
+                    return esperado
+                espera = (n - self._saldo) / self.tasa
+            esperar_cancelable(espera)
+            esperado += espera
+
+    def ajustar(self, delta: float):
+        """Cobra (delta > 0) o devuelve (delta < 0) unidades ya consumidas; el saldo puede quedar negativo."""
+        with self._lock:
+            self._rellenar()
+            self._saldo = min(self.capacidad, self._saldo - delta)
+
+
+# ============================================================
+# CONCURRENCIA ADAPTATIVA (AIMD)
+# ============================================================
+class ConcurrenciaAIMD:
+    """
+    Límite de llamadas simultáneas que sube +1 por "ronda" de éxitos rápidos
+    (aumento aditivo: +1/límite por éxito) y se multiplica por `factor` ante
+    un 429 (disminución multiplicativa). Un éxito más lento que
+    `latencia_objetivo_s` no sube el límite.
+    """
+
+    def __init__(
+            self,
+            inicial: int = 4,
+            minimo: int = 1,
+            maximo: int = 16,
+            factor: float = 0.5,
+            latencia_objetivo_s: Optional[float] = None,
+    ):
+        self.minimo = max(1, int(minimo))
+        self.maximo = max(self.minimo, int(maximo))
+        self.limite = float(min(max(inicial, self.minimo), self.maximo))
+        self.factor = factor
+        self.latencia_objetivo_s = latencia_objetivo_s
+        self.en_vuelo = 0
+        self._ultima_reduccion = 0.0
+        self._cond = threading.Condition()
+
+    def entrar(self) -> float:
+        t0 = time.monotonic()
+        with self._cond:
+            while self.en_vuelo >= int(self.limite):
+                # Espera acotada: un caso cancelado no se queda en la cola del cupo
+                self._cond.wait(timeout=0.25)
+                verificar_cancelacion()
+            self.en_vuelo += 1
+        return time.monotonic() - t0
+
+    def salir(self):
+        with self._cond:
+            self.en_vuelo -= 1
+            self._cond.notify()
+
+    def registrar_exito(self, latencia_s: float):
+        with self._cond:
+            if self.latencia_objetivo_s and latencia_s > self.latencia_objetivo_s:
+                return
+            anterior = int(self.limite)
+            self.limite = min(float(self.maximo), self.limite + 1.0 / self.limite)
+            if int(self.limite) > anterior:
+                self._cond.notify()
+
+    def registrar_limitado(self):
+        with self._cond:
+            # Varios 429 de la misma ráfaga cuentan como una sola reducción
+            ahora = time.monotonic()
+            if ahora - self._ultima_reduccion < 1.0:
+                return
+            self._ultima_reduccion = ahora
+            self.limite = max(float(self.minimo), self.limite * self.factor)
+            logging.warning(f"🐢 Concurrencia LLM reducida a {int(self.limite)} por límite de cuota")
+
+
+# ============================================================
+# LIMITADOR POR MODELO
+# ============================================================
+def es_error_cuota(error: BaseException) -> bool:
+    """Heurística para 429 / cuota agotada en los distintos SDKs."""
+    for attr in ("status_code", "code", "http_status"):
+        if str(getattr(error, attr, "")) == "429":
+            return True
+    respuesta = getattr(error, "response", None)
+    if str(getattr(respuesta, "status_code", "")) == "429":
+        return True
+    texto = str(error).lower()
+    return any(s in texto for s in ("429", "resource_exhausted", "resource exhausted", "rate limit", "quota"))
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    respuesta = getattr(error, "response", None)
+    cabeceras = getattr(respuesta, "headers", None) or {}
+    valor = cabeceras.get("retry-after") or cabeceras.get("Retry-After")
+    try:
+        return float(valor) if valor is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def estimar_tokens(mensajes: Any) -> int:
+    """Estimación barata de tokens de entrada (~4 caracteres por token)."""
+    total = 0
+    for msg in mensajes if isinstance(mensajes, (list, tuple)) else [mensajes]:
+        contenido = getattr(msg, "content", msg)
+        for bloque in contenido if isinstance(contenido, list) else [contenido]:
+            if isinstance(bloque, dict):
+                mime = str(bloque.get("mime_type", ""))
+                data = bloque.get("data")
+                if mime.startswith("image/"):
+                    total += _TOKENS_IMAGEN
+                elif mime.startswith("audio/") and isinstance(data, (bytes, bytearray)):
+                    total += len(data) // _BYTES_POR_TOKEN_AUDIO
+                elif isinstance(bloque.get("text"), str):
+                    total += len(bloque["text"]) // 4
+            else:
+                total += len(str(bloque)) // 4
+    return max(1, total)
+
+
+def _tokens_reales(respuesta: Any) -> Optional[int]:
+    uso = getattr(respuesta, "usage_metadata", None) or {}
+    total = uso.get("total_tokens") if isinstance(uso, dict) else None
+    return int(total) if total else None
+
+
+class LimitadorModelo:
+    """Token buckets (RPM / TPM) + concurrencia AIMD + estadísticas de un modelo."""
+
+    def __init__(self, nombre: str, rpm: float, tpm: float, concurrencia: ConcurrenciaAIMD):
+        self.nombre = nombre
+        self.rpm = TokenBucket(rpm) if rpm else None
+        self.tpm = TokenBucket(tpm) if tpm else None
+        self.concurrencia = concurrencia
+        self.stats = {"llamadas": 0, "limitadas_429": 0, "reintentos": 0, "espera_cola_s": 0.0}
+        self._lock = threading.Lock()
+
+    def _sumar(self, clave: str, valor: float = 1):
+        with self._lock:
+            self.stats[clave] += valor
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "espera_cola_s": round(self.stats["espera_cola_s"], 3),
+                "concurrencia_limite": int(self.concurrencia.limite),
+                "en_vuelo": self.concurrencia.en_vuelo,
+            }
+
+
+class RateLimitedLLM:
+    """
+    Envuelve un chat model: antes de cada `invoke` consume cuota de los token
+    buckets y toma un cupo de concurrencia; ante un 429 reduce la concurrencia
+    y reintenta con backoff exponencial con jitter completo (o `Retry-After`).
+    Otros errores se propagan sin reintentar. Si el caso en curso se cancela
+    (`CANCELACION_ACTUAL`) deja de llamar y de reintentar.
+    """
+
+    def __init__(
+            self,
+            llm,
+            limitador: LimitadorModelo,
+            max_reintentos: int = 5,
+            backoff_base_s: float = 1.0,
+            backoff_max_s: float = 30.0,
+    ):
+        self.llm = llm
+        self.limitador = limitador
+        self.max_reintentos = max_reintentos
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+
+    def invoke(self, mensajes, **kwargs):
+        lim = self.limitador
+        tokens = estimar_tokens(mensajes)
+        intento = 0
+        while True:
+            # Caso cancelado / plazo vencido: no se gasta cuota en una respuesta que nadie espera
+            verificar_cancelacion()
+            espera = 0.0
+            if lim.rpm:
+                espera += lim.rpm.adquirir(1)
+            if lim.tpm:
+                espera += lim.tpm.adquirir(tokens)
+            espera += lim.concurrencia.entrar()
+            lim._sumar("espera_cola_s", espera)
+            lim._sumar("llamadas")
+            t0 = time.monotonic()
+            error_cuota = None
+            try:
+                verificar_cancelacion()  # pudo cancelarse mientras esperaba cupo
+                respuesta = self.llm.invoke(mensajes, **kwargs)
+            except Exception as e:
+                if not es_error_cuota(e):
+                    raise
+                error_cuota = e
+            finally:
+                # El cupo se libera antes del backoff: dormir con él tomado frena a las demás llamadas
+                lim.concurrencia.salir()
+
+            if error_cuota is None:
+                lim.concurrencia.registrar_exito(time.monotonic() - t0)
+                reales = _tokens_reales(respuesta)
+                if reales and lim.tpm:
+                    lim.tpm.ajustar(reales - tokens)
+                return respuesta
+
+            lim._sumar("limitadas_429")
+            lim.concurrencia.registrar_limitado()
+            if intento >= self.max_reintentos:
+                logging.error(f"❌ [{lim.nombre}] Cuota agotada tras {intento} reintentos")
+                raise error_cuota
+            pausa = _retry_after(error_cuota)
+            if pausa is None:
+                pausa = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** intento)))
+            intento += 1
+            lim._sumar("reintentos")
+            registrar_reintento_cuota(lim.nombre)
+            logging.warning(f"⏳ [{lim.nombre}] 429 recibido; reintento {intento} en {pausa:.1f}s")
+            esperar_cancelable(pausa)
+
+    def __getattr__(self, item):
+        return getattr(self.llm, item)
+
+
+# ============================================================
+# LIMITADORES COMPARTIDOS DEL PROCESO
+# ============================================================
+_limitadores: Dict[str, LimitadorModelo] = {}
+_limitadores_lock = threading.Lock()
+
+
+def config_limites(clave_modelo: str) -> Dict[str, Any]:
+    """Sección `rate_limit` de pipeline_parameters.json con overrides de `rate_limits` del modelo."""
+    cfg = dict(load_pipeline_parameters("rate_limit"))
+    cfg.update(load_all_llm_parameters().get(clave_modelo, {}).get("rate_limits", {}) or {})
+    return cfg
+
+
+def obtener_limitador(clave_modelo: str) -> LimitadorModelo:
+    """Un limitador por modelo, compartido por todos los casos/requests del proceso."""
+    with _limitadores_lock:
+        if clave_modelo not in _limitadores:
+            cfg = config_limites(clave_modelo)
+            _limitadores[clave_modelo] = LimitadorModelo(
+                clave_modelo,
+                rpm=float(cfg.get("rpm", 0) or 0),
+                tpm=float(cfg.get("tpm", 0) or 0),
+                concurrencia=ConcurrenciaAIMD(
+                    inicial=int(cfg.get("concurrencia_inicial", 4)),
+                    minimo=int(cfg.get("concurrencia_min", 1)),
+                    maximo=int(cfg.get("concurrencia_max", 16)),
+                    latencia_objetivo_s=cfg.get("latencia_objetivo_s"),
+                ),
+            )
+        return _limitadores[clave_modelo]
+
+
+def resumen_limitadores() -> Dict[str, Dict[str, Any]]:
+    with _limitadores_lock:
+        return {n: l.resumen() for n, l in _limitadores.items()}
+
+
+def envolver_con_limitador(llm, clave_modelo: str):
+    """Aplica el limitador compartido del modelo si `rate_limit.habilitado` es true."""
+    cfg = config_limites(clave_modelo)
+    if not cfg.get("habilitado", True):
+        return llm
+    return RateLimitedLLM(
+        llm,
+        obtener_limitador(clave_modelo),
+        max_reintentos=int(cfg.get("max_reintentos", 5)),
+        backoff_base_s=float(cfg.get("backoff_base_s", 1.0)),
+        backoff_max_s=float(cfg.get("backoff_max_s", 30.0)),
+    )
@@ -0,0 +1,200 @@
+import time
+import logging
+import contextvars
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.commons.services.cancelacion import CANCELACION_ACTUAL, Cancelacion, CasoCancelado
+
+# Etapa que se está ejecutando en el hilo actual (para métricas por etapa)
+ETAPA_ACTUAL: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("etapa_actual", default=None)
+
+
+@dataclass
+class Etapa:
+    """
+    Nodo del grafo del pipeline.
+
+    `funcion` recibe un dict {nombre_dependencia: resultado} con las salidas
+    de sus dependencias y devuelve el resultado de la etapa. `plazo_s` es el
+    tiempo máximo de la etapa (None = sin plazo propio).
+    """
+    nombre: str
+    funcion: Callable[[Dict[str, Any]], Any]
+    dependencias: Tuple[str, ...] = ()
+    plazo_s: Optional[float] = None
+
+
+@dataclass
+class ResultadoPlan:
+    resultados: Dict[str, Any] = field(default_factory=dict)
+    tiempos: Dict[str, float] = field(default_factory=dict)
+    errores: Dict[str, str] = field(default_factory=dict)
+    # Etapas no ejecutadas porque falló una dependencia -> dependencias fallidas
+    # (también figuran en `errores` con "Dependencia fallida: ...")
+    bloqueadas: Dict[str, List[str]] = field(default_factory=dict)
+    reutilizadas: List[str] = field(default_factory=list)
+    # Etapas abandonadas por plazo/cancelación (su hilo puede seguir vivo)
+    abandonadas: List[str] = field(default_factory=list)
+    cancelado: Optional[CasoCancelado] = None
+    total: float = 0.0
+
+
+def _validar_grafo(etapas: Sequence[Etapa]) -> None:
+    nombres = [e.nombre for e in etapas]
+    if len(nombres) != len(set(nombres)):
+        raise ValueError(f"Nombres de etapa duplicados: {nombres}")
+    for e in etapas:
+        faltantes = [d for d in e.dependencias if d not in nombres]
+        if faltantes:
+            raise ValueError(f"La etapa '{e.nombre}' depende de etapas inexistentes: {faltantes}")
+
+    # Detección de ciclos (orden topológico de Kahn)
+    pendientes = {e.nombre: set(e.dependencias) for e in etapas}
+    resueltas: set = set()
+    while pendientes:
+        listas = [n for n, deps in pendientes.items() if deps <= resueltas]
+        if not listas:
+            raise ValueError(f"El grafo de etapas tiene ciclos: {sorted(pendientes)}")
+        for n in listas:
+            resueltas.add(n)
+            pendientes.pop(n)
+
+
+def ejecutar_etapas(
+        etapas: Sequence[Etapa],
+        *,
+        max_workers: Optional[int] = None,
+        precargados: Optional[Dict[str, Any]] = None,
+        on_inicio: Optional[Callable[[str], None]] = None,
+        on_fin: Optional[Callable[[str, Any, float], None]] = None,
+        cancelacion: Optional[Cancelacion] = None,
+        intervalo_sondeo_s: float = 0.5,
+) -> ResultadoPlan:
+    """
+    Ejecuta las etapas como un grafo de dependencias: cada etapa arranca en
+    cuanto terminan todas sus dependencias, y las etapas independientes corren
+    en paralelo en un pool de hilos.
+
+    Si una etapa lanza excepción, sus dependientes no se ejecutan y quedan
+    registrados en `errores` y en `bloqueadas`. Los callbacks `on_inicio` / `on_fin` se invocan
+    desde el hilo que llama a esta función.
+
+    `precargados` ({etapa: resultado}) marca etapas como ya resueltas (p. ej.
+    desde un checkpoint): no se ejecutan ni disparan callbacks, y quedan
+    listadas en `reutilizadas`.
+
+    Cada etapa corre con una `Cancelacion` hija de `cancelacion` (con su
+    `plazo_s`) en `CANCELACION_ACTUAL`. Si vence el plazo de una etapa, se
+    marca con error y se abandona; si se cancela el caso, no se lanzan más
+    etapas, las que están en curso se abandonan y `cancelado` queda con el
+    motivo. Un hilo abandonado no se puede matar: se corta en su próxima
+    verificación (antes de cada llamada al LLM) y no bloquea el retorno.
+    """
+    _validar_grafo(etapas)
+
+    por_nombre = {e.nombre: e for e in etapas}
+    plan = ResultadoPlan()
+    for nombre, resultado in (precargados or {}).items():
+        if nombre in por_nombre:
+            plan.resultados[nombre] = resultado
+            plan.reutilizadas.append(nombre)
+    pendientes: List[str] = [e.nombre for e in etapas if e.nombre not in plan.resultados]
+    en_curso: Dict[Any, Tuple[str, float, Cancelacion]] = {}
+    t_inicio_plan = time.perf_counter()
+
+    def _lista(nombre: str) -> bool:
+        return all(d in plan.resultados for d in por_nombre[nombre].dependencias)
+
+    def _bloqueada(nombre: str) -> bool:
+        return any(d in plan.errores for d in por_nombre[nombre].dependencias)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers or max(1, len(pendientes)), thread_name_prefix="etapa")
+    con_plazos = cancelacion is not None or any(e.plazo_s for e in etapas)
+
+    def _cancelar_pendientes(error: CasoCancelado):
+        logging.warning(f"🛑 Caso cancelado ({error.motivo}); etapas sin lanzar: {pendientes}")
+        for nombre in pendientes:
+            plan.errores[nombre] = f"Cancelada: {error.motivo}"
+        pendientes.clear()
+
+    def _lanzar_listas():
+        if cancelacion is not None and plan.cancelado is None:
+            plan.cancelado = cancelacion.estado()
+        if plan.cancelado is not None:
+            if pendientes:
+                _cancelar_pendientes(plan.cancelado)
+            return
+
+        # Propaga primero los bloqueos en cascada (dependencias fallidas)
+        bloqueadas = [n for n in pendientes if _bloqueada(n)]
+        while bloqueadas:
+            for nombre in bloqueadas:
+                pendientes.remove(nombre)
+                plan.bloqueadas[nombre] = [d for d in por_nombre[nombre].dependencias if d in plan.errores]
+                plan.errores[nombre] = "Dependencia fallida: " + ", ".join(plan.bloqueadas[nombre])
+                logging.warning(f"⏭️ Etapa '{nombre}' omitida: {plan.errores[nombre]}")
+            bloqueadas = [n for n in pendientes if _bloqueada(n)]
+
+        for nombre in list(pendientes):
+            if not _lista(nombre):
+                continue
+            pendientes.remove(nombre)
+            etapa = por_nombre[nombre]
+            entradas = {d: plan.resultados[d] for d in etapa.dependencias}
+            if on_inicio:
+                on_inicio(nombre)
+            # Propaga contextvars del llamador al hilo de la etapa
+            ctx = contextvars.copy_context()
+            ctx.run(ETAPA_ACTUAL.set, nombre)
+            senal = cancelacion.hija(etapa.plazo_s) if cancelacion is not None else Cancelacion(etapa.plazo_s)
+            ctx.run(CANCELACION_ACTUAL.set, senal)
+            futuro = pool.submit(ctx.run, etapa.funcion, entradas)
+            en_curso[futuro] = (nombre, time.perf_counter(), senal)
+
+    def _abandonar_vencidas():
+        for futuro, (nombre, t0, senal) in list(en_curso.items()):
+            error = senal.estado()
+            if error is None:
+                continue
+            en_curso.pop(futuro)
+            senal.cancelar(error.motivo)  # sus próximas llamadas al LLM se cortan
+            futuro.cancel()
+            plan.tiempos[nombre] = round(time.perf_counter() - t0, 3)
+            plan.errores[nombre] = f"{'Plazo excedido' if error.por_plazo else 'Cancelada'}: {error.motivo}"
+            plan.abandonadas.append(nombre)
+            logging.warning(f"⌛ Etapa '{nombre}' abandonada tras {plan.tiempos[nombre]:.2f}s: {error.motivo}")
+
+    try:
+        _lanzar_listas()
+        while en_curso:
+            hechos, _ = wait(list(en_curso), timeout=intervalo_sondeo_s if con_plazos else None,
+                             return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                nombre, t0, _senal = en_curso.pop(futuro)
+                duracion = time.perf_counter() - t0
+                plan.tiempos[nombre] = round(duracion, 3)
+                try:
+                    resultado = futuro.result()
+                except CasoCancelado as e:
+                    logging.warning(f"🛑 Etapa '{nombre}' cortada en {duracion:.2f}s: {e.motivo}")
+                    plan.errores[nombre] = f"{'Plazo excedido' if e.por_plazo else 'Cancelada'}: {e.motivo}"
+                    continue
+                except Exception as e:
+                    logging.error(f"❌ Etapa '{nombre}' falló en {duracion:.2f}s: {e}", exc_info=True)
+                    plan.errores[nombre] = str(e)
+                    continue
+                plan.resultados[nombre] = resultado
+                logging.info(f"⏱️ Etapa '{nombre}' completada en {duracion:.2f}s")
+                if on_fin:
+                    on_fin(nombre, resultado, duracion)
+            _abandonar_vencidas()
+            _lanzar_listas()
+    finally:
+        # Con etapas abandonadas no se espera a sus hilos (pueden estar colgados en el LLM)
+        pool.shutdown(wait=not plan.abandonadas, cancel_futures=True)
+
+    plan.total = round(time.perf_counter() - t_inicio_plan, 3)
+    logging.info(f"⏱️ Pipeline completado en {plan.total:.2f}s | etapas: {plan.tiempos}")
+    return plan
@@ -0,0 +1,204 @@
+import json
+import hashlib
+import logging
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from app.commons.services.miscelaneous import load_pipeline_parameters
+
+
+class UploadRechazado(Exception):
+    """Upload rechazado durante el streaming. `status` es el código HTTP sugerido."""
+
+    def __init__(self, status: int, detalle: str):
+        super().__init__(detalle)
+        self.status = status
+        self.detalle = detalle
+
+
+# =========================
+# Firmas (magic bytes)
+# =========================
+def _es_mp3(c: bytes) -> bool:
+    # Tag ID3 o frame MPEG (11 bits de sincronía)
+    return c.startswith(b"ID3") or (len(c) >= 2 and c[0] == 0xFF and (c[1] & 0xE0) == 0xE0)
+
+
+_FIRMAS = {
+    ".pdf": lambda c: c.startswith(b"%PDF-"),
+    ".png": lambda c: c.startswith(b"\x89PNG\r\n\x1a\n"),
+    ".wav": lambda c: c[:4] == b"RIFF" and c[8:12] == b"WAVE",
+    ".ogg": lambda c: c.startswith(b"OggS"),
+    ".m4a": lambda c: c[4:8] == b"ftyp",
+    ".mp3": _es_mp3,
+    ".zip": lambda c: c.startswith(b"PK\x03\x04"),
+}
+
+
+def firma_valida(ext: str, cabecera: bytes) -> bool:
+    """Verifica que los primeros bytes correspondan al tipo declarado por la extensión."""
+    verificador = _FIRMAS.get(ext.lower())
+    return verificador(cabecera) if verificador else True
+
+
+# =========================
+# Límites
+# =========================
+def config_uploads() -> Dict[str, Any]:
+    return load_pipeline_parameters("uploads")
+
+
+def limite_bytes(campo: str) -> int:
+    cfg = config_uploads()
+    return int(float(cfg.get(f"max_mb_{campo}", 100)) * 1024 * 1024)
+
+
+class PresupuestoRequest:
+    """Acumula los bytes recibidos entre todos los archivos de un mismo request."""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(float(config_uploads().get("max_mb_request", 150)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.recibidos = 0
+
+    def consumir(self, n: int):
+        self.recibidos += n
+        if self.recibidos > self.max_bytes:
+            raise UploadRechazado(
+                413, f"El request supera el máximo de {self.max_bytes // (1024 * 1024)} MB."
+            )
+
+
+# =========================
+# Límite del cuerpo en la red
+# =========================
+class _CuerpoExcedido(Exception):
+    pass
+
+
+class LimiteCuerpoMiddleware:
+    """
+    Middleware ASGI que corta el request mientras el cuerpo todavía se está
+    recibiendo. Starlette vuelca el multipart completo a su spool antes de que
+    corra el endpoint, así que los límites de `guardar_upload` solo aplican a
+    la copia desde ese spool. Aquí se rechaza de entrada si `Content-Length` ya
+    supera `maximo_para(ruta)` y, si no viene (chunked) o miente, se cuentan los
+    bytes recibidos y se responde 413 en cuanto se pasa del máximo.
+    """
+
+    def __init__(self, app, maximo_para: Callable[[str], Optional[int]]):
+        self.app = app
+        self.maximo_para = maximo_para
+
+    @staticmethod
+    async def _rechazar(send, maximo: int):
+        cuerpo = json.dumps({"detail": f"El request supera el máximo de {maximo // (1024 * 1024)} MB."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(cuerpo)).encode())],
+        })
+        await send({"type": "http.response.body", "body": cuerpo})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        maximo = self.maximo_para(scope["path"])
+        if not maximo:
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > maximo:
+            return await self._rechazar(send, maximo)
+
+        recibidos = 0
+        excedido = False
+        respuesta_iniciada = False
+
+        async def _receive():
+            nonlocal recibidos, excedido
+            mensaje = await receive()
+            if mensaje["type"] == "http.request":
+                recibidos += len(mensaje.get("body", b""))
+                if recibidos > maximo:
+                    excedido = True
+                    raise _CuerpoExcedido()
+            return mensaje
+
+        async def _send(mensaje):
+            nonlocal respuesta_iniciada
+            if excedido:
+                return  # FastAPI convierte el error de parseo en 400: se reemplaza por el 413
+            if mensaje["type"] == "http.response.start":
+                respuesta_iniciada = True
+            await send(mensaje)
+
+        try:
+            await self.app(scope, _receive, _send)
+        except Exception:
+            if not excedido:
+                raise
+        if excedido and not respuesta_iniciada:
+            logging.warning(f"🚫 Request a {scope['path']} cortado al superar {maximo // (1024 * 1024)} MB")
+            await self._rechazar(send, maximo)
+
+
+@dataclass
+class ArchivoRecibido:
+    ruta: Path
+    bytes: int
+    sha256: str
+
+    def resumen(self) -> Dict[str, Any]:
+        return {"bytes": self.bytes, "sha256": self.sha256}
+
+
+async def guardar_upload(
+        upload,
+        destino: Path,
+        campo: str,
+        presupuesto: PresupuestoRequest,
+        max_bytes: Optional[int] = None,
+) -> ArchivoRecibido:
+    """
+    Copia un `UploadFile` a `destino` en bloques de tamaño fijo, calculando el
+    SHA-256 sobre la marcha. Rechaza en cuanto se supera el límite del archivo
+    o del request, o si los magic bytes no corresponden a la extensión.
+    Si se rechaza, el archivo parcial se borra. El cuerpo ya está en el spool
+    de Starlette: el corte durante la recepción lo hace `LimiteCuerpoMiddleware`.
+    """
+    chunk = int(float(config_uploads().get("chunk_kb", 1024)) * 1024)
+    max_bytes = max_bytes or limite_bytes(campo)
+    ext = destino.suffix.lower()
+    h = hashlib.sha256()
+    total = 0
+
+    try:
+        with open(destino, "wb") as f:
+            primero = True
+            while True:
+                bloque = await upload.read(chunk)
+                if not bloque:
+                    break
+                if primero:
+                    primero = False
+                    if not firma_valida(ext, bloque[:16]):
+                        raise UploadRechazado(415, f"El contenido de '{campo}' no corresponde a un archivo {ext}.")
+                total += len(bloque)
+                if total > max_bytes:
+                    raise UploadRechazado(
+                        413, f"'{campo}' supera el máximo de {max_bytes // (1024 * 1024)} MB."
+                    )
+                presupuesto.consumir(len(bloque))
+                h.update(bloque)
+                f.write(bloque)  # /tmp en Cloud Run es memoria: escritura local y rápida
+        if total == 0:
+            raise UploadRechazado(400, f"El archivo '{campo}' está vacío.")
+    except BaseException:
+        destino.unlink(missing_ok=True)
+        raise
+
+    logging.info(f"📥 Upload '{campo}' recibido: {total / 1024:.0f} KB sha256={h.hexdigest()[:12]}")
+    return ArchivoRecibido(ruta=destino, bytes=total, sha256=h.hexdigest())
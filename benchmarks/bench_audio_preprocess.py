@@ -0,0 +1,46 @@
+"""
+Benchmark del preprocesado de audio (mono + 16 kHz + recorte de silencios + Opus).
+
+Genera llamadas sintéticas WAV estéreo de distintas duraciones y reporta
+tamaño y duración antes/después, y el tiempo de conversión.
+
+Uso:
+    python -m benchmarks.bench_audio_preprocess --minutos 1 5 20
+Requiere ffmpeg en el PATH (o env FFMPEG_BIN).
+"""
+import os
+import time
+import argparse
+import tempfile
+
+from app.commons.services.audio_preprocess import ffmpeg_bin, preprocesar_audio
+from benchmarks.fixtures_audio import generar_wav_llamada
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutos", type=float, nargs="+", default=[1, 5])
+    parser.add_argument("--codec", default="opus", choices=["opus", "mp3", "flac"])
+    args = parser.parse_args()
+
+    if not ffmpeg_bin():
+        raise SystemExit("ffmpeg no disponible: instala ffmpeg o define FFMPEG_BIN.")
+
+    print(f"{'min':>5} {'orig KB':>10} {'final KB':>10} {'ratio':>7} {'dur orig':>9} {'dur final':>9} {'seg':>6}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutos in args.minutos:
+            ruta = generar_wav_llamada(os.path.join(tmp, f"llamada_{minutos}m.wav"), minutos * 60)
+            t0 = time.perf_counter()
+            r = preprocesar_audio(ruta, codec=args.codec, min_kb=0)
+            dt = time.perf_counter() - t0
+            if r is None:
+                print(f"{minutos:>5} sin reducción")
+                continue
+            print(
+                f"{minutos:>5} {r.bytes_originales / 1024:>10.0f} {r.bytes_finales / 1024:>10.0f} "
+                f"{r.bytes_originales / r.bytes_finales:>6.1f}x {r.duracion_original:>9} {r.duracion_final:>9} {dt:>6.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark de hedging (solicitudes duplicadas) contra FakeLLM con cola larga.
+
+Cada etapa tiene su propio modelo falso: latencia media distinta, jitter y
+una probabilidad `--prob-lenta` de que la llamada se atasque
+`--factor-lenta` veces su latencia media. Se lanzan `--llamadas` por etapa
+desde `--hilos` hilos, primero directo y luego con HedgedLLM (tras
+`--calentamiento` llamadas que llenan la ventana de latencias), y se compara
+p50/p95/p99/max, la tasa de hedges y las llamadas extra al proveedor.
+
+Uso:
+    python -m benchmarks.bench_hedging --llamadas 300 --hilos 16 --prob-lenta 0.03
+    python -m benchmarks.bench_hedging --percentil 90 --tasa-maxima 0.1
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from app.commons.services.fake_llm import FakeLLM
+from app.commons.services.hedging import EstadoHedge, HedgedLLM
+from app.commons.services.stage_scheduler import ETAPA_ACTUAL
+from benchmarks.bench_pipeline import percentil
+
+# Latencia media relativa por etapa (visual y audio son las más pesadas)
+LATENCIA_ETAPA = {"visual": 1.0, "ficha": 0.5, "audio": 1.2, "circunstancias": 0.8, "precision": 0.5}
+
+
+def _fakes(args) -> Dict[str, FakeLLM]:
+    return {
+        etapa: FakeLLM(
+            latencia_s=args.latencia * factor,
+            jitter_s=args.latencia * factor * 0.3,
+            prob_lenta=args.prob_lenta,
+            latencia_lenta_s=args.latencia * factor * args.factor_lenta,
+            semilla=args.semilla + i,
+        )
+        for i, (etapa, factor) in enumerate(LATENCIA_ETAPA.items())
+    }
+
+
+def _correr(llms: Dict[str, object], llamadas: int, hilos: int) -> Dict[str, List[float]]:
+    def _una(etapa: str) -> float:
+        ETAPA_ACTUAL.set(etapa)
+        t0 = time.perf_counter()
+        llms[etapa].invoke("hola")
+        return time.perf_counter() - t0
+
+    tareas = [e for _ in range(llamadas) for e in LATENCIA_ETAPA]
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        duraciones = list(pool.map(_una, tareas))
+    por_etapa: Dict[str, List[float]] = {e: [] for e in LATENCIA_ETAPA}
+    for etapa, d in zip(tareas, duraciones):
+        por_etapa[etapa].append(d)
+    return por_etapa
+
+
+def _imprimir(modo: str, por_etapa: Dict[str, List[float]]):
+    todas = [d for v in por_etapa.values() for d in v]
+    for etapa, v in [*por_etapa.items(), ("todas", todas)]:
+        print(f"{modo:<8} {etapa:<15} {percentil(v, 50):>8.3f} {percentil(v, 95):>8.3f} "
+              f"{percentil(v, 99):>8.3f} {max(v):>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llamadas", type=int, default=200, help="Llamadas medidas por etapa.")
+    parser.add_argument("--hilos", type=int, default=16)
+    parser.add_argument("--latencia", type=float, default=0.05, help="Latencia base del LLM falso (s).")
+    parser.add_argument("--prob-lenta", type=float, default=0.03, help="Probabilidad de llamada atascada.")
+    parser.add_argument("--factor-lenta", type=float, default=20.0, help="Atasco = factor × latencia de la etapa.")
+    parser.add_argument("--percentil", type=float, default=95)
+    parser.add_argument("--tasa-maxima", type=float, default=0.05)
+    parser.add_argument("--rafaga", type=float, default=2)
+    parser.add_argument("--calentamiento", type=int, default=40, help="Llamadas por etapa antes de medir.")
+    parser.add_argument("--semilla", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'modo':<8} {'etapa':<15} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+
+    directos = _fakes(args)
+    _imprimir("directo", _correr(directos, args.llamadas, args.hilos))
+
+    fakes = _fakes(args)
+    estado = EstadoHedge("bench", {
+        "percentil": args.percentil,
+        "min_muestras": min(20, args.calentamiento),
+        "umbral_minimo_s": 0.0,
+        "tasa_maxima": args.tasa_maxima,
+        "rafaga": args.rafaga,
+        "max_hilos": args.hilos * 2,
+    })
+    hedged = {etapa: HedgedLLM(fake, estado) for etapa, fake in fakes.items()}
+    _correr(hedged, args.calentamiento, args.hilos)
+    llamadas_previas = sum(f.stats["llamadas"] for f in fakes.values())
+    stats_previas = dict(estado.stats)
+    _imprimir("hedging", _correr(hedged, args.llamadas, args.hilos))
+
+    medidas = args.llamadas * len(LATENCIA_ETAPA)
+    al_proveedor = sum(f.stats["llamadas"] for f in fakes.values()) - llamadas_previas
+    hedges = estado.stats["hedges"] - stats_previas["hedges"]
+    ganados = estado.stats["gano_hedge"] - stats_previas["gano_hedge"]
+    print(f"\nhedges: {hedges} ({hedges / medidas:.1%} de {medidas}), ganados por el duplicado: {ganados}, "
+          f"sin presupuesto: {estado.stats['sin_presupuesto'] - stats_previas['sin_presupuesto']}")
+    print(f"llamadas extra al proveedor: {al_proveedor - medidas} ({(al_proveedor - medidas) / medidas:.1%})")
+    print(f"umbrales (s): {estado.resumen()['umbral_s']}")
+    estado.pool.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    main()
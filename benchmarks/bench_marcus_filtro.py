@@ -0,0 +1,65 @@
+"""
+Benchmark del filtro de relevancia de la matriz Marcus.
+
+Sobre relatos sintéticos etiquetados (hechos visuales + transcripción)
+reporta qué circunstancias se seleccionan, si las esperadas quedan dentro,
+cuántos caracteres / tokens estimados del contexto se ahorran y el tiempo
+de selección.
+
+Uso:
+    python -m benchmarks.bench_marcus_filtro --top-k 6
+"""
+import time
+import argparse
+
+from app.commons.services.marcus_index import IndiceMarcus
+
+CASOS = [
+    ("alcance", {"descripcion": "El vehículo A golpea la parte trasera del vehículo B que frenaba ante el semáforo"},
+     "Yo venía frenando porque el semáforo cambió y el de atrás me pegó por detrás", {"C2", "C6"}),
+    ("reversa", {"descripcion": "Vehículo B daba reversa saliendo de un parqueadero y golpea al vehículo A"},
+     "El señor retrocedía sin mirar y me pegó, yo estaba detenido esperando", {"C8", "C3", "C9"}),
+    ("puerta", {"descripcion": "Conductor del vehículo estacionado abre la puerta y un carro la golpea"},
+     "Estaba parqueado, abrí la puerta y el otro carro se la llevó", {"C15", "C3"}),
+    ("carril", {"descripcion": "Vehículo A cambia de carril para adelantar e impacta el costado del vehículo B"},
+     "Íbamos en el mismo sentido, él se pasó a mi carril sin poner direccional", {"C4", "C7"}),
+    ("glorieta", {"descripcion": "Vehículo A entra a la glorieta desde vía secundaria, B circula dentro de la glorieta"},
+     "Yo iba por la rotonda y el otro entró sin ceder el paso", {"C1", "C12"}),
+    ("contravia", {"descripcion": "Vehículo B circula en contravía y colisiona de frente con A"},
+     "El muchacho venía en contramano por la vía", {"C13"}),
+    ("giro", {"descripcion": "Vehículo A gira a la izquierda en la intersección y B sigue derecho"},
+     "Yo estaba doblando a la izquierda con la flecha y el otro no paró en el pare", {"C10", "C5"}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ruta", default="app/utils/Descripción Circunstancias.xlsx")
+    parser.add_argument("--top-k", type=int, default=6)
+    args = parser.parse_args()
+
+    indice = IndiceMarcus.desde_excel(args.ruta)
+    completo = len(indice.contexto_completo)
+    print(f"Contexto completo: {completo} caracteres (~{completo // 4} tokens)\n")
+    print(f"{'caso':<10} {'seleccion':<32} {'esperadas':>9} {'chars':>6} {'ahorro':>7} {'ms':>6}")
+
+    aciertos = total = ahorro_total = 0
+    for nombre, visual, transcripcion, esperadas in CASOS:
+        t0 = time.perf_counter()
+        sel = indice.seleccionar(visual, transcripcion, top_k=args.top_k)
+        ms = (time.perf_counter() - t0) * 1000
+        elegidas = set(sel.ids) if not sel.completo else {f["id"].split(":")[0] for f in indice.filas}
+        ok = len(esperadas & elegidas)
+        aciertos += ok
+        total += len(esperadas)
+        ahorro = 1 - len(sel.contexto) / completo
+        ahorro_total += ahorro
+        etiqueta = "COMPLETO (" + sel.motivo + ")" if sel.completo else ",".join(sel.ids)
+        print(f"{nombre:<10} {etiqueta[:32]:<32} {ok:>4}/{len(esperadas):<4} {len(sel.contexto):>6} "
+              f"{ahorro:>6.0%} {ms:>6.2f}")
+
+    print(f"\nRecall de circunstancias esperadas: {aciertos}/{total} | ahorro medio: {ahorro_total / len(CASOS):.0%}")
+
+
+if __name__ == "__main__":
+    main()
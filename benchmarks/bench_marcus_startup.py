@@ -0,0 +1,69 @@
+"""
+Benchmark del arranque: carga del contexto Marcus en un proceso nuevo.
+
+Compara, cada uno en un subproceso limpio (incluye el costo de imports):
+  - pandas:      la carga anterior (import pandas + read_excel + iterrows)
+  - compilado:   cargar_matriz_marcus leyendo el artefacto JSON vigente
+  - recompilar:  cargar_matriz_marcus sin artefacto (compila con openpyxl)
+
+Uso:
+    python -m benchmarks.bench_marcus_startup --repeticiones 5
+"""
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+RUTA_DEFECTO = "app/utils/Descripción Circunstancias.xlsx"
+
+_PANDAS = """
+import pandas as pd
+df = pd.read_excel(RUTA, sheet_name="Descripción")
+df = df.rename(columns={"CIRCUNSTANCIAS": "id", "CODIGO NACIONAL DE TRANSITO": "codigo", "DESCRIPCION CESVI": "descripcion"})
+texto = ""
+for _, fila in df.iterrows():
+    texto += f"{fila['id']}:\\n- Descripción CESVI: {fila['descripcion']}\\n- Fundamento legal (Código Nacional de Tránsito): {fila['codigo']}\\n\\n"
+"""
+
+_LOADER = """
+from app.commons.services.matrix_loader import cargar_matriz_marcus
+cargar_matriz_marcus(RUTA)
+"""
+
+
+def _medir(codigo: str, ruta: str, repeticiones: int, env=None) -> float:
+    script = f"import time; t0 = time.perf_counter()\nRUTA = {ruta!r}\n{codigo}\nprint(time.perf_counter() - t0)"
+    tiempos = []
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                                env={**os.environ, **(env or {})}, check=True)
+        tiempos.append(float(salida.stdout.strip().splitlines()[-1]))
+    return statistics.median(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ruta", default=RUTA_DEFECTO)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    from app.commons.services.matrix_loader import cargar_matriz_marcus
+    cargar_matriz_marcus(args.ruta)  # deja el artefacto vigente
+
+    print(f"{'modo':<12} {'mediana ms':>11}")
+    try:
+        import pandas  # noqa: F401
+        print(f"{'pandas':<12} {_medir(_PANDAS, args.ruta, args.repeticiones) * 1000:>11.1f}")
+    except ImportError:
+        print(f"{'pandas':<12} {'(no instalado)':>11}")
+    print(f"{'compilado':<12} {_medir(_LOADER, args.ruta, args.repeticiones) * 1000:>11.1f}")
+    with tempfile.TemporaryDirectory() as tmp:
+        # Destino no escribible → recompila en cada corrida
+        env = {"MARCUS_ARTEFACTO": os.path.join(tmp, "no_existe", "marcus.json")}
+        print(f"{'recompilar':<12} {_medir(_LOADER, args.ruta, args.repeticiones, env) * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark de rasterización de PDF: serial vs pool de procesos.
+
+Genera un PDF sintético de N páginas con "fotos" (ruido RGB a pantalla
+completa, costoso de comprimir como una foto real) y compara el throughput
+de `renderizar_pdf_en_memoria` con distintos tamaños de pool.
+
+Uso:
+    python -m benchmarks.bench_pdf_render --paginas 30 --workers 1 2 4
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import fitz  # PyMuPDF
+
+from app.commons.services.pdf_render import renderizar_pdf_en_memoria
+
+
+def generar_pdf_sintetico(ruta: str, paginas: int, lado_foto: int = 1200) -> str:
+    doc = fitz.open()
+    for i in range(paginas):
+        page = doc.new_page()  # A4
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, lado_foto, lado_foto), False)
+        pix.set_rect(pix.irect, (0, 0, 0))
+        # Ruido determinista por página (os.urandom es demasiado lento para 1200x1200)
+        semilla = bytes((i * 37 + k * 11) % 251 for k in range(4096))
+        pix.samples_mv[:] = (semilla * (len(pix.samples_mv) // len(semilla) + 1))[:len(pix.samples_mv)]
+        page.insert_image(page.rect, stream=pix.tobytes("jpeg", jpg_quality=85))
+        page.insert_text((36, 36), f"Foto inspección #{i + 1}", fontsize=14)
+    doc.save(ruta)
+    doc.close()
+    return ruta
+
+
+def medir(ruta: str, workers: int, repeticiones: int) -> float:
+    # Calentamiento: arranca el pool (una sola vez por proceso en producción)
+    renderizar_pdf_en_memoria(ruta, workers=workers, max_paginas=0)
+    t0 = time.perf_counter()
+    for _ in range(repeticiones):
+        paginas = renderizar_pdf_en_memoria(ruta, workers=workers, max_paginas=0)
+    return (time.perf_counter() - t0) / repeticiones, len(paginas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paginas", type=int, default=30)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta = generar_pdf_sintetico(os.path.join(tmp, "sintetico.pdf"), args.paginas)
+        print(f"PDF sintético: {args.paginas} páginas, {os.path.getsize(ruta) / 1024:.0f} KB | CPUs: {os.cpu_count()}")
+        base = None
+        for w in args.workers:
+            segundos, n = medir(ruta, w, args.repeticiones)
+            base = base or segundos
+            print(f"workers={w:<3} {segundos:7.3f} s/pdf  {n / segundos:7.1f} pág/s  speedup x{base / segundos:.2f}")
+
+
+if __name__ == "__main__":
+    main()
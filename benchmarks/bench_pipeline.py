@@ -0,0 +1,264 @@
+"""
+Benchmark end-to-end del pipeline sin red: un FakeLLM determinista (latencia,
+jitter, tasa de fallos y JSON enlatado por etapa) reemplaza a Gemini.
+
+Modos:
+  - pipeline: llama `_procesar_caso_por_rutas` desde `--concurrencia` hilos.
+  - api:      POST /process-case contra la app FastAPI (TestClient), con la
+              subida multipart, el guardado en disco y el threadpool incluidos.
+
+Reporta throughput (casos/s) y p50/p95/p99 por etapa y del caso completo, y
+guarda el resultado en `benchmarks/resultados/bench_pipeline/` con el commit
+actual para comparar entre versiones (`--comparar <json previo>`).
+
+Con `--cadena` el modelo falso se envuelve como en producción (métricas,
+limitador de cuota y context cache) para medir también ese overhead; con
+`--hedging` se agrega la capa de solicitudes duplicadas (útil con
+`--prob-lenta` para simular llamadas atascadas).
+
+Uso:
+    python -m benchmarks.bench_pipeline --modo pipeline --casos 40 --concurrencia 8
+    python -m benchmarks.bench_pipeline --modo api --casos 20 --comparar benchmarks/resultados/bench_pipeline/<previo>.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+DIR_RESULTADOS = Path(__file__).resolve().parent / "resultados" / "bench_pipeline"
+ETAPAS = ("visual", "ficha", "audio", "circunstancias", "precision")
+
+
+def percentil(valores: List[float], p: float) -> float:
+    """Percentil con interpolación lineal (p en 0..100)."""
+    if not valores:
+        return 0.0
+    orden = sorted(valores)
+    k = (len(orden) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(orden) - 1)
+    return orden[i] + (orden[j] - orden[i]) * (k - i)
+
+
+def _resumen_latencias(valores: List[float]) -> Dict[str, float]:
+    return {
+        "n": len(valores),
+        "p50": round(percentil(valores, 50), 4),
+        "p95": round(percentil(valores, 95), 4),
+        "p99": round(percentil(valores, 99), 4),
+        "max": round(max(valores), 4) if valores else 0.0,
+    }
+
+
+def _commit_actual() -> Dict[str, Any]:
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             check=True).stdout.strip()
+        sucio = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True).stdout.strip())
+        return {"commit": sha, "sucio": sucio}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": "desconocido", "sucio": None}
+
+
+# ============================================================
+# MODELO FALSO
+# ============================================================
+def _construir_llm(args):
+    from app.commons.services.fake_llm import FakeLLM
+    from benchmarks.fixtures_pipeline import respuesta_por_etapa
+
+    fake = FakeLLM(
+        respuesta=respuesta_por_etapa,
+        latencia_s=args.latencia,
+        jitter_s=args.jitter,
+        prob_error=args.prob_error,
+        prob_429=args.prob_429,
+        prob_lenta=args.prob_lenta,
+        latencia_lenta_s=args.latencia_lenta,
+        semilla=args.semilla,
+    )
+    llm = fake
+    if args.cadena:
+        from app.commons.services.metrics import envolver_con_metricas
+        from app.commons.services.rate_limiter import envolver_con_limitador
+        llm = envolver_con_metricas(llm, args.modelo_limites)
+        llm = envolver_con_limitador(llm, args.modelo_limites)
+    if args.hedging:
+        from app.commons.services.hedging import HedgedLLM, EstadoHedge, config_hedging
+        # Misma config que producción, pero activada aunque el JSON la tenga deshabilitada
+        llm = HedgedLLM(llm, EstadoHedge("bench", config_hedging(args.modelo_limites)))
+    if args.cadena:
+        from app.commons.services.context_cache import envolver_con_context_cache
+        llm = envolver_con_context_cache(llm, args.modelo_limites)
+    return fake, llm
+
+
+# ============================================================
+# MODOS
+# ============================================================
+def _caso_pipeline(mainAPI, rutas: Dict[str, str], llm, contexto_marcus) -> Dict[str, Any]:
+    resultado = mainAPI._procesar_caso_por_rutas(
+        uuid.uuid4().hex, rutas["visual"], rutas["ficha"], rutas["audio"], llm, contexto_marcus,
+    )
+    return resultado
+
+
+def _caso_api(cliente, rutas: Dict[str, str]) -> Dict[str, Any]:
+    with open(rutas["visual"], "rb") as v, open(rutas["ficha"], "rb") as f, open(rutas["audio"], "rb") as a:
+        r = cliente.post("/process-case", files={
+            "visual_pdf": ("visual.pdf", v, "application/pdf"),
+            "ficha_png": ("ficha.png", f, "image/png"),
+            "audio": ("audio.wav", a, "audio/wav"),
+        })
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}: {r.text[:200]}")
+    return r.json()
+
+
+def correr(args) -> Dict[str, Any]:
+    # WORKDIR antes de importar mainAPI: las salidas del benchmark no ensucian /tmp/motor_resp
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench_pipeline_"))
+    os.environ["WORKDIR"] = str(workdir)
+    import mainAPI
+    from app.commons.services.checkpoints import es_resultado_error
+    from app.commons.services.marcus_index import IndiceMarcus
+    from app.Funciones.pipeline_caso import CLAVES_RESULTADO
+    from benchmarks.fixtures_pipeline import generar_fixtures_caso
+
+    rutas = generar_fixtures_caso(workdir / "fixtures", paginas_pdf=args.paginas,
+                                  duracion_audio_s=args.duracion_audio)
+    contexto_marcus = IndiceMarcus.desde_excel(args.marcus) if args.marcus else "Contexto Marcus de prueba."
+    fake, llm = _construir_llm(args)
+
+    if args.modo == "api":
+        from fastapi.testclient import TestClient
+        mainAPI.app.state.gemini = llm
+        mainAPI.app.state.contexto_marcus = contexto_marcus
+        cliente = TestClient(mainAPI.app)  # sin lifespan: no carga modelos reales
+        tarea = lambda: _caso_api(cliente, rutas)  # noqa: E731
+    else:
+        tarea = lambda: _caso_pipeline(mainAPI, rutas, llm, contexto_marcus)  # noqa: E731
+
+    for _ in range(args.calentamiento):
+        try:
+            tarea()
+        except Exception:
+            pass
+
+    por_etapa: Dict[str, List[float]] = {e: [] for e in ETAPAS}
+    total_caso: List[float] = []
+    fallos: List[str] = []
+    # Las etapas devuelven {"error": ...} en vez de lanzar: el caso termina pero con errores
+    errores_etapa: Dict[str, int] = {e: 0 for e in ETAPAS}
+
+    def _medido():
+        t0 = time.perf_counter()
+        resultado = tarea()
+        return time.perf_counter() - t0, resultado
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        for futuro in as_completed([pool.submit(_medido) for _ in range(args.casos)]):
+            try:
+                duracion, resultado = futuro.result()
+            except Exception as e:
+                fallos.append(str(e)[:200])
+                continue
+            total_caso.append(duracion)
+            tiempos = resultado["tiempos_etapas"]
+            for etapa in ETAPAS:
+                if etapa in tiempos:
+                    por_etapa[etapa].append(tiempos[etapa])
+                if es_resultado_error(resultado.get(CLAVES_RESULTADO[etapa])):
+                    errores_etapa[etapa] += 1
+    pared = time.perf_counter() - t0
+
+    return {
+        **_commit_actual(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("comparar", "workdir")},
+        "pared_s": round(pared, 3),
+        "throughput_casos_s": round(len(total_caso) / pared, 3) if pared else 0.0,
+        "ok": len(total_caso),
+        "fallidos": len(fallos),
+        "con_errores_etapa": errores_etapa,
+        "errores_muestra": fallos[:5],
+        "llm": dict(fake.stats),
+        "caso": _resumen_latencias(total_caso),
+        "etapas": {e: _resumen_latencias(v) for e, v in por_etapa.items()},
+    }
+
+
+# ============================================================
+# REPORTE / HISTÓRICO
+# ============================================================
+def _imprimir(res: Dict[str, Any], base: Optional[Dict[str, Any]] = None):
+    print(f"\ncommit {res['commit']}{' (sucio)' if res['sucio'] else ''} | modo={res['parametros']['modo']} "
+          f"| casos ok={res['ok']} fallidos={res['fallidos']} | {res['throughput_casos_s']} casos/s "
+          f"| llamadas LLM={res['llm']['llamadas']}")
+    errores = {e: n for e, n in res.get("con_errores_etapa", {}).items() if n}
+    if errores:
+        print(f"etapas con error: {errores}")
+    print(f"{'etapa':<16} {'n':>4} {'p50':>8} {'p95':>8} {'p99':>8}" + ("   Δp50     Δp95" if base else ""))
+    filas = [(e, res["etapas"][e], (base or {}).get("etapas", {}).get(e)) for e in ETAPAS]
+    filas.append(("caso completo", res["caso"], (base or {}).get("caso")))
+    for nombre, r, b in filas:
+        linea = f"{nombre:<16} {r['n']:>4} {r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f}"
+        if b:
+            linea += f" {r['p50'] - b['p50']:>+8.3f} {r['p95'] - b['p95']:>+8.3f}"
+        print(linea)
+    if base:
+        print(f"throughput: {res['throughput_casos_s']} vs {base['throughput_casos_s']} casos/s "
+              f"(base {base.get('commit')})")
+
+
+def guardar(res: Dict[str, Any]) -> Path:
+    DIR_RESULTADOS.mkdir(parents=True, exist_ok=True)
+    ruta = DIR_RESULTADOS / f"{datetime.now():%Y%m%d_%H%M%S}_{res['commit']}_{res['parametros']['modo']}.json"
+    ruta.write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+    return ruta
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modo", choices=("pipeline", "api"), default="pipeline")
+    parser.add_argument("--casos", type=int, default=40)
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--calentamiento", type=int, default=1, help="Casos descartados antes de medir.")
+    parser.add_argument("--latencia", type=float, default=0.2, help="Latencia media del LLM falso (s).")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--prob-error", type=float, default=0.0, help="Fallos no-cuota por llamada.")
+    parser.add_argument("--prob-429", type=float, default=0.0)
+    parser.add_argument("--prob-lenta", type=float, default=0.0, help="Probabilidad de llamada atascada.")
+    parser.add_argument("--latencia-lenta", type=float, default=5.0, help="Duración de una llamada atascada (s).")
+    parser.add_argument("--semilla", type=int, default=7)
+    parser.add_argument("--paginas", type=int, default=2, help="Páginas del PDF sintético.")
+    parser.add_argument("--duracion-audio", type=float, default=20.0, help="Segundos del WAV sintético.")
+    parser.add_argument("--marcus", default=None, help="Excel Marcus real (por defecto un contexto corto).")
+    parser.add_argument("--cadena", action="store_true", help="Envuelve con métricas + limitador + context cache.")
+    parser.add_argument("--hedging", action="store_true", help="Envuelve con HedgedLLM (config `hedging`).")
+    parser.add_argument("--modelo-limites", default="gemini-1.5-flash", help="Clave de límites para --cadena.")
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--comparar", default=None, help="JSON de una corrida anterior para mostrar deltas.")
+    parser.add_argument("--no-guardar", action="store_true")
+    args = parser.parse_args(argv)
+
+    res = correr(args)
+    base = json.loads(Path(args.comparar).read_text(encoding="utf-8")) if args.comparar else None
+    _imprimir(res, base)
+    if not args.no_guardar:
+        print(f"💾 {guardar(res)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
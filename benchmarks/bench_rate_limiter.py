@@ -0,0 +1,65 @@
+"""
+Benchmark del limitador de llamadas LLM contra un FakeLLM con cuota simulada.
+
+Lanza N llamadas desde varios hilos (como un lote de casos) contra un modelo
+que rechaza con 429 por encima de `--cuota-concurrencia` llamadas simultáneas
+y al azar con `--prob-429`. Compara llamadas directas vs. RateLimitedLLM:
+éxitos, 429 vistos por el proveedor y tiempo total.
+
+Uso:
+    python -m benchmarks.bench_rate_limiter --llamadas 200 --hilos 32
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from app.commons.services.fake_llm import FakeLLM
+from app.commons.services.rate_limiter import ConcurrenciaAIMD, LimitadorModelo, RateLimitedLLM
+
+
+def _correr(llm, llamadas: int, hilos: int):
+    exitos = fallos = 0
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        for futuro in [pool.submit(llm.invoke, "hola") for _ in range(llamadas)]:
+            try:
+                futuro.result()
+                exitos += 1
+            except Exception:
+                fallos += 1
+    return exitos, fallos, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llamadas", type=int, default=200)
+    parser.add_argument("--hilos", type=int, default=32)
+    parser.add_argument("--latencia", type=float, default=0.05)
+    parser.add_argument("--cuota-concurrencia", type=int, default=6)
+    parser.add_argument("--prob-429", type=float, default=0.02)
+    parser.add_argument("--rpm", type=float, default=0, help="Token bucket RPM del limitador (0 = sin límite).")
+    args = parser.parse_args()
+
+    def _fake():
+        return FakeLLM(latencia_s=args.latencia, jitter_s=args.latencia / 2,
+                       max_concurrencia=args.cuota_concurrencia, prob_429=args.prob_429, semilla=7)
+
+    print(f"{'modo':<12} {'ok':>6} {'fallos':>7} {'429 prov':>9} {'max vuelo':>10} {'seg':>7}")
+
+    directo = _fake()
+    ok, fallos, dt = _correr(directo, args.llamadas, args.hilos)
+    print(f"{'directo':<12} {ok:>6} {fallos:>7} {directo.stats['rechazadas_429']:>9} "
+          f"{directo.stats['max_en_vuelo']:>10} {dt:>7.2f}")
+
+    fake = _fake()
+    limitador = LimitadorModelo("bench", rpm=args.rpm, tpm=0,
+                                concurrencia=ConcurrenciaAIMD(inicial=4, minimo=1, maximo=32))
+    limitado = RateLimitedLLM(fake, limitador, max_reintentos=8, backoff_base_s=0.05, backoff_max_s=1.0)
+    ok, fallos, dt = _correr(limitado, args.llamadas, args.hilos)
+    print(f"{'limitado':<12} {ok:>6} {fallos:>7} {fake.stats['rechazadas_429']:>9} "
+          f"{fake.stats['max_en_vuelo']:>10} {dt:>7.2f}")
+    print(f"limitador: {limitador.resumen()}")
+
+
+if __name__ == "__main__":
+    main()
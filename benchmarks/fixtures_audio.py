@@ -0,0 +1,51 @@
+"""
+Generador de audios sintéticos tipo llamada (WAV PCM 16-bit) para benchmarks.
+
+Alterna tramos de "voz" (tono con formantes modulados y ruido) con silencios
+de distinta longitud, incluyendo silencio inicial y final, en estéreo 44.1 kHz
+como las grabaciones de call center.
+"""
+import math
+import wave
+import random
+import struct
+
+
+def generar_wav_llamada(
+        ruta: str,
+        duracion_s: float,
+        sample_rate: int = 44100,
+        canales: int = 2,
+        semilla: int = 7,
+) -> str:
+    rnd = random.Random(semilla)
+    tramos = [("silencio", 2.5)]
+    t = 2.5
+    while t < duracion_s - 3:
+        voz = rnd.uniform(2.0, 9.0)
+        pausa = rnd.choice([0.3, 0.5, 0.8, 1.5, 3.0, 6.0])
+        tramos += [("voz", voz), ("silencio", pausa)]
+        t += voz + pausa
+    tramos.append(("silencio", max(0.5, duracion_s - t)))
+
+    with wave.open(ruta, "wb") as wav:
+        wav.setnchannels(canales)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        n_global = 0
+        for tipo, seg in tramos:
+            frames = bytearray()
+            f0 = rnd.uniform(110, 220)
+            for _ in range(int(seg * sample_rate)):
+                if tipo == "voz":
+                    tt = n_global / sample_rate
+                    env = 0.5 + 0.5 * math.sin(2 * math.pi * 4 * tt)  # ~sílabas
+                    x = (math.sin(2 * math.pi * f0 * tt) + 0.4 * math.sin(2 * math.pi * 3 * f0 * tt)) * env
+                    x += rnd.uniform(-0.05, 0.05)
+                    muestra = int(max(-1.0, min(1.0, 0.4 * x)) * 32767)
+                else:
+                    muestra = int(rnd.uniform(-0.001, 0.001) * 32767)  # ruido de piso (~ -60 dB)
+                frames += struct.pack("<h", muestra) * canales
+                n_global += 1
+            wav.writeframes(bytes(frames))
+    return ruta
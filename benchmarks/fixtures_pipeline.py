@@ -0,0 +1,100 @@
+"""
+Fixtures sintéticos de un caso completo (PDF visual, PNG ficha, audio WAV) y
+respuestas enlatadas por etapa para correr el pipeline con `FakeLLM`.
+
+La respuesta se elige según la etapa en curso (`ETAPA_ACTUAL`), así un solo
+modelo falso sirve a las 5 etapas en paralelo.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict
+
+import fitz  # PyMuPDF
+
+from app.commons.services.stage_scheduler import ETAPA_ACTUAL
+from benchmarks.fixtures_audio import generar_wav_llamada
+
+RESPUESTAS_ETAPA: Dict[str, str] = {
+    "visual": json.dumps({
+        "metadata_analisis": {"numero_imagenes_analizadas": 2, "calidad_evidencia_global": "regular"},
+        "observaciones_objetivas": {
+            "descripcion_general_escena": "Vía urbana de dos carriles, vehículos alineados en el mismo carril.",
+            "vehiculo_a": {"analisis_danos_detallado": {"zona_impacto_primario": "trasero_completo"}},
+            "vehiculo_b": {"analisis_danos_detallado": {"zona_impacto_primario": "frontal_completo"}},
+        },
+        "inferencias_tecnicas": {
+            "reconstruccion_impacto": {"secuencia_impacto_inferida": "B golpea por alcance a A detenido."},
+        },
+        "limitaciones_y_incertidumbres": {"nivel_confianza_global": "medio 50-75%"},
+    }, ensure_ascii=False),
+    "ficha": json.dumps({
+        "metadata_extraccion": {"tipo_documento": "reporte_siniestro", "calidad_legibilidad": "buena"},
+        "datos_siniestro": {
+            "causa": "5 - Responsabilidad de otros",
+            "descripcion_detallada_relato": "El tercero me chocó por detrás mientras estaba detenido en el semáforo.",
+        },
+        "vehiculo_asegurado": {"placa": "ABC123"},
+        "datos_tercero": {"placa": "XYZ789"},
+    }, ensure_ascii=False),
+    "audio": (
+        "Asesor: Buenas tardes, cuénteme qué pasó. Cliente: Estaba detenido en el semáforo en rojo "
+        "y el carro de atrás no frenó a tiempo y me golpeó la parte trasera. Asesor: ¿Hubo heridos? "
+        "Cliente: No, solo daños en el paragolpes trasero."
+    ),
+    "circunstancias": json.dumps({
+        "analisis_por_vehiculo": {
+            "vehiculo_a": {"circunstancia_marcus": {"id": "C6", "descripcion": "Detenido normalmente"}},
+            "vehiculo_b": {"circunstancia_marcus": {"id": "C3", "descripcion": "Golpea por alcance"}},
+        },
+        "conclusion_general_del_caso": {
+            "determinacion_responsabilidad_primaria": "Vehiculo_B",
+            "porcentaje_responsabilidad": {"vehiculo_a": "0%", "vehiculo_b": "100%"},
+        },
+    }, ensure_ascii=False),
+    "precision": json.dumps({
+        "asociacion_vehiculo": {"placa_ficha": "ABC123", "rol_visual": "Vehiculo_A"},
+        "responsabilidad_visual": {"responsable_primario_visual": "vehiculo_b",
+                                   "porcentaje_vehiculo_a": 0, "porcentaje_vehiculo_b": 100},
+        "evaluacion_precision": {"coherencia_cualitativa": "alta", "precision_global": 90,
+                                 "explicacion_detallada": "La ficha coincide con los daños observados."},
+    }, ensure_ascii=False),
+}
+
+
+def respuesta_por_etapa(_mensajes: Any) -> str:
+    return RESPUESTAS_ETAPA.get(ETAPA_ACTUAL.get() or "", '{"ok": true}')
+
+
+def generar_pdf(ruta: Path, paginas: int = 2) -> Path:
+    doc = fitz.open()
+    for i in range(paginas):
+        pagina = doc.new_page()
+        pagina.insert_text((72, 72), f"Informe fotográfico del siniestro - página {i + 1}", fontsize=14)
+        pagina.draw_rect(fitz.Rect(72, 120, 520, 420), color=(0.2, 0.2, 0.2), fill=(0.7, 0.75, 0.8))
+    doc.save(str(ruta))
+    doc.close()
+    return ruta
+
+
+def generar_png(ruta: Path, ancho: int = 1200, alto: int = 1600) -> Path:
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, ancho, alto), False)
+    pix.clear_with(230)
+    pix.save(str(ruta))
+    return ruta
+
+
+def generar_fixtures_caso(directorio: Path, paginas_pdf: int = 2, duracion_audio_s: float = 20.0) -> Dict[str, str]:
+    """Crea (una sola vez) los 3 archivos de un caso y devuelve sus rutas."""
+    directorio.mkdir(parents=True, exist_ok=True)
+    rutas = {
+        "visual": directorio / "visual.pdf",
+        "ficha": directorio / "ficha.png",
+        "audio": directorio / "audio.wav",
+    }
+    if not rutas["visual"].exists():
+        generar_pdf(rutas["visual"], paginas_pdf)
+    if not rutas["ficha"].exists():
+        generar_png(rutas["ficha"])
+    if not rutas["audio"].exists():
+        generar_wav_llamada(str(rutas["audio"]), duracion_audio_s, sample_rate=16000, canales=1)
+    return {k: str(v) for k, v in rutas.items()}
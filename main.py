@@ -1,30 +1,25 @@
 import os
+import sys
 import json
+import time
+import argparse
 import dotenv
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
 from langchain.globals import set_debug
 
 from app.commons.services.llm_manager import load_llms
-from app.commons.services.matrix_loader import cargar_matriz_marcus
-
-from app.Funciones.procesar_audio import transcribir_audio_gemini
-from app.Funciones.procesar_imagen import procesar_imagen, procesar_imagen_ficha
-from app.Funciones.Procesar_circunstancias import evaluar_circunstancias_marcus
-from app.Funciones.presicion import evaluar_coherencia_visual_vs_ficha
-
-
-# ============================================================
-# CONFIGURACIÓN GENERAL
-# ============================================================
-
-dotenv.load_dotenv()
-set_debug(False)
-os.environ["APP_ENV"] = os.environ.get("APP_ENV", "sbx")
+from app.commons.services.marcus_index import IndiceMarcus
+from app.commons.services.prompt_registry import validar_prompts
+from app.commons.services.checkpoints import CheckpointCaso, es_resultado_error
+from app.commons.services.cancelacion import cancelacion_caso, config_plazos
 
-llms = load_llms()
-gemini = llms["gemini_pro"]
+from app.commons.services.stage_scheduler import ejecutar_etapas
 
-ruta_excel_marcus = r"app/utils/Descripción Circunstancias.xlsx"
-contexto_marcus = cargar_matriz_marcus(ruta_excel_marcus)
+from app.Funciones.pipeline_caso import construir_etapas_caso, huellas_etapas, precargar_checkpoint, ARCHIVOS_SALIDA
 
 
 # ============================================================
@@ -35,6 +30,14 @@ EXT_VISUAL = {".pdf"}             # imagen para análisis visual
 EXT_FICHA = {".png"}              # imagen para FICHA DEL SINIESTRO
 EXT_AUDIO = {".mp3", ".wav", ".m4a", ".ogg"}
 
+MENSAJES_ETAPA = {
+    "visual": "🖼️ Hechos visuales extraídos OK.",
+    "ficha": "📄 Ficha del siniestro extraída OK.",
+    "audio": "🗣️ Transcripción OK.",
+    "circunstancias": "📘 Resultado circunstancias OK.",
+    "precision": "🎯 Evaluación de precisión OK.",
+}
+
 
 # ============================================================
 # UTILIDADES
@@ -54,15 +57,10 @@ def _listar_archivos_por_extension(directorio, extensiones):
     return archivos
 
 
-def _ensure_dir(path_dir):
-    os.makedirs(path_dir, exist_ok=True)
-
-
 def _save_json(data, path_file):
     try:
         with open(path_file, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"💾 Guardado JSON: {path_file}")
     except Exception as e:
         print(f"⚠️ No se pudo guardar {path_file}: {e}")
 
@@ -71,106 +69,173 @@ def _save_text(text, path_file):
     try:
         with open(path_file, "w", encoding="utf-8") as f:
             f.write(text if isinstance(text, str) else str(text))
-        print(f"💾 Guardado TXT: {path_file}")
     except Exception as e:
         print(f"⚠️ No se pudo guardar {path_file}: {e}")
 
 
 # ============================================================
-# DIRECTORIOS PRINCIPALES
+# UN CASO (con checkpoint por etapa)
 # ============================================================
 
-raiz_casos = r"./inputs"
-out_root = r"C:\Users\1032497498\PycharmProjects\Motor__responsabilidad\outputs"
-
-
-# ============================================================
-# LOOP PRINCIPAL
-# ============================================================
-
-if not os.path.isdir(raiz_casos):
-    raise FileNotFoundError(f"Directorio raíz no encontrado: {raiz_casos}")
-
-subdirectorios = [
-    os.path.join(raiz_casos, d)
-    for d in sorted(os.listdir(raiz_casos))
-    if os.path.isdir(os.path.join(raiz_casos, d))
-]
-
-if not subdirectorios:
-    print(f"No se encontraron casos en: {raiz_casos}")
-
-
-for dir_caso in subdirectorios:
+def procesar_caso(
+        dir_caso: str,
+        out_root: str,
+        gemini,
+        contexto_marcus: IndiceMarcus,
+        forzar: bool = False,
+        modelos: Optional[Callable[[str], Any]] = None,
+) -> Dict[str, Any]:
     nombre_caso = os.path.basename(dir_caso)
-    print(f"\n================= CASO: {nombre_caso} =================")
+    t0 = time.perf_counter()
+    resumen: Dict[str, Any] = {"caso": nombre_caso}
 
-    # Buscar archivos específicos
     visual_pdf = _listar_archivos_por_extension(dir_caso, EXT_VISUAL)
     ficha_png = _listar_archivos_por_extension(dir_caso, EXT_FICHA)
     audios = _listar_archivos_por_extension(dir_caso, EXT_AUDIO)
+    faltantes = [n for n, a in (("PDF visual", visual_pdf), ("PNG ficha", ficha_png), ("audio", audios)) if not a]
+    if faltantes:
+        print(f"⚠️  [{nombre_caso}] Sin {', '.join(faltantes)}. Se omite.")
+        return {**resumen, "estado": "omitido", "motivo": f"Faltan: {', '.join(faltantes)}"}
+
+    ruta_visual, ruta_ficha, ruta_audio = visual_pdf[0], ficha_png[0], audios[0]
+    out_case_dir = Path(out_root) / nombre_caso
+    out_case_dir.mkdir(parents=True, exist_ok=True)
+
+    etapas = construir_etapas_caso(ruta_visual, ruta_ficha, ruta_audio, gemini, contexto_marcus, modelos=modelos)
+    huellas = huellas_etapas(ruta_visual, ruta_ficha, ruta_audio, contexto_marcus)
+    checkpoint = CheckpointCaso(out_case_dir)
+
+    precargados = {} if forzar else precargar_checkpoint(etapas, huellas, checkpoint)
+
+    if len(precargados) == len(etapas):
+        print(f"♻️  [{nombre_caso}] Todas las etapas vigentes en checkpoint. Se omite.")
+        return {**resumen, "estado": "reutilizado", "etapas_reutilizadas": list(precargados),
+                "etapas_ejecutadas": [], "errores": {}, "tiempos": {},
+                "duracion_s": round(time.perf_counter() - t0, 3)}
+
+    errores_etapa: Dict[str, str] = {}
+
+    def _guardar(etapa, resultado, duracion):
+        ruta = out_case_dir / ARCHIVOS_SALIDA[etapa]
+        if etapa == "audio":
+            _save_text(resultado, ruta)
+        else:
+            _save_json(resultado, ruta)
+        if es_resultado_error(resultado):
+            # Se guarda para inspección, pero sin checkpoint: se reintenta en la próxima corrida
+            errores_etapa[etapa] = str(resultado.get("error")) if isinstance(resultado, dict) else "salida vacía"
+            print(f"❌ [{nombre_caso}] Etapa '{etapa}' devolvió error: {errores_etapa[etapa]}")
+            return
+        checkpoint.registrar(etapa, huellas[etapa], ARCHIVOS_SALIDA[etapa])
+        print(f"{MENSAJES_ETAPA[etapa]} [{nombre_caso}] ({duracion:.1f}s)")
+
+    # Plazo por caso y por etapa (config `plazos`); lo ya guardado queda en el checkpoint
+    plan = ejecutar_etapas(etapas, precargados=precargados, on_fin=_guardar, cancelacion=cancelacion_caso(),
+                           intervalo_sondeo_s=float(config_plazos().get("intervalo_sondeo_s", 0.5)))
+
+    errores = {**errores_etapa, **plan.errores}
+    for etapa, error in plan.errores.items():
+        print(f"❌ [{nombre_caso}] Etapa '{etapa}' con error: {error}")
+
+    return {
+        **resumen,
+        "estado": "cancelado" if plan.cancelado else ("con_errores" if errores else "completo"),
+        "etapas_reutilizadas": plan.reutilizadas,
+        "etapas_ejecutadas": sorted(plan.tiempos),
+        "errores": errores,
+        "tiempos": plan.tiempos,
+        "duracion_s": round(time.perf_counter() - t0, 3),
+    }
 
-    if not visual_pdf:
-        print(f"⚠️  Sin PDF para análisis visual en {nombre_caso}. Se omite.")
-        continue
-
-    if not ficha_png:
-        print(f"⚠️  Sin PNG para la ficha del siniestro en {nombre_caso}. Se omite.")
-        continue
-
-    if not audios:
-        print(f"⚠️  Sin audio en {nombre_caso}. Se omite.")
-        continue
-
-    ruta_visual = visual_pdf[0]
-    ruta_ficha = ficha_png[0]
-    ruta_audio = audios[0]
-
-    # Carpeta salida
-    out_case_dir = os.path.join(out_root, nombre_caso)
-    _ensure_dir(out_case_dir)
-
-    # ============================================================
-    # 1) ANALISIS VISUAL
-    # ============================================================
-    hechos_visual = procesar_imagen(ruta_visual, llm=gemini)
-    print("🖼️ Hechos visuales extraídos OK.")
-    _save_json(hechos_visual, os.path.join(out_case_dir, "hechos_visual.json"))
-
-    # ============================================================
-    # 2) FICHA DEL SINIESTRO (PNG)
-    # ============================================================
-    ficha_siniestro = procesar_imagen_ficha(ruta_ficha, gemini)
-    print("📄 Ficha del siniestro extraída OK.")
-    _save_json(ficha_siniestro, os.path.join(out_case_dir, "ficha_siniestro.json"))
-
-    # ============================================================
-    # 3) TRANSCRIPCIÓN AUDIO
-    # ============================================================
-    texto_transcrito = transcribir_audio_gemini(ruta_audio, llm=gemini)
-    print("🗣️ Transcripción OK.")
-    _save_text(texto_transcrito, os.path.join(out_case_dir, "transcripcion.txt"))
-
-    # ============================================================
-    # 4) EVALUAR CIRCUNSTANCIAS MARCUS
-    # ============================================================
-    resultado_circunstancias = evaluar_circunstancias_marcus(
-        contexto_marcus=contexto_marcus,
-        json_visual=hechos_visual.get("resultado", hechos_visual),
-        json_transcripcion=texto_transcrito,
-        llm=gemini
-    )
-    print("📘 Resultado circunstancias OK.")
-    _save_json(resultado_circunstancias, os.path.join(out_case_dir, "resultado_circunstancias.json"))
-
-    # ============================================================
-    # 5) EVALUAR PRECISIÓN VISUAL VS FICHA
-    # ============================================================
-    resultado_precision = evaluar_coherencia_visual_vs_ficha(
-        llm=gemini,
-        json_analisis_visual=json.dumps(hechos_visual),
-        json_ficha_siniestro=json.dumps(ficha_siniestro)
-    )
 
-    print("🎯 Evaluación de precisión OK.")
-    _save_json(resultado_precision, os.path.join(out_case_dir, "precision_visual_vs_ficha.json"))
+# ============================================================
+# CORRIDA POR LOTES
+# ============================================================
+
+def _argumentos(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Procesa en lote las carpetas de casos (una subcarpeta por caso: PDF visual, PNG ficha y audio)."
+    )
+    parser.add_argument("--entrada", default="./inputs", help="Carpeta raíz con una subcarpeta por caso.")
+    parser.add_argument("--salida", default=os.environ.get("OUTPUT_DIR", "./outputs"),
+                        help="Carpeta de salida (env OUTPUT_DIR).")
+    parser.add_argument("--paralelo", type=int, default=int(os.environ.get("CASOS_PARALELO", 2)),
+                        help="Casos procesados en paralelo (env CASOS_PARALELO).")
+    parser.add_argument("--forzar", action="store_true", help="Ignora los checkpoints y recalcula todo.")
+    parser.add_argument("--casos", nargs="*", help="Procesa solo estos casos (nombres de carpeta).")
+    parser.add_argument("--marcus", default=os.environ.get("MARCUS_XLSX_PATH", "app/utils/Descripción Circunstancias.xlsx"),
+                        help="Excel de la matriz Marcus (env MARCUS_XLSX_PATH).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _argumentos(argv)
+
+    dotenv.load_dotenv()
+    set_debug(False)
+    os.environ["APP_ENV"] = os.environ.get("APP_ENV", "sbx")
+
+    if not os.path.isdir(args.entrada):
+        raise FileNotFoundError(f"Directorio raíz no encontrado: {args.entrada}")
+
+    subdirectorios = [
+        os.path.join(args.entrada, d)
+        for d in sorted(os.listdir(args.entrada))
+        if os.path.isdir(os.path.join(args.entrada, d)) and (not args.casos or d in args.casos)
+    ]
+    if not subdirectorios:
+        print(f"No se encontraron casos en: {args.entrada}")
+        return 0
+
+    validar_prompts()
+    llms = load_llms()
+    gemini = llms["gemini_pro"]
+    contexto_marcus = IndiceMarcus.desde_excel(args.marcus)
+    os.makedirs(args.salida, exist_ok=True)
+
+    inicio = datetime.now()
+    t0 = time.perf_counter()
+    print(f"🚀 {len(subdirectorios)} caso(s) | paralelo={args.paralelo} | salida={args.salida}")
+
+    casos: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=max(1, args.paralelo), thread_name_prefix="caso") as pool:
+        futuros = {
+            pool.submit(procesar_caso, d, args.salida, gemini, contexto_marcus, args.forzar,
+                        modelos=llms.__getitem__): d
+            for d in subdirectorios
+        }
+        for futuro in as_completed(futuros):
+            nombre_caso = os.path.basename(futuros[futuro])
+            try:
+                casos.append(futuro.result())
+            except Exception as e:
+                # Un caso que revienta no detiene la corrida
+                print(f"❌ [{nombre_caso}] Falló: {e}")
+                casos.append({"caso": nombre_caso, "estado": "fallido", "errores": {"caso": str(e)}})
+            print(f"📊 {len(casos)}/{len(subdirectorios)} casos terminados")
+
+    casos.sort(key=lambda c: c["caso"])
+    conteo: Dict[str, int] = {}
+    for c in casos:
+        conteo[c["estado"]] = conteo.get(c["estado"], 0) + 1
+
+    resumen = {
+        "inicio": inicio.isoformat(timespec="seconds"),
+        "duracion_s": round(time.perf_counter() - t0, 3),
+        "entrada": os.path.abspath(args.entrada),
+        "paralelo": args.paralelo,
+        "forzar": args.forzar,
+        "total_casos": len(casos),
+        "por_estado": conteo,
+        "casos": casos,
+    }
+    ruta_resumen = os.path.join(args.salida, f"resumen_corrida_{inicio:%Y%m%d_%H%M%S}.json")
+    _save_json(resumen, ruta_resumen)
+
+    print(f"\n⏱️ Corrida terminada en {resumen['duracion_s']:.1f}s | {conteo}")
+    print(f"💾 Resumen: {ruta_resumen}")
+    return 1 if conteo.get("fallido") or conteo.get("con_errores") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
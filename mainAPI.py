@@ -1,12 +1,19 @@
 import os
 import json
+import logging
 import uuid
+import asyncio
+import shutil
 import dotenv
+import functools
+import contextvars
 from pathlib import Path
 from contextlib import asynccontextmanager
-from typing import Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.concurrency import run_in_threadpool
 
 # LangChain import compatible (old/new)
@@ -17,12 +24,45 @@ except Exception:
 
 # --- TU PROYECTO ---
 from app.commons.services.llm_manager import load_llms
-from app.commons.services.matrix_loader import cargar_matriz_marcus
-
-from app.Funciones.procesar_audio import transcribir_audio_gemini
-from app.Funciones.procesar_imagen import procesar_imagen, procesar_imagen_ficha
-from app.Funciones.Procesar_circunstancias import evaluar_circunstancias_marcus
-from app.Funciones.presicion import evaluar_coherencia_visual_vs_ficha
+from app.commons.services.marcus_index import IndiceMarcus
+from app.commons.services.llm_cache import obtener_cache
+from app.commons.services.rate_limiter import resumen_limitadores
+from app.commons.services.hedging import resumen_hedging
+from app.commons.services.context_cache import metricas_context_cache
+from app.commons.services.model_routing import estadisticas_enrutamiento
+from app.commons.services.metrics import CONTENT_TYPE_LATEST, caso_en_curso, exportar_metricas
+from app.commons.services.prompt_registry import validar_prompts
+from app.commons.services.miscelaneous import load_pipeline_parameters
+from app.commons.services.checkpoints import CheckpointCaso, es_resultado_error
+from app.commons.services.cancelacion import Cancelacion, CasoCancelado, cancelacion_caso, config_plazos
+from app.commons.services.job_queue import ColaTrabajos, ColaLlena, CasoEnCurso, crear_store
+from app.commons.services.upload_stream import (
+    ArchivoRecibido,
+    LimiteCuerpoMiddleware,
+    PresupuestoRequest,
+    UploadRechazado,
+    guardar_upload,
+)
+from app.commons.services.lote_casos import (
+    case_id_valido,
+    config_lotes,
+    extraer_zip_lote,
+    limite_bytes_lote,
+    parsear_manifiesto,
+)
+
+from app.commons.services.stage_scheduler import ejecutar_etapas
+
+from app.Funciones.pipeline_caso import (
+    ARCHIVOS_SALIDA,
+    CLAVES_RESULTADO,
+    ETAPAS_REQUERIDAS,
+    CasoFallido,
+    construir_etapas_caso,
+    errores_caso,
+    huellas_etapas,
+    precargar_checkpoint,
+)
 
 
 # ============================================================
@@ -38,6 +78,9 @@ EXT_VISUAL = {".pdf"}
 EXT_FICHA = {".png"}
 EXT_AUDIO = {".mp3", ".wav", ".m4a", ".ogg"}
 
+# Campo del formulario -> sufijo del archivo guardado
+CAMPOS_UPLOAD = {"visual_pdf": "visual", "ficha_png": "ficha", "audio": "audio"}
+
 
 def _save_json(data: Any, path_file: Path):
     path_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -55,8 +98,62 @@ def _validate_ext(filename: str, allowed: set, label: str):
         raise HTTPException(400, f"Archivo inválido para {label}. Ext permitidas: {sorted(list(allowed))}")
 
 
+def _validar_case_id(case_id: Optional[str]) -> str:
+    # El case_id arma nombres de archivo en UPLOAD_DIR y la carpeta de salida
+    if not case_id:
+        return uuid.uuid4().hex
+    if not case_id_valido(case_id):
+        raise HTTPException(422, f"case_id inválido: {case_id!r}")
+    return case_id
+
+
+def _dir_envio(case_id: str, envio_id: str) -> Path:
+    # Un directorio por envío: dos requests del mismo caso nunca comparten rutas
+    return UPLOAD_DIR / case_id / envio_id
+
+
+def _borrar_envio(dir_envio: Path):
+    shutil.rmtree(dir_envio, ignore_errors=True)
+    try:
+        dir_envio.parent.rmdir()  # solo si ya no quedan otros envíos del caso
+    except OSError:
+        pass
+
+
+def _rechazar_si_job_activo(case_id: str):
+    activo = app.state.cola_jobs.store.activo_para_caso(case_id)
+    if activo is not None:
+        raise HTTPException(409, f"El caso {case_id} ya tiene un job activo: {activo.id}")
+
+
+async def _recibir_archivos_caso(
+    dir_envio: Path, case_id: str, **uploads: UploadFile
+) -> Dict[str, ArchivoRecibido]:
+    """
+    Copia los uploads a `dir_envio` en bloques (sin cargarlos enteros en memoria),
+    con límites por archivo y por request y verificación de magic bytes.
+    Ante cualquier rechazo (o desconexión) borra el directorio del envío.
+    """
+    presupuesto = PresupuestoRequest()
+    recibidos: Dict[str, ArchivoRecibido] = {}
+    dir_envio.mkdir(parents=True, exist_ok=True)
+    try:
+        for campo, upload in uploads.items():
+            sufijo = CAMPOS_UPLOAD[campo]
+            destino = dir_envio / f"{case_id}_{sufijo}{Path(upload.filename).suffix.lower()}"
+            recibidos[campo] = await guardar_upload(upload, destino, campo, presupuesto)
+            await upload.close()  # libera el spool temporal de Starlette cuanto antes
+    except UploadRechazado as e:
+        _borrar_envio(dir_envio)
+        raise HTTPException(e.status, e.detalle)
+    except BaseException:
+        _borrar_envio(dir_envio)
+        raise
+    return recibidos
+
+
 # ============================================================
-# LIFESPAN: carga LLM + matriz 1 sola vez
+# LIFESPAN: carga prompts + LLM + matriz 1 sola vez
 # ============================================================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -64,8 +161,12 @@ async def lifespan(app: FastAPI):
     set_debug(False)
     os.environ["APP_ENV"] = os.environ.get("APP_ENV", "sbx")
 
-    # 1) LLM
+    # 0) Prompts: se cargan y validan una vez; falla el arranque si falta alguno
+    validar_prompts()
+
+    # 1) LLM (registro perezoso: solo se construye el cliente que se usa)
     llms = load_llms()
+    app.state.llms = llms
     gemini = llms.get("gemini_pro")
     if not gemini:
         raise RuntimeError("No se pudo cargar gemini_pro desde load_llms()")
@@ -77,21 +178,114 @@ async def lifespan(app: FastAPI):
     marcus_path = os.environ.get("MARCUS_XLSX_PATH", "app/utils/Descripción Circunstancias.xlsx")
     if not Path(marcus_path).exists():
         raise RuntimeError(f"No se encontró el Excel Marcus en: {marcus_path}")
-    app.state.contexto_marcus = cargar_matriz_marcus(marcus_path)
+    # Índice BM25 sobre la matriz: cada caso envía solo las circunstancias relevantes
+    # (str(indice) sigue siendo el contexto completo)
+    app.state.contexto_marcus = IndiceMarcus.desde_excel(marcus_path)
+
+    # 3) Cola de jobs asíncronos (backend local en proceso)
+    cfg_jobs = load_pipeline_parameters("jobs")
+    app.state.cola_jobs = ColaTrabajos(
+        procesar=_procesar_job,
+        store=crear_store(
+            cfg_jobs.get("backend", "local"),
+            max_jobs=int(cfg_jobs.get("max_jobs_retenidos", 1000)),
+            ttl_segundos=float(cfg_jobs.get("ttl_resultados_s", 3600)),
+        ),
+        workers=int(os.environ.get("JOBS_WORKERS") or cfg_jobs.get("workers", 2)),
+        max_cola=int(os.environ.get("JOBS_MAX_COLA") or cfg_jobs.get("max_cola", 50)),
+    )
+    app.state.cola_jobs.iniciar()
+
+    # 4) Límite global de casos en paralelo para los lotes (compartido entre requests)
+    cfg_lotes = config_lotes()
+    app.state.semaforo_lotes = asyncio.Semaphore(
+        int(os.environ.get("LOTES_MAX_CONCURRENTES") or cfg_lotes.get("max_casos_concurrentes", 4))
+    )
+
+    # 5) Executor propio y acotado para los casos (no el threadpool por defecto de anyio,
+    #    que comparten todas las rutas síncronas)
+    app.state.executor_casos = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("CASOS_MAX_HILOS") or config_plazos().get("max_hilos_casos", 8)),
+        thread_name_prefix="caso",
+    )
 
     yield
 
+    app.state.cola_jobs.detener()
+    app.state.executor_casos.shutdown(wait=False, cancel_futures=True)
+
 
 app = FastAPI(title="Motor Responsabilidad API", version="1.0.0", lifespan=lifespan)
 
 
+def _maximo_cuerpo(ruta: str) -> int:
+    return limite_bytes_lote() if ruta == "/process-cases" else PresupuestoRequest().max_bytes
+
+
+# Rechazo temprano (Content-Length o bytes contados), antes de que Starlette termine de recibir el multipart
+app.add_middleware(LimiteCuerpoMiddleware, maximo_para=_maximo_cuerpo)
+
+
 @app.get("/health")
 def health():
-    return {"ok": True}
+    llms = getattr(app.state, "llms", None)
+    return {"ok": True, "modelos_activos": llms.warm_models() if llms is not None else []}
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    cache = obtener_cache()
+    if cache is None:
+        return {"habilitada": False}
+    return {"habilitada": True, **cache.resumen()}
+
+
+@app.get("/rate-limit/stats")
+def rate_limit_stats():
+    return resumen_limitadores()
+
+
+@app.get("/hedging/stats")
+def hedging_stats():
+    return resumen_hedging()
+
+
+@app.get("/context-cache/stats")
+def context_cache_stats():
+    return metricas_context_cache.resumen()
+
+
+@app.get("/model-routing/stats")
+def model_routing_stats():
+    return estadisticas_enrutamiento.resumen()
+
+
+@app.get("/metrics")
+def metrics():
+    # Formato de exposición Prometheus (latencias por etapa, bytes, tokens, reintentos, casos en curso)
+    return Response(content=exportar_metricas(), media_type=CONTENT_TYPE_LATEST)
+
+
+# ============================================================
+# ENRUTAMIENTO DE MODELOS POR ETAPA
+# ============================================================
+def _modelos(usar_cache: bool = True) -> Optional[Callable[[str], Any]]:
+    """Resuelve nombre -> LLM sobre el registro cargado (ver config/model_routing.json)."""
+    llms = getattr(app.state, "llms", None)
+    if llms is None:
+        return None
+
+    def _resolver(nombre: str):
+        llm = llms[nombre]
+        if not usar_cache and hasattr(llm, "sin_cache"):
+            llm = llm.sin_cache()
+        return llm
+
+    return _resolver
 
 
 # ============================================================
-# CORE: tu pipeline (mismas 5 fases)
+# CORE: tu pipeline (mismas 5 fases, como grafo de dependencias)
 # ============================================================
 def _procesar_caso_por_rutas(
     case_id: str,
@@ -100,48 +294,127 @@ def _procesar_caso_por_rutas(
     ruta_audio: str,
     gemini,
     contexto_marcus,
+    on_inicio: Optional[Callable[[str], None]] = None,
+    on_fin: Optional[Callable[[str, Any, float], None]] = None,
+    modelos: Optional[Callable[[str], Any]] = None,
+    cancelacion: Optional[Cancelacion] = None,
+    reanudar: bool = True,
 ) -> Dict[str, Any]:
     out_case_dir = OUTPUT_DIR / case_id
     out_case_dir.mkdir(parents=True, exist_ok=True)
 
-    # 1) ANALISIS VISUAL
-    hechos_visual = procesar_imagen(ruta_visual_pdf, llm=gemini)
-    _save_json(hechos_visual, out_case_dir / "hechos_visual.json")
+    etapas = construir_etapas_caso(ruta_visual_pdf, ruta_ficha_png, ruta_audio, gemini, contexto_marcus,
+                                   modelos=modelos)
+    huellas = huellas_etapas(ruta_visual_pdf, ruta_ficha_png, ruta_audio, contexto_marcus)
+    checkpoint = CheckpointCaso(out_case_dir)
+    # Reintento con el mismo case_id: las etapas ya guardadas (mismas entradas) no se recalculan
+    precargados = precargar_checkpoint(etapas, huellas, checkpoint) if reanudar else {}
+
+    # Etapas que terminaron devolviendo {"error": ...} en vez de lanzar excepción
+    errores_salida: Dict[str, str] = {}
+
+    # visual, ficha y audio en paralelo; circunstancias y precisión
+    # arrancan en cuanto terminan sus dependencias
+    def _guardar(etapa: str, resultado: Any, duracion: float):
+        ruta = out_case_dir / ARCHIVOS_SALIDA[etapa]
+        if etapa == "audio":
+            _save_text(resultado, ruta)
+        else:
+            _save_json(resultado, ruta)
+        if es_resultado_error(resultado):
+            errores_salida[etapa] = str(resultado.get("error")) if isinstance(resultado, dict) else "salida vacía"
+        else:
+            checkpoint.registrar(etapa, huellas[etapa], ARCHIVOS_SALIDA[etapa])
+        if on_fin:
+            on_fin(etapa, resultado, duracion)
+
+    with caso_en_curso():
+        plan = ejecutar_etapas(
+            etapas,
+            precargados=precargados,
+            on_inicio=on_inicio,
+            on_fin=_guardar,
+            cancelacion=cancelacion,
+            intervalo_sondeo_s=float(config_plazos().get("intervalo_sondeo_s", 0.5)),
+        )
+        if plan.cancelado is not None:
+            raise CasoCancelado(plan.cancelado.motivo, por_plazo=plan.cancelado.por_plazo, detalle={
+                "case_id": case_id,
+                "etapas_guardadas": sorted(plan.resultados),
+                "errores": plan.errores,
+                "reanudable": True,
+            })
+
+    errores = errores_caso(plan, errores_salida)
+    validas = [e for e, r in plan.resultados.items() if not es_resultado_error(r)]
+    faltantes = [e for e in ETAPAS_REQUERIDAS if e not in validas]
+    if not validas or faltantes:
+        # Sin salida utilizable: error del caso, con el detalle por etapa (no solo un mensaje)
+        raise CasoFallido(
+            f"Etapas requeridas sin resultado: {faltantes}" if faltantes else "Ninguna etapa produjo resultado",
+            detalle={"case_id": case_id, **errores, "etapas_guardadas": sorted(validas), "reanudable": True},
+        )
 
-    # 2) FICHA DEL SINIESTRO (PNG)
-    ficha_siniestro = procesar_imagen_ficha(ruta_ficha_png, gemini)
-    _save_json(ficha_siniestro, out_case_dir / "ficha_siniestro.json")
+    # Resultado parcial: lo que sí se calculó se devuelve junto con los errores por etapa
+    return {
+        "case_id": case_id,
+        "estado": "con_errores" if errores["errores_etapas"] else "completo",
+        **errores,
+        **{CLAVES_RESULTADO[etapa]: valor for etapa, valor in plan.resultados.items()},
+        "tiempos_etapas": {**plan.tiempos, "total": plan.total},
+        "etapas_reutilizadas": plan.reutilizadas,
+        "outputs_dir": str(out_case_dir),
+    }
 
-    # 3) TRANSCRIPCIÓN AUDIO
-    texto_transcrito = transcribir_audio_gemini(ruta_audio, llm=gemini)
-    _save_text(texto_transcrito, out_case_dir / "transcripcion.txt")
 
-    # 4) EVALUAR CIRCUNSTANCIAS MARCUS
-    resultado_circunstancias = evaluar_circunstancias_marcus(
-        contexto_marcus=contexto_marcus,
-        json_visual=hechos_visual.get("resultado", hechos_visual),
-        json_transcripcion=texto_transcrito,
-        llm=gemini,
+# ============================================================
+# EJECUCIÓN DE CASOS: executor acotado + cancelación
+# ============================================================
+async def _en_executor_casos(funcion: Callable[..., Any], *args, **kwargs) -> Any:
+    executor = getattr(app.state, "executor_casos", None)
+    if executor is None:  # app sin lifespan (p. ej. TestClient de los benchmarks)
+        return await run_in_threadpool(funcion, *args, **kwargs)
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(ctx.run, funcion, *args, **kwargs)
     )
-    _save_json(resultado_circunstancias, out_case_dir / "resultado_circunstancias.json")
 
-    # 5) EVALUAR PRECISIÓN VISUAL VS FICHA
-    resultado_precision = evaluar_coherencia_visual_vs_ficha(
-        llm=gemini,
-        json_analisis_visual=json.dumps(hechos_visual, ensure_ascii=False),
-        json_ficha_siniestro=json.dumps(ficha_siniestro, ensure_ascii=False),
-    )
-    _save_json(resultado_precision, out_case_dir / "precision_visual_vs_ficha.json")
 
-    return {
-        "case_id": case_id,
-        "hechos_visual": hechos_visual,
-        "ficha_siniestro": ficha_siniestro,
-        "transcripcion_text": texto_transcrito,
-        "resultado_circunstancias": resultado_circunstancias,
-        "precision_visual_vs_ficha": resultado_precision,
-        "outputs_dir": str(out_case_dir),
-    }
+async def _vigilar_desconexion(request: Request, cancelacion: Cancelacion):
+    intervalo = float(config_plazos().get("intervalo_sondeo_s", 0.5))
+    while not cancelacion.cancelada:
+        if await request.is_disconnected():
+            logging.warning("🔌 Cliente desconectado: se cancelan las etapas pendientes del caso")
+            cancelacion.cancelar("cliente desconectado")
+            return
+        await asyncio.sleep(intervalo)
+
+
+async def _ejecutar_caso(request: Optional[Request], cancelacion: Cancelacion, *args, **kwargs) -> Dict[str, Any]:
+    """
+    Corre `_procesar_caso_por_rutas` en el executor de casos con `cancelacion`
+    (plazo del caso). Si el cliente se desconecta o el request se cancela, el
+    caso deja de lanzar etapas y de llamar al LLM; lo ya guardado queda en el
+    checkpoint para reanudar con el mismo case_id.
+    """
+    vigilante = asyncio.create_task(_vigilar_desconexion(request, cancelacion)) if request is not None else None
+    try:
+        return await _en_executor_casos(_procesar_caso_por_rutas, *args, cancelacion=cancelacion, **kwargs)
+    except asyncio.CancelledError:
+        cancelacion.cancelar("request cancelado")
+        raise
+    finally:
+        if vigilante is not None:
+            vigilante.cancel()
+
+
+def _http_cancelado(e: CasoCancelado) -> HTTPException:
+    # 504 si venció el plazo; 499 (convención nginx) si el cliente se fue
+    return HTTPException(504 if e.por_plazo else 499, {"detalle": e.motivo, **e.detalle})
+
+
+def _http_fallido(e: CasoFallido) -> HTTPException:
+    return HTTPException(500, {"detalle": e.motivo, **e.detalle})
 
 
 # ============================================================
@@ -149,40 +422,374 @@ def _procesar_caso_por_rutas(
 # ============================================================
 @app.post("/process-case")
 async def process_case(
+    request: Request,
     visual_pdf: UploadFile = File(...),
     ficha_png: UploadFile = File(...),
     audio: UploadFile = File(...),
     case_id: Optional[str] = Form(None),  # opcional, si no lo mandas se genera
+    usar_cache: bool = Form(True),  # False = fuerza llamadas frescas al LLM
 ):
     _validate_ext(visual_pdf.filename, EXT_VISUAL, "visual_pdf")
     _validate_ext(ficha_png.filename, EXT_FICHA, "ficha_png")
     _validate_ext(audio.filename, EXT_AUDIO, "audio")
 
-    case_id = case_id or uuid.uuid4().hex
-
-    # Guardar en /tmp (Cloud Run)
-    pdf_path = UPLOAD_DIR / f"{case_id}_visual{Path(visual_pdf.filename).suffix.lower()}"
-    png_path = UPLOAD_DIR / f"{case_id}_ficha{Path(ficha_png.filename).suffix.lower()}"
-    aud_path = UPLOAD_DIR / f"{case_id}_audio{Path(audio.filename).suffix.lower()}"
+    case_id = _validar_case_id(case_id)
+    _rechazar_si_job_activo(case_id)
 
-    pdf_path.write_bytes(await visual_pdf.read())
-    png_path.write_bytes(await ficha_png.read())
-    aud_path.write_bytes(await audio.read())
+    # Guardar en /tmp (Cloud Run) en streaming, con límites y hash
+    dir_envio = _dir_envio(case_id, uuid.uuid4().hex)
+    archivos = await _recibir_archivos_caso(
+        dir_envio, case_id, visual_pdf=visual_pdf, ficha_png=ficha_png, audio=audio
+    )
+    pdf_path = archivos["visual_pdf"].ruta
+    png_path = archivos["ficha_png"].ruta
+    aud_path = archivos["audio"].ruta
 
     gemini = app.state.gemini
+    if not usar_cache and hasattr(gemini, "sin_cache"):
+        gemini = gemini.sin_cache()
+    modelos = _modelos(usar_cache)
     contexto_marcus = app.state.contexto_marcus
 
     try:
-        result = await run_in_threadpool(
-            _procesar_caso_por_rutas,
+        result = await _ejecutar_caso(
+            request,
+            cancelacion_caso(),
             case_id,
             str(pdf_path),
             str(png_path),
             str(aud_path),
             gemini,
             contexto_marcus,
+            modelos=modelos,
+            reanudar=usar_cache,
         )
+    except CasoCancelado as e:
+        raise _http_cancelado(e)
+    except CasoFallido as e:
+        raise _http_fallido(e)
     except Exception as e:
         raise HTTPException(500, f"Error procesando caso {case_id}: {e}")
+    finally:
+        # Los checkpoints guardan hashes de las entradas, no los archivos
+        _borrar_envio(dir_envio)
+
+    return {"ok": True, **result, "archivos": {campo: a.resumen() for campo, a in archivos.items()}}
+
+
+# ============================================================
+# LOTES: varios casos en un solo request (manifiesto + archivos, o zip)
+# ============================================================
+async def _recibir_lote_multipart(
+    lote_dir: Path, manifiesto: str, archivos: List[UploadFile]
+) -> Dict[str, Dict[str, Path]]:
+    casos = parsear_manifiesto(manifiesto)
+    referencias: Dict[str, tuple] = {}  # nombre del archivo -> (case_id, campo)
+    for caso in casos:
+        for campo, nombre in caso.archivos.items():
+            if nombre in referencias:
+                raise UploadRechazado(400, f"'{nombre}' está referenciado más de una vez en el manifiesto.")
+            referencias[nombre] = (caso.case_id, campo)
+
+    presupuesto = PresupuestoRequest(limite_bytes_lote())
+    rutas: Dict[str, Dict[str, Path]] = {caso.case_id: {} for caso in casos}
+    for upload in archivos:
+        if upload.filename not in referencias:
+            raise UploadRechazado(400, f"'{upload.filename}' no aparece en el manifiesto.")
+        case_id, campo = referencias[upload.filename]
+        destino = lote_dir / f"{case_id}_{campo}{Path(upload.filename).suffix.lower()}"
+        rutas[case_id][campo] = (await guardar_upload(upload, destino, campo, presupuesto)).ruta
+        await upload.close()
+
+    faltantes = sorted(n for n, (cid, campo) in referencias.items() if campo not in rutas[cid])
+    if faltantes:
+        raise UploadRechazado(400, f"Archivos del manifiesto no recibidos: {faltantes}")
+    return rutas
+
+
+@app.post("/process-cases")
+async def process_cases(
+    request: Request,
+    manifest: Optional[str] = Form(None),
+    archivos: Optional[List[UploadFile]] = File(None),
+    lote_zip: Optional[UploadFile] = File(None),
+    usar_cache: bool = Form(True),
+):
+    if (lote_zip is None) == (manifest is None):
+        raise HTTPException(400, "Envía 'manifest' + 'archivos', o bien 'lote_zip' (no ambos).")
+
+    lote_id = uuid.uuid4().hex
+    lote_dir = UPLOAD_DIR / f"lote_{lote_id}"
+    lote_dir.mkdir(parents=True, exist_ok=True)
+    # Los archivos del lote solo se necesitan mientras se procesa
+    try:
+        try:
+            if lote_zip is not None:
+                _validate_ext(lote_zip.filename, {".zip"}, "lote_zip")
+                ruta_zip = lote_dir / "lote.zip"
+                await guardar_upload(lote_zip, ruta_zip, "lote_zip", PresupuestoRequest(limite_bytes_lote()),
+                                     max_bytes=limite_bytes_lote())
+                await lote_zip.close()
+                rutas = await run_in_threadpool(extraer_zip_lote, ruta_zip, lote_dir)
+                ruta_zip.unlink(missing_ok=True)
+            else:
+                rutas = await _recibir_lote_multipart(lote_dir, manifest, archivos or [])
+        except UploadRechazado as e:
+            raise HTTPException(e.status, e.detalle)
+
+        gemini = app.state.gemini
+        if not usar_cache and hasattr(gemini, "sin_cache"):
+            gemini = gemini.sin_cache()
+        modelos = _modelos(usar_cache)
+        contexto_marcus = app.state.contexto_marcus
+        semaforo: asyncio.Semaphore = app.state.semaforo_lotes
+        # Una desconexión cancela todo el lote; cada caso tiene además su propio plazo
+        cancelacion_lote = Cancelacion()
+
+        async def _un_caso(case_id: str, rutas_caso: Dict[str, Path]) -> Dict[str, Any]:
+            # El semáforo es global: varios lotes simultáneos comparten el mismo límite
+            async with semaforo:
+                try:
+                    result = await _ejecutar_caso(
+                        None,
+                        cancelacion_caso(cancelacion_lote),
+                        case_id,
+                        str(rutas_caso["visual_pdf"]),
+                        str(rutas_caso["ficha_png"]),
+                        str(rutas_caso["audio"]),
+                        gemini,
+                        contexto_marcus,
+                        modelos=modelos,
+                        reanudar=usar_cache,
+                    )
+                    return {"ok": True, **result}
+                except CasoCancelado as e:
+                    logging.warning(f"🛑 Caso {case_id} del lote {lote_id} cancelado: {e.motivo}")
+                    return {"ok": False, "case_id": case_id, "error": e.motivo, "cancelado": True, **e.detalle}
+                except CasoFallido as e:
+                    logging.error(f"❌ Caso {case_id} del lote {lote_id} falló: {e.motivo}")
+                    return {"ok": False, "case_id": case_id, "error": e.motivo, **e.detalle}
+                except Exception as e:
+                    logging.error(f"❌ Caso {case_id} del lote {lote_id} falló: {e}")
+                    return {"ok": False, "case_id": case_id, "error": str(e)}
+
+        vigilante = asyncio.create_task(_vigilar_desconexion(request, cancelacion_lote))
+        try:
+            resultados = await asyncio.gather(*(_un_caso(cid, r) for cid, r in rutas.items()))
+        except asyncio.CancelledError:
+            cancelacion_lote.cancelar("request cancelado")
+            raise
+        finally:
+            vigilante.cancel()
+        exitosos = sum(1 for r in resultados if r["ok"])
+        return {
+            "ok": True,
+            "lote_id": lote_id,
+            "total": len(resultados),
+            "exitosos": exitosos,
+            "con_errores": sum(1 for r in resultados if r.get("estado") == "con_errores"),
+            "fallidos": len(resultados) - exitosos,
+            "resultados": resultados,
+        }
+    finally:
+        shutil.rmtree(lote_dir, ignore_errors=True)
+
+
+# ============================================================
+# STREAMING: cada etapa se emite (SSE / NDJSON) apenas termina
+# ============================================================
+def _formatear_evento(evento: Dict[str, Any], formato: str) -> str:
+    data = json.dumps(evento, ensure_ascii=False, default=str)
+    if formato == "ndjson":
+        return data + "\n"
+    return f"event: {evento['evento']}\ndata: {data}\n\n"
+
+
+@app.post("/process-case/stream")
+async def process_case_stream(
+    visual_pdf: UploadFile = File(...),
+    ficha_png: UploadFile = File(...),
+    audio: UploadFile = File(...),
+    case_id: Optional[str] = Form(None),
+    usar_cache: bool = Form(True),
+    formato: str = Query("sse", pattern="^(sse|ndjson)$"),
+):
+    _validate_ext(visual_pdf.filename, EXT_VISUAL, "visual_pdf")
+    _validate_ext(ficha_png.filename, EXT_FICHA, "ficha_png")
+    _validate_ext(audio.filename, EXT_AUDIO, "audio")
+
+    case_id = _validar_case_id(case_id)
+    _rechazar_si_job_activo(case_id)
+    dir_envio = _dir_envio(case_id, uuid.uuid4().hex)
+    archivos = await _recibir_archivos_caso(
+        dir_envio, case_id, visual_pdf=visual_pdf, ficha_png=ficha_png, audio=audio
+    )
+
+    gemini = app.state.gemini
+    if not usar_cache and hasattr(gemini, "sin_cache"):
+        gemini = gemini.sin_cache()
+    modelos = _modelos(usar_cache)
+
+    loop = asyncio.get_running_loop()
+    eventos: asyncio.Queue = asyncio.Queue()
+
+    def _emitir(evento: Dict[str, Any]):
+        # Llamado desde el hilo del pipeline
+        loop.call_soon_threadsafe(eventos.put_nowait, evento)
+
+    def _on_fin(etapa: str, resultado: Any, duracion: float):
+        _emitir({
+            "evento": "etapa",
+            "case_id": case_id,
+            "etapa": etapa,
+            "clave": CLAVES_RESULTADO[etapa],
+            "duracion_s": round(duracion, 3),
+            "resultado": resultado,
+        })
+
+    cancelacion = cancelacion_caso()
+
+    async def _ejecutar():
+        try:
+            # Sin vigilante propio: StreamingResponse ya escucha la desconexión y cierra `_generador`
+            result = await _ejecutar_caso(
+                None,
+                cancelacion,
+                case_id,
+                str(archivos["visual_pdf"].ruta),
+                str(archivos["ficha_png"].ruta),
+                str(archivos["audio"].ruta),
+                gemini,
+                app.state.contexto_marcus,
+                on_fin=_on_fin,
+                modelos=modelos,
+                reanudar=usar_cache,
+            )
+            await eventos.put({
+                "evento": "resumen",
+                "ok": True,
+                "case_id": case_id,
+                "estado": result["estado"],
+                "errores_etapas": result["errores_etapas"],
+                "etapas_bloqueadas": result["etapas_bloqueadas"],
+                "tiempos_etapas": result["tiempos_etapas"],
+                "outputs_dir": result["outputs_dir"],
+                "archivos": {campo: a.resumen() for campo, a in archivos.items()},
+            })
+        except CasoCancelado as e:
+            await eventos.put({"evento": "error", "ok": False, "cancelado": True, "detalle": e.motivo, **e.detalle})
+        except CasoFallido as e:
+            await eventos.put({"evento": "error", "ok": False, "detalle": e.motivo, **e.detalle})
+        except Exception as e:
+            await eventos.put({"evento": "error", "ok": False, "case_id": case_id, "detalle": str(e)})
+        finally:
+            _borrar_envio(dir_envio)
+            await eventos.put(None)
+
+    tarea = asyncio.create_task(_ejecutar())
+
+    async def _generador():
+        try:
+            while True:
+                evento = await eventos.get()
+                if evento is None:
+                    break
+                yield _formatear_evento(evento, formato)
+            await tarea
+        finally:
+            if not tarea.done():
+                # El cliente cerró el stream: no se lanzan más etapas ni llamadas al LLM
+                cancelacion.cancelar("cliente desconectado")
+
+    media_type = "application/x-ndjson" if formato == "ndjson" else "text/event-stream"
+    return StreamingResponse(_generador(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+
+# ============================================================
+# JOBS ASÍNCRONOS: submit inmediato + consulta de estado
+# ============================================================
+def _procesar_job(job_id: str, reportar: Callable[[str, str], None], **payload) -> Dict[str, Any]:
+    try:
+        return _procesar_caso_por_rutas(
+            payload["case_id"],
+            payload["ruta_visual_pdf"],
+            payload["ruta_ficha_png"],
+            payload["ruta_audio"],
+            payload["gemini"],
+            payload["contexto_marcus"],
+            on_inicio=lambda etapa: reportar("inicio", etapa),
+            on_fin=lambda etapa, _resultado, _duracion: reportar("fin", etapa),
+            modelos=payload.get("modelos"),
+            # Sin cliente conectado: solo aplican los plazos
+            cancelacion=cancelacion_caso(),
+            reanudar=payload.get("reanudar", True),
+        )
+    finally:
+        _borrar_envio(Path(payload["dir_envio"]))
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    visual_pdf: UploadFile = File(...),
+    ficha_png: UploadFile = File(...),
+    audio: UploadFile = File(...),
+    case_id: Optional[str] = Form(None),
+    usar_cache: bool = Form(True),
+):
+    _validate_ext(visual_pdf.filename, EXT_VISUAL, "visual_pdf")
+    _validate_ext(ficha_png.filename, EXT_FICHA, "ficha_png")
+    _validate_ext(audio.filename, EXT_AUDIO, "audio")
+
+    case_id = _validar_case_id(case_id)
+    cola = app.state.cola_jobs
+    # Reservar el job antes de escribir nada: el caso queda activo de forma
+    # atómica y los uploads van al directorio propio del job
+    try:
+        job = cola.reservar(case_id)
+    except CasoEnCurso as e:
+        raise HTTPException(409, str(e))
+    dir_envio = _dir_envio(case_id, job.id)
+    try:
+        archivos = await _recibir_archivos_caso(
+            dir_envio, case_id, visual_pdf=visual_pdf, ficha_png=ficha_png, audio=audio
+        )
+    except BaseException as e:
+        cola.descartar(job.id, f"Upload rechazado: {getattr(e, 'detail', None) or type(e).__name__}")
+        raise
+
+    gemini = app.state.gemini
+    if not usar_cache and hasattr(gemini, "sin_cache"):
+        gemini = gemini.sin_cache()
+    modelos = _modelos(usar_cache)
+
+    try:
+        cola.despachar(
+            job,
+            dir_envio=str(dir_envio),
+            ruta_visual_pdf=str(archivos["visual_pdf"].ruta),
+            ruta_ficha_png=str(archivos["ficha_png"].ruta),
+            ruta_audio=str(archivos["audio"].ruta),
+            gemini=gemini,
+            modelos=modelos,
+            contexto_marcus=app.state.contexto_marcus,
+            reanudar=usar_cache,
+        )
+    except ColaLlena as e:
+        _borrar_envio(dir_envio)
+        raise HTTPException(503, str(e))
+
+    return {
+        "job_id": job.id,
+        "case_id": job.case_id,
+        "estado": job.estado.value,
+        "status_url": f"/jobs/{job.id}",
+        "en_cola": cola.profundidad(),
+    }
+
 
-    return {"ok": True, **result}
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = app.state.cola_jobs.store.obtener(job_id)
+    if job is None:
+        raise HTTPException(404, f"Job no encontrado: {job_id}")
+    return job.to_dict()